@@ -15,6 +15,11 @@ users run them), drives traffic through it, and measures:
   * latency      - small request/response round-trip time (interactive traffic)
   * setup        - time to establish a new tunneled connection (FTE negotiation)
   * resilience   - behaviour when the encoded link is torn down mid-transfer
+  * streams      - aggregate throughput and fairness of many concurrent bulk
+                   transfers through one tunnel (--streams)
+
+With --in-process the client and server run as threads of this process
+instead, and --profile records where their time goes.
 
 Every scenario can be run through an in-process "link shaper" that emulates a
 slow / high-latency / bandwidth-constrained link, and against a plain-TCP relay
@@ -100,6 +105,72 @@ def recv_n(sock, n):
     return b''.join(chunks)
 
 
+def process_cpu_seconds(pids):
+    """CPU time (user + system) used so far by the processes pids and all of
+    their descendants, such as fteproxy's --workers, or None where it cannot
+    be read. Read from /proc where there is one, else from ps(1)."""
+    table = _process_table()
+    if table is None:
+        return None
+    children = {}
+    for pid, (ppid, _) in table.items():
+        children.setdefault(ppid, []).append(pid)
+    total, todo, seen = 0.0, list(pids), set()
+    while todo:
+        pid = todo.pop()
+        if pid in seen or pid not in table:
+            continue
+        seen.add(pid)
+        total += table[pid][1]
+        todo.extend(children.get(pid, []))
+    return total
+
+
+def _process_table():
+    """{pid: (ppid, cpu seconds)} of every process, or None."""
+    table = {}
+    if os.path.isdir('/proc/self'):
+        tick = os.sysconf('SC_CLK_TCK')
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+            try:
+                with open(f'/proc/{name}/stat') as fh:
+                    # the fields after "(comm)": state, ppid, ..., utime, stime
+                    fields = fh.read().rsplit(')', 1)[1].split()
+            except (OSError, IndexError):
+                continue
+            table[int(name)] = (int(fields[1]), (int(fields[11]) + int(fields[12])) / tick)
+        return table
+    try:
+        out = subprocess.run(['ps', '-A', '-o', 'pid=,ppid=,time='], capture_output=True,
+                             text=True, timeout=10).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    for line in out.splitlines():
+        pid, ppid, cpu = line.split()
+        table[int(pid)] = (int(ppid), _parse_cputime(cpu))
+    return table or None
+
+
+def _parse_cputime(s):
+    # ps(1) TIME: [dd-][hh:]mm:ss[.ff]
+    days, _, s = s.rpartition('-')
+    seconds = 0.0
+    for part in s.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds + 86400 * int(days or 0)
+
+
+def jain_index(rates):
+    """Jain's fairness index of rates: 1.0 when all are equal, down to 1/n
+    when one of n takes everything."""
+    square_sum = sum(r * r for r in rates)
+    if not square_sum:
+        return 0.0
+    return sum(rates) ** 2 / (len(rates) * square_sum)
+
+
 # --------------------------------------------------------------------------- #
 # Destinations (the "origin server" the proxy forwards to)
 # --------------------------------------------------------------------------- #
@@ -205,15 +276,22 @@ class Shaper(threading.Thread):
                 continue
             except OSError:
                 break
-            try:
-                upstream = socket.create_connection(('127.0.0.1', self.target_port))
-            except OSError:
-                downstream.close()
-                continue
-            with self._conns_lock:
-                self._conns += [downstream, upstream]
-            for a, b in ((downstream, upstream), (upstream, downstream)):
-                threading.Thread(target=self._pump, args=(a, b), daemon=True).start()
+            threading.Thread(target=self._connect, args=(downstream,), daemon=True).start()
+
+    def _connect(self, downstream):
+        # The kernel completes the client's handshake with this relay at once,
+        # where a real link takes a round trip for it: hold the connection for
+        # one before relaying anything, so that connection setup pays for it.
+        time.sleep(2 * self.delay)
+        try:
+            upstream = socket.create_connection(('127.0.0.1', self.target_port))
+        except OSError:
+            downstream.close()
+            return
+        with self._conns_lock:
+            self._conns += [downstream, upstream]
+        for a, b in ((downstream, upstream), (upstream, downstream)):
+            threading.Thread(target=self._pump, args=(a, b), daemon=True).start()
 
     def _release_delay(self):
         d = self.delay
@@ -401,8 +479,19 @@ class FteProxyTunnel:
     """
 
     def __init__(self, dest_port, upstream_format=None, downstream_format=None,
-                 shaper_kwargs=None, verbose=False):
+                 shaper_kwargs=None, verbose=False, codec_pool=0, pipeline_depth=0,
+                 adaptive_cells=False, coalesce_window=0, upstream_pool=0, mux=False,
+                 workers=1, relay_backend=None, engine=None):
         self.dest_port = dest_port
+        self.mux = mux
+        self.workers = workers
+        self.relay_backend = relay_backend
+        self.engine = engine
+        self.upstream_pool = upstream_pool
+        self.coalesce_window = coalesce_window
+        self.codec_pool = codec_pool
+        self.pipeline_depth = pipeline_depth
+        self.adaptive_cells = adaptive_cells
         self.entry_port = free_port()
         self.server_port = free_port()
         self.upstream_format = upstream_format
@@ -419,6 +508,22 @@ class FteProxyTunnel:
         server_cmd = [py, '-m', 'fteproxy', '--mode', 'server', '--quiet',
                       '--server_ip', '127.0.0.1', '--server_port', str(self.server_port),
                       '--proxy_ip', '127.0.0.1', '--proxy_port', str(self.dest_port)]
+        server_cmd += ['--codec-pool', str(self.codec_pool),
+                       '--pipeline-depth', str(self.pipeline_depth)]
+        if self.adaptive_cells:
+            server_cmd += ['--adaptive-cells']
+        if self.coalesce_window:
+            server_cmd += ['--coalesce-window', str(self.coalesce_window)]
+        if self.upstream_pool:
+            server_cmd += ['--upstream-pool', str(self.upstream_pool)]
+        if self.mux:
+            server_cmd += ['--mux']
+        if self.workers > 1:
+            server_cmd += ['--workers', str(self.workers)]
+        if self.relay_backend:
+            server_cmd += ['--relay-backend', self.relay_backend]
+        if self.engine:
+            server_cmd += ['--engine', self.engine]
         self.procs.append(subprocess.Popen(server_cmd, stdout=out, stderr=out))
 
         # Client connects either straight to the server, or via the shaper.
@@ -437,6 +542,20 @@ class FteProxyTunnel:
             client_cmd += ['--upstream-format', self.upstream_format]
         if self.downstream_format:
             client_cmd += ['--downstream-format', self.downstream_format]
+        client_cmd += ['--codec-pool', str(self.codec_pool),
+                       '--pipeline-depth', str(self.pipeline_depth)]
+        if self.adaptive_cells:
+            client_cmd += ['--adaptive-cells']
+        if self.coalesce_window:
+            client_cmd += ['--coalesce-window', str(self.coalesce_window)]
+        if self.mux:
+            client_cmd += ['--mux']
+        if self.workers > 1:
+            client_cmd += ['--workers', str(self.workers)]
+        if self.relay_backend:
+            client_cmd += ['--relay-backend', self.relay_backend]
+        if self.engine:
+            client_cmd += ['--engine', self.engine]
         self.procs.append(subprocess.Popen(client_cmd, stdout=out, stderr=out))
 
         if not wait_listening(self.server_port):
@@ -458,6 +577,102 @@ class FteProxyTunnel:
                 p.wait(timeout=5)
 
 
+class InProcessTunnel:
+    """The same client+server pair as FteProxyTunnel, but run as threads of
+    this process: fteproxy.client.listener and fteproxy.server.listener, set
+    up through fteproxy.conf the way the command line sets them up. Slower
+    than the subprocesses, since the benchmark and both ends of the tunnel
+    share one GIL, but the relay can be profiled (--profile).
+    """
+
+    def __init__(self, dest_port, upstream_format=None, downstream_format=None,
+                 shaper_kwargs=None, codec_pool=0, pipeline_depth=0,
+                 adaptive_cells=False, coalesce_window=0, upstream_pool=0, mux=False,
+                 relay_backend=None, engine=None, **_ignored):
+        self.dest_port = dest_port
+        self.engine = engine
+        self.entry_port = free_port()
+        self.server_port = free_port()
+        self.settings = {
+            'runtime.fteproxy.record_layer.codec_pool.workers': codec_pool,
+            'runtime.fteproxy.relay.pipeline_depth': pipeline_depth,
+            'runtime.fteproxy.record_layer.adaptive_cell_size': adaptive_cells,
+            'runtime.fteproxy.relay.coalesce_window': coalesce_window,
+            'runtime.fteproxy.relay.upstream_pool.min_idle': upstream_pool,
+            'runtime.fteproxy.mux': mux,
+        }
+        if upstream_format:
+            self.settings['runtime.state.upstream_language'] = upstream_format
+        if downstream_format:
+            self.settings['runtime.state.downstream_language'] = downstream_format
+        if relay_backend:
+            self.settings['runtime.fteproxy.relay.backend'] = relay_backend
+        self.listeners = []
+        self.shaper = None
+        self._shaper_kwargs = shaper_kwargs
+        self._saved = {}
+
+    def start(self):
+        import fteproxy.client
+        import fteproxy.conf
+        import fteproxy.defs
+        import fteproxy.format_cache
+        import fteproxy.server
+
+        for key, value in self.settings.items():
+            self._saved[key] = fteproxy.conf.getValue(key)
+            fteproxy.conf.setValue(key, value)
+
+        # Load every format up front, as a server does before it listens, so
+        # that neither the transfers nor a profile of them include it.
+        key = fteproxy.conf.getValue('runtime.fteproxy.encrypter.key')
+        for language in fteproxy.defs.load_definitions():
+            fteproxy.format_cache.get_encoder(fteproxy.defs.getRegex(language),
+                                              fteproxy.defs.getFixedSlice(language), key)
+
+        server = fteproxy.server.listener('127.0.0.1', self.server_port,
+                                          '127.0.0.1', self.dest_port,
+                                          engine=self.engine)
+        server.daemon = True
+        server.start()
+        self.listeners.append(server)
+
+        if self._shaper_kwargs is not None:
+            shaper_port = free_port()
+            self.shaper = Shaper(shaper_port, self.server_port, **self._shaper_kwargs)
+            self.shaper.start()
+            client_target = shaper_port
+        else:
+            client_target = self.server_port
+
+        client = fteproxy.client.listener('127.0.0.1', self.entry_port,
+                                          '127.0.0.1', client_target,
+                                          engine=self.engine)
+        client.daemon = True
+        client.start()
+        self.listeners.append(client)
+
+        if not wait_listening(self.server_port):
+            raise RuntimeError("in-process fteproxy server did not come up")
+        if not wait_listening(self.entry_port):
+            raise RuntimeError("in-process fteproxy client did not come up")
+        time.sleep(0.3)
+        return self
+
+    def stop(self):
+        import fteproxy.conf
+
+        if self.shaper:
+            self.shaper.stop()
+        for listener in reversed(self.listeners):
+            with contextlib.suppress(Exception):
+                listener.stop()
+        for listener in self.listeners:
+            listener.join(timeout=5)
+        for key, value in self._saved.items():
+            fteproxy.conf.setValue(key, value)
+
+
 class PlainTunnel:
     """Identical-topology baseline built from two TcpRelays instead of fteproxy,
     with the same optional shaper in the middle."""
@@ -520,10 +735,12 @@ def workload_throughput(entry_port, nbytes, direction='echo', send_chunk=1 << 16
     app.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     app.settimeout(60)
 
-    received = {'n': 0}
+    received = {'n': 0, 'first': None}
 
     def receiver():
-        received['n'] = len(recv_n(app, nbytes))
+        first = app.recv(min(1 << 16, nbytes))
+        received['first'] = time.perf_counter()
+        received['n'] = len(first) + len(recv_n(app, nbytes - len(first)))
 
     t0 = time.perf_counter()
     if direction == 'echo':
@@ -546,7 +763,79 @@ def workload_throughput(entry_port, nbytes, direction='echo', send_chunk=1 << 16
     dt = time.perf_counter() - t0
     app.close()
     mbps = (nbytes * 8 / 1e6) / dt if dt > 0 else 0.0
-    return {'ok': ok, 'bytes': nbytes, 'seconds': dt, 'mbit_s': mbps}
+    result = {'ok': ok, 'bytes': nbytes, 'seconds': dt, 'mbit_s': mbps}
+    if received['first'] is not None:
+        # Time to the first echoed byte: how long the far end waits for the
+        # first cell to arrive whole before it can decode anything.
+        result['first_byte_ms'] = (received['first'] - t0) * 1000.0
+    return result
+
+
+def workload_streams(entry_port, nstreams, nbytes, direction='echo', send_chunk=1 << 16):
+    """Push nbytes through each of nstreams connections at once, the way
+    workload_throughput pushes them through one. All connections are opened
+    first, then released together. Reports the aggregate goodput, from the
+    release until the last stream is done, and the goodput of each stream. An
+    upload stream is done when the sink's close comes back through the
+    tunnel, that is once the sink has read all of it, not once it is sent."""
+    payload = os.urandom(nbytes) if nbytes <= (4 << 20) else (b'x' * nbytes)
+    apps = []
+    for _ in range(nstreams):
+        app = socket.create_connection(('127.0.0.1', entry_port), timeout=30)
+        app.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        app.settimeout(120)
+        apps.append(app)
+
+    go = threading.Barrier(nstreams + 1)
+    streams = [{'ok': False, 'start': None, 'done': None} for _ in apps]
+
+    def transfer(app, stream):
+        received = {'n': 0}
+
+        def receiver():
+            with contextlib.suppress(OSError):
+                received['n'] = len(recv_n(app, nbytes))
+
+        rx = threading.Thread(target=receiver, daemon=True)
+        if direction == 'echo':
+            rx.start()
+        go.wait()
+        stream['start'] = time.perf_counter()
+        try:
+            sent = 0
+            mv = memoryview(payload)
+            while sent < nbytes:
+                sent += app.send(mv[sent:sent + send_chunk])
+            if direction == 'echo':
+                rx.join(timeout=120)
+                stream['ok'] = received['n'] == nbytes
+            else:  # upload / sink: done once the sink has read it all and closed
+                app.shutdown(socket.SHUT_WR)
+                stream['ok'] = app.recv(1) == b''
+        except OSError:
+            pass
+        stream['done'] = time.perf_counter()
+
+    threads = [threading.Thread(target=transfer, args=(app, stream), daemon=True)
+               for app, stream in zip(apps, streams)]
+    for t in threads:
+        t.start()
+    go.wait()
+    for t in threads:
+        t.join(timeout=300)
+    for app in apps:
+        with contextlib.suppress(OSError):
+            app.close()
+
+    ok = all(stream['ok'] for stream in streams)
+    now = time.perf_counter()
+    spans = [(stream['start'] or now, stream['done'] or now) for stream in streams]
+    dt = max(end for _, end in spans) - min(start for start, _ in spans)
+    rates = [(nbytes * 8 / 1e6) / (end - start) if end > start else 0.0
+             for start, end in spans]
+    return {'ok': ok, 'streams': nstreams, 'bytes': nbytes * nstreams, 'seconds': dt,
+            'mbit_s': (nbytes * nstreams * 8 / 1e6) / dt if dt > 0 else 0.0,
+            'stream_mbit_s': rates, 'fairness': jain_index(rates)}
 
 
 def workload_latency(entry_port, count=50, msg_size=64, warmup=5):
@@ -667,6 +956,294 @@ def workload_resilience(entry_port, tunnel, drop_after=0.5, observe_s=12.0):
     return {'ok': True, 'freed': state['freed'], 'mechanism': mechanism, 'detect_ms': dt}
 
 
+# --------------------------------------------------------------------------- #
+# Profiling of an InProcessTunnel (--profile)
+# --------------------------------------------------------------------------- #
+
+class RelayProfiler:
+    """Profiles the threads fteproxy starts while it is installed, that is the
+    threads of its listeners, relays, connectors and codecs, but not those of
+    the benchmark's own workloads, shaper or destination.
+
+    Two profiles are kept:
+
+      * cProfile stats, in CPU time of each thread. Up to Python 3.11 cProfile
+        only sees the thread that enables it, so each thread gets a profiler
+        of its own, and their stats are merged. From Python 3.12 one profiler
+        sees every thread, in wall-clock time, including the benchmark's.
+      * Collapsed stacks, for flamegraph.pl or speedscope: the stack of each
+        thread is sampled every `interval` seconds, weighted by the CPU time
+        the thread used since its last sample.
+    """
+
+    def __init__(self, interval=0.002):
+        import cProfile
+
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._profilers = []
+        self._threads = {}      # ident -> (thread, its CPU clock id or None)
+        self._stacks = {}       # collapsed stack -> weight
+        self._running = False
+        self._wrapper_code = None
+        self._shared = None
+        if sys.version_info >= (3, 12):
+            self._shared = cProfile.Profile()
+
+    def install(self):
+        start = self._start = threading.Thread.start
+        profiler = self
+
+        def profiled_start(thread):
+            # fteproxy's threads, and the threads they start in turn, like
+            # those of the listeners' connector executors.
+            target = getattr(thread, '_target', None) or type(thread).run
+            if (getattr(target, '__module__', '').startswith('fteproxy')
+                    or threading.get_ident() in profiler._threads):
+                thread.run = profiler._profiled(thread, thread.run)
+            return start(thread)
+
+        threading.Thread.start = profiled_start
+        if self._shared is not None:
+            self._shared.enable()
+        self._running = True
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        return self
+
+    def _profiled(self, thread, run):
+        import cProfile
+
+        def profiled_run():
+            clock = None
+            with contextlib.suppress(AttributeError, OSError):
+                clock = time.pthread_getcpuclockid(thread.ident)
+            own = None
+            if self._shared is None:
+                own = cProfile.Profile(time.thread_time_ns, 1e-9)
+            with self._lock:
+                self._threads[thread.ident] = (thread, clock)
+                if own is not None:
+                    self._profilers.append((thread, own))
+            try:
+                if own is None:
+                    return run()
+                own.enable()
+                try:
+                    return run()
+                finally:
+                    own.disable()
+            finally:
+                with self._lock:
+                    del self._threads[thread.ident]
+        self._wrapper_code = profiled_run.__code__
+        return profiled_run
+
+    def uninstall(self, timeout=5.0):
+        """Stop profiling threads that start from now on, and wait up to
+        timeout seconds for those profiled to finish."""
+        threading.Thread.start = self._start
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            threads = [thread for thread, _ in self._threads.values()]
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        if self._shared is not None:
+            self._shared.disable()
+        self._running = False
+        self._sampler.join(timeout=5)
+
+    def _sample(self):
+        last = {}
+        while self._running:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                threads = list(self._threads.items())
+            for ident, (thread, clock) in threads:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                weight = 1
+                if clock is not None:
+                    try:
+                        now = time.clock_gettime_ns(clock)
+                    except OSError:  # the thread is gone
+                        continue
+                    weight, last[ident] = now - last.get(ident, now), now
+                    if weight <= 0:
+                        continue
+                stack = []
+                while frame is not None and frame.f_code is not self._wrapper_code:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:"
+                                 f"{getattr(code, 'co_qualname', code.co_name)}")
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                self._stacks[key] = self._stacks.get(key, 0) + weight
+
+    def stats(self):
+        """The merged cProfile stats, as a pstats.Stats, or None. Threads
+        still running are left out: their calls in progress would be timed
+        with the clock of the thread that asks."""
+        import pstats
+
+        if self._shared is not None:
+            profilers = [self._shared]
+        else:
+            with self._lock:
+                profilers = [own for thread, own in self._profilers if not thread.is_alive()]
+        stats = None
+        for profiler in profilers:
+            with contextlib.suppress(TypeError):  # a thread that profiled nothing
+                if stats is None:
+                    stats = pstats.Stats(profiler)
+                else:
+                    stats.add(profiler)
+        return stats
+
+    def write(self, prefix):
+        """Write PREFIX.prof (cProfile stats, for pstats or snakeviz) and
+        PREFIX.folded (collapsed stacks). Returns the stats."""
+        stats = self.stats()
+        if stats is not None:
+            stats.dump_stats(prefix + '.prof')
+        with open(prefix + '.folded', 'w') as fh:
+            for stack, weight in sorted(self._stacks.items()):
+                fh.write(f"{stack} {weight}\n")
+        return stats
+
+
+PROFILE_CATEGORIES = ['socket I/O', 'record layer', 'fte encode/decode', 'negotiation',
+                      'Python overhead']
+
+
+def profile_summary(stats):
+    """Split the time of pstats.Stats stats across PROFILE_CATEGORIES, by
+    each function's own time (tottime):
+
+      * fteproxy's negotiation code and fteproxy.classifier are negotiation,
+        fteproxy.record_layer, fteproxy.codec_pool and fteproxy.engines the
+        record layer, the fte package fte encode/decode, and socket, select
+        and selectors calls socket I/O. The rest of fteproxy, and this
+        benchmark, are Python overhead.
+      * Any other function, like a builtin or the crypto library fte uses,
+        takes the categories of its callers, in proportion to its time when
+        called by each.
+      * The time of fte is then split between negotiation and fte
+        encode/decode, in proportion to the time of the calls made into fte
+        by negotiation and by everything else.
+
+    Returns {category: seconds}."""
+    import fte
+    import fteproxy
+    import fteproxy.classifier
+
+    fte_dir = os.path.dirname(fte.__file__) + os.sep
+    fteproxy_dir = os.path.dirname(fteproxy.__file__) + os.sep
+    negotiation = set()
+    for cls in (fteproxy.NegotiateCell, fteproxy.NegotiationManager):
+        for fn in vars(cls).values():
+            if hasattr(fn, '__code__'):
+                negotiation.add(_code_key(fn.__code__))
+    for fn in (fteproxy._FTESocketWrapper.negotiate, fteproxy._rememberLanguage):
+        negotiation.add(_code_key(fn.__code__))
+
+    def own_category(func):
+        filename, _, name = func
+        if filename == '~':
+            if '_socket.socket' in name or 'select' in name or 'poll' in name:
+                return 'socket I/O'
+            return None
+        if func in negotiation or filename == fteproxy.classifier.__file__:
+            return 'negotiation'
+        if filename.startswith(fte_dir):
+            return 'fte encode/decode'
+        base = os.path.basename(filename)
+        if filename.startswith(fteproxy_dir):
+            if base in ('record_layer.py', 'codec_pool.py', 'engines.py'):
+                return 'record layer'
+            if base == 'network_io.py':
+                return 'socket I/O'
+            return 'Python overhead'
+        if base in ('socket.py', 'selectors.py'):
+            return 'socket I/O'
+        if filename == os.path.abspath(__file__):
+            return 'Python overhead'
+        return None
+
+    resolved = {}
+
+    def categories(func, visiting=()):
+        # {category: share} of the own time of func
+        if func in resolved:
+            return resolved[func]
+        own = own_category(func)
+        if own is not None:
+            resolved[func] = {own: 1.0}
+            return resolved[func]
+        shares = {}
+        callers = stats.stats[func][4] if func in stats.stats else {}
+        total = sum(edge[2] for edge in callers.values())
+        for caller, edge in callers.items():
+            if caller in visiting or not total:
+                continue
+            for cat, share in categories(caller, visiting + (func,)).items():
+                shares[cat] = shares.get(cat, 0.0) + share * edge[2] / total
+        if not shares:
+            shares = {'Python overhead': 1.0}
+        resolved[func] = shares
+        return shares
+
+    totals = dict.fromkeys(PROFILE_CATEGORIES, 0.0)
+    into_fte = {'negotiation': 0.0, 'other': 0.0}
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for cat, share in categories(func).items():
+            totals[cat] += tt * share
+        if own_category(func) == 'fte encode/decode':
+            for caller, edge in callers.items():
+                caller_category = own_category(caller)
+                if caller_category == 'negotiation':
+                    into_fte['negotiation'] += edge[3]
+                elif caller_category != 'fte encode/decode':
+                    into_fte['other'] += edge[3]
+
+    entered = into_fte['negotiation'] + into_fte['other']
+    if entered:
+        moved = totals['fte encode/decode'] * into_fte['negotiation'] / entered
+        totals['fte encode/decode'] -= moved
+        totals['negotiation'] += moved
+    return totals
+
+
+def _code_key(code):
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+def finish_profile(profiler, directory, name):
+    """Stop profiler, write its profiles to DIRECTORY/NAME.prof and .folded,
+    and print and return the split of its time."""
+    profiler.uninstall()
+    os.makedirs(directory, exist_ok=True)
+    prefix = os.path.join(directory, name)
+    stats = profiler.write(prefix)
+    totals = (profile_summary(stats) if stats is not None
+              else dict.fromkeys(PROFILE_CATEGORIES, 0.0))
+    print_profile_summary('fteproxy', totals)
+    print(f"      wrote {prefix}.prof and {prefix}.folded")
+    return totals
+
+
+def print_profile_summary(label, totals):
+    total = sum(totals.values())
+    if not total:
+        print(f"  [{label}] profile: nothing recorded")
+        return
+    print(f"  [{label}] profile, {total:.2f} s of relay CPU:")
+    for name in PROFILE_CATEGORIES:
+        print(f"      {name:<18} {totals[name]:7.2f} s  {100 * totals[name] / total:5.1f}%")
+
+
 # --------------------------------------------------------------------------- #
 # Scenarios (named network conditions)
 # --------------------------------------------------------------------------- #
@@ -685,12 +1262,112 @@ SCENARIOS = {
 
 DEFAULT_SCENARIOS = ['lan', 'broadband', 'dsl', '3g', 'edge', 'satellite']
 DEFAULT_SIZES = [64, 64 * 1024, 1024 * 1024]
+DEFAULT_STREAMS = [1, 2, 4, 8, 16, 32]
 
 
 # --------------------------------------------------------------------------- #
 # Runner
 # --------------------------------------------------------------------------- #
 
+def workload_codec_scaling(nbytes, pool_sizes, language='manual-http-request', repeat=3):
+    """Encode and decode nbytes through fteproxy's record layer in this process,
+    once without a codec pool and once per pool size in pool_sizes, and report
+    the throughput of each relative to no pool. This isolates the FTE cell
+    codec, the work a --codec-pool spreads across cores, from the network."""
+    import fte
+    import fteproxy.conf
+    import fteproxy.defs
+    import fteproxy.codec_pool
+    import fteproxy.record_layer
+
+    regex = fteproxy.defs.getRegex(language)
+    fixed_slice = fteproxy.defs.getFixedSlice(language)
+    key = fteproxy.conf.getValue('runtime.fteproxy.encrypter.key')
+    payload = os.urandom(nbytes)
+
+    def one_pass(codec):
+        encoder = fteproxy.record_layer.Encoder(fte.Encoder(regex, fixed_slice, key), codec)
+        decoder = fteproxy.record_layer.Decoder(fte.Encoder(regex, fixed_slice, key), codec)
+        t0 = time.perf_counter()
+        encoder.push(payload)
+        covertext = encoder.pop()
+        t1 = time.perf_counter()
+        decoder.push(covertext)
+        ok = decoder.pop() == payload
+        t2 = time.perf_counter()
+        return {'ok': ok, 'encode_s': t1 - t0, 'decode_s': t2 - t1}
+
+    results = []
+    for workers in [0] + [n for n in pool_sizes if n > 0]:
+        codec = None
+        if workers:
+            fteproxy.conf.setValue('runtime.fteproxy.record_layer.codec_pool.workers', workers)
+            codec = fteproxy.codec_pool.codec(regex, fixed_slice, key)
+            one_pass(codec)  # start the pool and build its tables untimed
+        best = min((one_pass(codec) for _ in range(repeat)),
+                   key=lambda r: r['encode_s'] + r['decode_s'])
+        fteproxy.codec_pool.shutdown()
+        seconds = best['encode_s'] + best['decode_s']
+        results.append(dict(best, workers=workers, bytes=nbytes, seconds=seconds,
+                            mbit_s=(nbytes * 8 / 1e6) / seconds))
+
+    for r in results:
+        r['speedup'] = results[0]['seconds'] / r['seconds']
+    fteproxy.conf.setValue('runtime.fteproxy.record_layer.codec_pool.workers', 0)
+    return results
+
+
+def workload_record_layer_copies(nbytes, recv_size=1 << 16, language='manual-http-request'):
+    """Pass nbytes through fteproxy's record layer in this process the way one
+    tunnel direction does, in recv_size reads: the plaintext is pushed into an
+    Encoder read by read, and the covertext is received into a Decoder read by
+    read (in place where the Decoder supports it, as _FTESocketWrapper.recv
+    does). Reports the record layer's copy/allocation counters, where this
+    fteproxy has them, and the peak memory traced by tracemalloc."""
+    import tracemalloc
+    import fte
+    import fteproxy.conf
+    import fteproxy.defs
+    import fteproxy.record_layer as record_layer
+
+    regex = fteproxy.defs.getRegex(language)
+    fixed_slice = fteproxy.defs.getFixedSlice(language)
+    key = fteproxy.conf.getValue('runtime.fteproxy.encrypter.key')
+    payload = os.urandom(nbytes)
+    encoder = record_layer.Encoder(fte.Encoder(regex, fixed_slice, key))
+    decoder = record_layer.Decoder(fte.Encoder(regex, fixed_slice, key))
+    counters = getattr(record_layer, 'counters', None)
+    if counters is not None:
+        record_layer.reset_counters()
+
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    covertext = []
+    for offset in range(0, nbytes, recv_size):
+        encoder.push(payload[offset:offset + recv_size])
+        covertext.append(encoder.pop())
+    covertext = b''.join(covertext)
+
+    received = []
+    for offset in range(0, len(covertext), recv_size):
+        chunk = covertext[offset:offset + recv_size]
+        if hasattr(decoder, 'reserve'):
+            decoder.reserve(len(chunk))[:] = chunk
+            decoder.commit(len(chunk))
+        else:
+            decoder.push(chunk)
+        received.append(decoder.pop())
+    dt = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {'ok': b''.join(received) == payload, 'bytes': nbytes,
+              'recv_size': recv_size, 'seconds': dt, 'peak_bytes': peak}
+    if counters is not None:
+        result.update(counters)
+    return result
+
+
 def fmt_size(n):
     if n < 1024:
         return f"{n}B"
@@ -705,7 +1382,7 @@ def run_matrix(args):
     scenarios = args.scenarios
     sizes = args.sizes
 
-    tunnel_types = [('fteproxy', FteProxyTunnel)]
+    tunnel_types = [('fteproxy', InProcessTunnel if args.in_process else FteProxyTunnel)]
     if args.baseline:
         tunnel_types.append(('plain-tcp', PlainTunnel))
 
@@ -720,6 +1397,8 @@ def run_matrix(args):
     print(f"  scenarios   : {', '.join(scenarios)}")
     print(f"  sizes       : {', '.join(fmt_size(s) for s in sizes)}")
     print(f"  direction   : {args.direction}")
+    if args.engine:
+        print(f"  engine      : {args.engine}")
     print("=" * 78)
 
     for scen_name in scenarios:
@@ -734,13 +1413,27 @@ def run_matrix(args):
                 tunnel = TunnelCls(dest.port, shaper_kwargs=shaper_kwargs,
                                    upstream_format=args.upstream_format,
                                    downstream_format=args.downstream_format,
-                                   verbose=args.verbose)
+                                   verbose=args.verbose,
+                                   codec_pool=args.codec_pool,
+                                   pipeline_depth=args.pipeline_depth,
+                                   adaptive_cells=args.adaptive_cells,
+                                   coalesce_window=args.coalesce_window,
+                                   upstream_pool=args.upstream_pool,
+                                   mux=args.mux,
+                                   workers=args.workers,
+                                   relay_backend=args.relay_backend,
+                                   engine=args.engine)
             except TypeError:
                 tunnel = TunnelCls(dest.port, shaper_kwargs=shaper_kwargs)
+            profiler = None
+            if args.profile and tun_label == 'fteproxy':
+                profiler = RelayProfiler().install()
             try:
                 tunnel.start()
             except Exception as e:
                 print(f"  [{tun_label}] FAILED to start: {e}")
+                if profiler is not None:
+                    profiler.uninstall()
                 dest.stop()
                 continue
 
@@ -774,15 +1467,18 @@ def run_matrix(args):
                     best = None
                     for _ in range(args.repeat):
                         r = workload_throughput(tunnel.entry_port, size,
-                                                direction=args.direction)
+                                                direction=args.direction,
+                                                send_chunk=args.send_chunk)
                         if not r['ok']:
                             best = r
                             break
                         if best is None or r['mbit_s'] > best['mbit_s']:
                             best = r
                     tag = 'OK' if best['ok'] else 'FAIL'
+                    first = (f"  first byte {best['first_byte_ms']:7.1f} ms"
+                             if 'first_byte_ms' in best else '')
                     print(f"  [{tun_label}] xfer {fmt_size(size):>5} {args.direction:6}: "
-                          f"{best['mbit_s']:8.2f} Mbit/s  ({best['seconds']*1000:8.1f} ms)  {tag}")
+                          f"{best['mbit_s']:8.2f} Mbit/s  ({best['seconds']*1000:8.1f} ms){first}  {tag}")
                     results.append(dict(scenario=scen_name, tunnel=tun_label,
                                         metric='throughput', size=size,
                                         direction=args.direction, **best))
@@ -798,6 +1494,113 @@ def run_matrix(args):
             finally:
                 tunnel.stop()
                 dest.stop()
+                if profiler is not None:
+                    totals = finish_profile(profiler, args.profile, scen_name)
+                    results.append(dict(scenario=scen_name, tunnel=tun_label,
+                                        metric='profile', seconds=totals))
+                time.sleep(0.2)
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(results, fh, indent=2)
+        print(f"\nWrote {len(results)} records to {args.json}")
+
+    return results
+
+
+def run_streams(args):
+    counts = args.streams or DEFAULT_STREAMS
+
+    print("=" * 78)
+    print("fteproxy concurrent streams")
+    print(f"  cpus        : {os.cpu_count()}")
+    print(f"  scenarios   : {', '.join(args.scenarios)}")
+    print(f"  streams     : {', '.join(str(n) for n in counts)}")
+    print(f"  per stream  : {fmt_size(args.stream_size)} {args.direction}")
+    if args.workers > 1:
+        print(f"  workers     : {args.workers}")
+    if args.engine:
+        print(f"  engine      : {args.engine}")
+    print("=" * 78)
+
+    results = []
+    for scen_name in args.scenarios:
+        scen = SCENARIOS[scen_name]
+        print(f"\n### scenario: {scen_name}  --  {scen['desc']}")
+        for tun_label, TunnelCls in [('fteproxy', InProcessTunnel if args.in_process else FteProxyTunnel),
+                                     ('plain-tcp', PlainTunnel)]:
+            dest = LoopServer(free_port(), mode='echo' if args.direction == 'echo' else 'sink')
+            dest.start()
+            tunnel = TunnelCls(dest.port, shaper_kwargs=scen['shaper'],
+                               upstream_format=args.upstream_format,
+                               downstream_format=args.downstream_format,
+                               verbose=args.verbose,
+                               codec_pool=args.codec_pool,
+                               pipeline_depth=args.pipeline_depth,
+                               adaptive_cells=args.adaptive_cells,
+                               coalesce_window=args.coalesce_window,
+                               upstream_pool=args.upstream_pool,
+                               mux=args.mux,
+                               workers=args.workers,
+                               relay_backend=args.relay_backend,
+                               engine=args.engine)
+            profiler = None
+            if args.profile and tun_label == 'fteproxy':
+                profiler = RelayProfiler().install()
+            try:
+                tunnel.start()
+            except Exception as e:
+                print(f"  [{tun_label}] FAILED to start: {e}")
+                if profiler is not None:
+                    profiler.uninstall()
+                dest.stop()
+                continue
+
+            # The fteproxy client and server are processes of their own; the
+            # plain-TCP relays are threads of this one, so their CPU time is
+            # only seen in this process's, along with the transfers'.
+            pids = [p.pid for p in getattr(tunnel, 'procs', [])]
+            try:
+                single = None
+                for nstreams in counts:
+                    best = None
+                    for _ in range(args.repeat):
+                        tunnel_cpu = process_cpu_seconds(pids) if pids else None
+                        own_cpu = time.process_time()
+                        r = workload_streams(tunnel.entry_port, nstreams, args.stream_size,
+                                             direction=args.direction,
+                                             send_chunk=args.send_chunk)
+                        r['bench_cpu_s'] = time.process_time() - own_cpu
+                        if tunnel_cpu is not None:
+                            after = process_cpu_seconds(pids)
+                            r['tunnel_cpu_s'] = after - tunnel_cpu if after is not None else None
+                        if not r['ok']:
+                            best = r
+                            break
+                        if best is None or r['mbit_s'] > best['mbit_s']:
+                            best = r
+                    if single is None and best['ok']:
+                        single = best
+                    tag = 'OK' if best['ok'] else 'FAIL'
+                    cpu = f"bench cpu {best['bench_cpu_s']:6.2f} s"
+                    if best.get('tunnel_cpu_s') is not None:
+                        cpu = (f"tunnel cpu {best['tunnel_cpu_s']:6.2f} s "
+                               f"({100 * best['tunnel_cpu_s'] / best['seconds']:4.0f}% of a core)  "
+                               + cpu)
+                    scaling = f"x{best['mbit_s'] / single['mbit_s']:5.2f}" if single else ''
+                    print(f"  [{tun_label}] {nstreams:>3} streams: {best['mbit_s']:8.2f} Mbit/s {scaling}  "
+                          f"fairness {best['fairness']:.3f}  "
+                          f"per stream {min(best['stream_mbit_s']):7.2f}-{max(best['stream_mbit_s']):7.2f}  "
+                          f"{cpu}  {tag}")
+                    results.append(dict(scenario=scen_name, tunnel=tun_label, metric='streams',
+                                        direction=args.direction, **best))
+            finally:
+                tunnel.stop()
+                dest.stop()
+                if profiler is not None:
+                    totals = finish_profile(profiler, args.profile, 'streams-' + scen_name)
+                    results.append(dict(scenario=scen_name, tunnel=tun_label,
+                                        metric='profile', seconds=totals))
                 time.sleep(0.2)
 
     if args.json:
@@ -808,6 +1611,68 @@ def run_matrix(args):
     return results
 
 
+def run_codec_scaling(args):
+    pool_sizes = args.codec_scaling
+    if not pool_sizes:
+        pool_sizes, n = [], 1
+        while n < (os.cpu_count() or 1):
+            pool_sizes.append(n)
+            n *= 2
+        pool_sizes.append(os.cpu_count() or 1)
+
+    print("=" * 78)
+    print("fteproxy record-layer codec scaling")
+    print(f"  cpus        : {os.cpu_count()}")
+    print(f"  pool sizes  : {', '.join(str(n) for n in pool_sizes)}")
+    print("=" * 78)
+
+    results = []
+    for size in args.sizes:
+        for r in workload_codec_scaling(size, pool_sizes,
+                                        language=args.upstream_format or 'manual-http-request',
+                                        repeat=args.repeat):
+            label = 'no pool' if not r['workers'] else f"pool {r['workers']:>3}"
+            tag = 'OK' if r['ok'] else 'FAIL'
+            print(f"  [{label}] codec {fmt_size(size):>5}: {r['mbit_s']:8.2f} Mbit/s  "
+                  f"(enc {r['encode_s']*1000:7.1f} ms  dec {r['decode_s']*1000:7.1f} ms)  "
+                  f"x{r['speedup']:.2f}  {tag}")
+            results.append(dict(metric='codec_scaling', **r))
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(results, fh, indent=2)
+        print(f"\nWrote {len(results)} records to {args.json}")
+
+    return results
+
+
+def run_record_layer_copies(args):
+    print("=" * 78)
+    print("fteproxy record-layer copies")
+    print(f"  recv size   : {fmt_size(args.recv_size)}")
+    print("=" * 78)
+
+    results = []
+    for size in args.sizes:
+        r = workload_record_layer_copies(size, recv_size=args.recv_size)
+        tag = 'OK' if r['ok'] else 'FAIL'
+        if 'bytes_copied' in r:
+            copies = (f"copied {r['bytes_copied'] / size:5.2f}x payload in "
+                      f"{r['copies']} copies, {r['allocations']} allocations")
+        else:
+            copies = "copies not counted by this fteproxy"
+        print(f"  [record layer] {fmt_size(size):>5}: {r['seconds']*1000:8.1f} ms  "
+              f"peak {fmt_size(r['peak_bytes']):>6}  {copies}  {tag}")
+        results.append(dict(metric='record_layer_copies', **r))
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(results, fh, indent=2)
+        print(f"\nWrote {len(results)} records to {args.json}")
+
+    return results
+
+
 NETEM_HELP = """
 Real kernel-level loss / reordering / duplication
 ==================================================
@@ -835,7 +1700,8 @@ def main():
         description="Performance & resilience benchmark for fteproxy.",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     ap.add_argument('--scenarios', nargs='+', default=DEFAULT_SCENARIOS,
-                    metavar='NAME', help=f"any of: {', '.join(SCENARIOS)}")
+                    metavar='NAME', help=f"any of: {', '.join(SCENARIOS)} "
+                                         "(just lan by default with --streams)")
     ap.add_argument('--sizes', nargs='+', type=_parse_size, default=DEFAULT_SIZES,
                     metavar='SIZE', help="payload sizes, e.g. 64 64K 1M 8M")
     ap.add_argument('--direction', choices=['echo', 'upload'], default='echo',
@@ -856,6 +1722,50 @@ def main():
     ap.add_argument('--upstream-format', default=None,
                     help="fteproxy --upstream-format (e.g. manual-http-request)")
     ap.add_argument('--downstream-format', default=None)
+    ap.add_argument('--codec-pool', type=int, default=0, metavar='N',
+                    help="fteproxy --codec-pool for the tunnel under test")
+    ap.add_argument('--pipeline-depth', type=int, default=0, metavar='N',
+                    help="fteproxy --pipeline-depth for the tunnel under test")
+    ap.add_argument('--adaptive-cells', action='store_true',
+                    help="run the tunnel under test with fteproxy --adaptive-cells")
+    ap.add_argument('--coalesce-window', type=float, default=0, metavar='SECONDS',
+                    help="fteproxy --coalesce-window for the tunnel under test")
+    ap.add_argument('--upstream-pool', type=int, default=0, metavar='N',
+                    help="fteproxy --upstream-pool for the server under test")
+    ap.add_argument('--mux', action='store_true',
+                    help="run the tunnel under test with fteproxy --mux")
+    ap.add_argument('--in-process', action='store_true',
+                    help="run the fteproxy client and server as threads of this "
+                         "process instead of as subprocesses")
+    ap.add_argument('--profile', default=None, metavar='DIR',
+                    help="with --in-process, profile the relay through each scenario, "
+                         "write DIR/SCENARIO.prof (cProfile) and DIR/SCENARIO.folded "
+                         "(collapsed stacks, for flamegraph.pl), and print where its "
+                         "time went")
+    ap.add_argument('--workers', type=int, default=1, metavar='N',
+                    help="fteproxy --workers for the tunnel under test")
+    ap.add_argument('--relay-backend', choices=['threads', 'selectors'], default=None,
+                    help="fteproxy --relay-backend for the tunnel under test")
+    ap.add_argument('--engine', choices=['fte', 'identity'], default=None,
+                    help="fteproxy --engine for the tunnel under test; identity "
+                         "only frames cells, which measures the relay without FTE")
+    ap.add_argument('--send-chunk', type=_parse_size, default=1 << 16, metavar='SIZE',
+                    help="size of the application's writes in the throughput "
+                         "transfers; small writes model a chatty protocol")
+    ap.add_argument('--streams', nargs='*', type=int, default=None, metavar='N',
+                    help="only measure the aggregate throughput and fairness of N "
+                         "concurrent transfers through one tunnel, for each N, "
+                         "against the plain-TCP baseline too "
+                         f"(default: {' '.join(str(n) for n in DEFAULT_STREAMS)})")
+    ap.add_argument('--stream-size', type=_parse_size, default=1 << 20, metavar='SIZE',
+                    help="bytes each of the --streams transfers")
+    ap.add_argument('--codec-scaling', nargs='*', type=int, default=None, metavar='N',
+                    help="only measure record-layer encode+decode speedup with "
+                         "these codec pool sizes (default: 1 2 4 ... up to the CPU count)")
+    ap.add_argument('--record-layer-copies', action='store_true',
+                    help="only measure the copies the record layer makes per payload")
+    ap.add_argument('--recv-size', type=_parse_size, default=1 << 16, metavar='SIZE',
+                    help="read size for --record-layer-copies")
     ap.add_argument('--json', default=None, metavar='PATH',
                     help="write raw results as JSON")
     ap.add_argument('--verbose', action='store_true',
@@ -868,6 +1778,13 @@ def main():
         print(NETEM_HELP)
         return
 
+    if args.profile and not args.in_process:
+        ap.error("--profile requires --in-process")
+    if args.in_process and args.workers > 1:
+        ap.error("--workers does not apply to --in-process")
+
+    if args.streams is not None and args.scenarios is DEFAULT_SCENARIOS:
+        args.scenarios = ['lan']
     for s in args.scenarios:
         if s not in SCENARIOS:
             ap.error(f"unknown scenario {s!r}; choose from {', '.join(SCENARIOS)}")
@@ -879,6 +1796,25 @@ def main():
         print("Install it into this interpreter, e.g.:  pip install -e .  (needs `fte`)")
         sys.exit(2)
 
+    if args.in_process and not args.verbose:
+        # As the subprocesses' output is discarded without --verbose.
+        import fteproxy.conf
+        fteproxy.conf.setValue('runtime.loglevel', 0)
+
+    if args.streams is not None:
+        if any(n < 1 for n in args.streams):
+            ap.error("--streams counts must be at least 1")
+        run_streams(args)
+        return
+
+    if args.codec_scaling is not None:
+        run_codec_scaling(args)
+        return
+
+    if args.record_layer_copies:
+        run_record_layer_copies(args)
+        return
+
     run_matrix(args)
 
 
@@ -4,14 +4,20 @@
 __version__ = "0.3.1"
 
 import sys
+import queue
+import collections
 import socket
+import time
+import threading
 import traceback
 
 import fteproxy.conf
+import fteproxy.log
 import fteproxy.defs
 import fteproxy.record_layer
-
-import fte
+import fteproxy.codec_pool
+import fteproxy.engines
+import fteproxy.buffers
 
 
 class InvalidRoleException(Exception):
@@ -33,20 +39,19 @@ class NegotiateTimeoutException(Exception):
     pass
 
 
-def fatal_error(msg):
-    if fteproxy.conf.getValue('runtime.loglevel') in [1,2,3]:
-        print('ERROR:', msg)
+def fatal_error(msg, *args):
+    fteproxy.log.error(msg, args)
     sys.exit(1)
 
 
-def warn(msg):
-    if fteproxy.conf.getValue('runtime.loglevel') in [2,3]:
-        print('WARN:', msg)
+def warn(msg, *args):
+    if fteproxy.conf.getValue('runtime.loglevel') >= fteproxy.log.WARN:
+        fteproxy.log.log(fteproxy.log.WARN, msg, args)
 
 
-def info(msg):
-    if fteproxy.conf.getValue('runtime.loglevel') in [3]:
-        print('INFO:', msg)
+def info(msg, *args):
+    if fteproxy.conf.getValue('runtime.loglevel') >= fteproxy.log.INFO:
+        fteproxy.log.log(fteproxy.log.INFO, msg, args)
 
 
 class NegotiateCell(object):
@@ -54,10 +59,15 @@ class NegotiateCell(object):
     _PADDING_LEN = 32
     _PADDING_CHAR = b'\x00'
     _DATE_FORMAT = b'YYYYMMDD'
+    # Flags are carried in the first byte of the padding, which is zero for
+    # clients that set none. Servers that predate a flag reject cells that
+    # carry it, rather than misreading the connection.
+    _FLAG_MUX = 0x01
 
     def __init__(self):
         self._def_file = b""
         self._language = b""
+        self._mux = False
 
     def setDefFile(self, def_file):
         if isinstance(def_file, str):
@@ -79,6 +89,12 @@ class NegotiateCell(object):
             return self._language.decode('utf-8')
         return self._language
 
+    def setMux(self, mux):
+        self._mux = mux
+
+    def getMux(self):
+        return self._mux
+
     def toBytes(self):
         retval = b''
         retval += self._def_file
@@ -86,13 +102,17 @@ class NegotiateCell(object):
         retval = retval.rjust(NegotiateCell._CELL_SIZE, NegotiateCell._PADDING_CHAR)
         assert retval[:NegotiateCell._PADDING_LEN] == NegotiateCell._PADDING_CHAR * \
             NegotiateCell._PADDING_LEN
+        if self._mux:
+            retval = bytes([NegotiateCell._FLAG_MUX]) + retval[1:]
         return retval
 
     def fromBytes(self, negotiate_cell_bytes):
         assert len(negotiate_cell_bytes) == NegotiateCell._CELL_SIZE
+        flags = negotiate_cell_bytes[0]
+        assert flags & ~NegotiateCell._FLAG_MUX == 0
         assert negotiate_cell_bytes[
-            :NegotiateCell._PADDING_LEN] == NegotiateCell._PADDING_CHAR * NegotiateCell._PADDING_LEN
-        negotiate_cell_bytes = negotiate_cell_bytes.strip(
+            1:NegotiateCell._PADDING_LEN] == NegotiateCell._PADDING_CHAR * (NegotiateCell._PADDING_LEN - 1)
+        negotiate_cell_bytes = negotiate_cell_bytes[1:].strip(
             NegotiateCell._PADDING_CHAR)
         # 8==len(YYYYMMDD)
         def_file = negotiate_cell_bytes[:len(NegotiateCell._DATE_FORMAT)]
@@ -100,53 +120,93 @@ class NegotiateCell(object):
         negotiate_cell = NegotiateCell()
         negotiate_cell.setDefFile(def_file)
         negotiate_cell.setLanguage(language)
+        negotiate_cell.setMux(bool(flags & NegotiateCell._FLAG_MUX))
         return negotiate_cell
 
 
+# Request languages that clients negotiated recently, most recent last, which
+# servers try right after their own.
+_recent_languages = collections.OrderedDict()
+_recent_languages_lock = threading.Lock()
+_RECENT_LANGUAGES = 8
+
+
+def _rememberLanguage(language):
+    with _recent_languages_lock:
+        _recent_languages[language] = None
+        _recent_languages.move_to_end(language)
+        while len(_recent_languages) > _RECENT_LANGUAGES:
+            _recent_languages.popitem(last=False)
+
+
 class NegotiationManager(object):
 
-    def __init__(self, K1, K2):
+    def __init__(self, K1, K2, engine=None):
         self._negotiationComplete = False
         self._K1 = K1
         self._K2 = K2
+        self._mux = False
+        self._engine = fteproxy.engines.get(engine)
 
     def getNegotiationComplete(self):
         return self._negotiationComplete
 
+    def getMux(self):
+        """Whether the negotiated connection carries multiplexed streams, as
+        asked for by the client in its negotiation cell."""
+        return self._mux
+
     def _acceptNegotiation(self, data):
 
         languages = fteproxy.defs.load_definitions()
 
-        # Try the configured upstream language first. The server otherwise scans
-        # request-languages in definition order and attempts a decode against
-        # each until one succeeds; the default is near the end of that list, so
-        # every connection pays ~20 failed decodes before matching. A client and
-        # server sharing config (the common case) now match on the first try,
-        # while non-default clients still fall through to the full scan.
+        # Only languages whose words can start with the first bytes are tried:
+        # the configured upstream language first, then the languages that
+        # clients negotiated most recently, then the rest in definition order.
+        # A language is tried by reading the header of the first cell with it,
+        # which costs a rank and a block decryption and fails for cells of any
+        # other format, so only the client's language gets a full decode. The
+        # wire format is unchanged: a format id inside the negotiation cell
+        # would only be readable once the cell was decoded.
         preferred = fteproxy.conf.getValue('runtime.state.upstream_language')
-        scan_order = ([preferred] if preferred in languages else []) + \
-            [lang for lang in languages.keys() if lang != preferred]
+        with _recent_languages_lock:
+            recent = list(reversed(_recent_languages))
+            recent_set = set(recent)
+        scan_order = [preferred] if preferred in languages else []
+        scan_order += [lang for lang in recent
+                       if lang != preferred and lang in languages]
+        scan_order += [lang for lang in languages
+                       if lang != preferred and lang not in recent_set]
 
+        candidates = self._engine.candidates(data)
+
+        key = (self._K1 + self._K2) if self._K1 and self._K2 else None
         for incoming_language in scan_order:
-            try:
-                if incoming_language.endswith('response'):
-                    continue
+            if incoming_language not in candidates:
+                continue
 
-                incoming_regex = fteproxy.defs.getRegex(incoming_language)
-                incoming_fixed_slice = fteproxy.defs.getFixedSlice(
-                    incoming_language)
+            incoming_regex = fteproxy.defs.getRegex(incoming_language)
+            incoming_fixed_slice = fteproxy.defs.getFixedSlice(
+                incoming_language)
+            incoming_decoder = self._engine.get_encoder(
+                incoming_regex, incoming_fixed_slice, key)
 
-                key = (self._K1 + self._K2) if self._K1 and self._K2 else None
-                incoming_decoder = fte.Encoder(incoming_regex, incoming_fixed_slice, key)
-                decoder = fteproxy.record_layer.Decoder(decoder=incoming_decoder)
+            length = self._engine.cell_length(incoming_decoder, data)
+            if length is None or length > len(data):
+                continue
 
-                decoder.push(data)
-                negotiate_cell = decoder.pop(oneCell=True)
+            # Decode the cell with the engine directly: a cell that fails to
+            # decrypt is a failed negotiation, not the fatal error it is mid-stream.
+            try:
+                [negotiate_cell, _] = incoming_decoder.decode(data[:length])
                 NegotiateCell().fromBytes(negotiate_cell)
-
-                return [negotiate_cell, decoder._buffer]
             except Exception as e:
-                fteproxy.info('Failed to decode first message as '+incoming_language+': '+str(e))
+                fteproxy.info('Failed to decode first message as %s: %s', incoming_language, e)
+                continue
+
+            if incoming_language != preferred:
+                _rememberLanguage(incoming_language)
+            return [negotiate_cell, data[length:]]
 
         raise NegotiationFailedException()
 
@@ -158,39 +218,62 @@ class NegotiationManager(object):
         decoder = None
 
         key = (self._K1 + self._K2) if self._K1 and self._K2 else None
+        use_codec_pool = fteproxy.conf.getValue(
+            'runtime.fteproxy.record_layer.codec_pool.workers') > 0
 
         if outgoing_regex != None and outgoing_fixed_slice != -1:
-            outgoing_encoder = fte.Encoder(outgoing_regex, outgoing_fixed_slice, key)
-            encoder = fteproxy.record_layer.Encoder(encoder=outgoing_encoder)
+            outgoing_encoder = self._engine.get_encoder(
+                outgoing_regex, outgoing_fixed_slice, key)
+            outgoing_codec = fteproxy.codec_pool.codec(
+                outgoing_regex, outgoing_fixed_slice, key,
+                self._engine.name) if use_codec_pool else None
+            sizer = None
+            if fteproxy.conf.getValue('runtime.fteproxy.record_layer.adaptive_cell_size'):
+                sizer = fteproxy.record_layer.CellSizer(
+                    fteproxy.conf.getValue('runtime.fteproxy.record_layer.min_cell_size'),
+                    fteproxy.conf.getValue('runtime.fteproxy.record_layer.max_cell_size'),
+                    fteproxy.conf.getValue('runtime.fteproxy.record_layer.target_latency'))
+            encoder = fteproxy.record_layer.Encoder(encoder=outgoing_encoder,
+                                                    codec=outgoing_codec,
+                                                    sizer=sizer)
 
         if incoming_regex != None and incoming_fixed_slice != -1:
-            incoming_decoder = fte.Encoder(incoming_regex, incoming_fixed_slice, key)
-            decoder = fteproxy.record_layer.Decoder(decoder=incoming_decoder)
+            incoming_decoder = self._engine.get_encoder(
+                incoming_regex, incoming_fixed_slice, key)
+            incoming_codec = fteproxy.codec_pool.codec(
+                incoming_regex, incoming_fixed_slice, key,
+                self._engine.name) if use_codec_pool else None
+            decoder = fteproxy.record_layer.Decoder(decoder=incoming_decoder,
+                                                    codec=incoming_codec,
+                                                    engine=self._engine)
 
         return [encoder, decoder]
 
-    def _makeNegotiationCell(self, encoder):
+    def _makeNegotiationCell(self, encoder, language, mux=False):
         negotiate_cell = NegotiateCell()
         def_file = fteproxy.conf.getValue('fteproxy.defs.release')
         negotiate_cell.setDefFile(def_file)
-        language = fteproxy.conf.getValue('runtime.state.upstream_language')
         language = language[:-len('-request')]
         negotiate_cell.setLanguage(language)
+        negotiate_cell.setMux(mux)
+        self._mux = mux
         encoder.push(negotiate_cell.toBytes())
         data = encoder.pop()
         return data
 
     def makeClientNegotiationCell(self,
                                   outgoing_regex, outgoing_fixed_slice,
-                                  incoming_regex, incoming_fixed_slice):
+                                  incoming_regex, incoming_fixed_slice,
+                                  language, mux=False):
         [encoder, decoder] = self._init_encoders(
             outgoing_regex, outgoing_fixed_slice, incoming_regex, incoming_fixed_slice)
-        return self._makeNegotiationCell(encoder)
+        return self._makeNegotiationCell(encoder, language, mux)
 
     def doServerSideNegotiation(self, data):
         [negotiate_cell, remaining_buffer] = self._acceptNegotiation(data)
 
         negotiate = NegotiateCell().fromBytes(negotiate_cell)
+        self._mux = negotiate.getMux()
 
         outgoing_language = negotiate.getLanguage() + '-response'
         incoming_language = negotiate.getLanguage() + '-request'
@@ -223,8 +306,14 @@ class FTEHelper(object):
                 self._negotiationComplete = True
                 retval = b''
             except Exception as e:
+                self._buffers.hold('negotiation', len(self._preNegotiationBuffer_incoming))
                 raise ChannelNotReadyException()
 
+            if self._negotiation_manager.getMux() and not self._accept_mux:
+                # Nothing on this side would demultiplex the streams.
+                raise NegotiationFailedException(
+                    'client asked for multiplexing, which is not enabled')
+
         return retval
 
     def _processSend(self):
@@ -239,19 +328,99 @@ class FTEHelper(object):
             self._decoder = decoder
             negotiation_cell = self._negotiation_manager.makeClientNegotiationCell(
                 self._outgoing_regex, self._outgoing_fixed_slice,
-                self._incoming_regex, self._incoming_fixed_slice)
+                self._incoming_regex, self._incoming_fixed_slice,
+                self._language, self._mux)
             retval = negotiation_cell
             self._negotiationComplete = True
         return retval
 
 
+class _SendPipeline(object):
+
+    """``_SendPipeline`` encodes and writes the data sent on an
+    ``_FTESocketWrapper`` on two threads of its own: one encodes cells, the
+    other writes them to the socket. The caller, encoder and writer are linked
+    by queues of at most ``depth`` entries, so that encoding the next cell
+    overlaps with transmitting the previous one, while a slow socket still
+    pushes back on the caller once the queues are full.
+
+    An error in either stage is raised by the next ``send``; data sent after it
+    is discarded.
+    """
+
+    def __init__(self, wrapper, depth):
+        self._wrapper = wrapper
+        self._plaintexts = queue.Queue(depth)
+        self._covertexts = queue.Queue(depth)
+        self._error = None
+        self._threads = [threading.Thread(target=self._encodeStage),
+                         threading.Thread(target=self._writeStage)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def send(self, prefix, data):
+        """Queue ``data`` to be encoded and written after the covertext
+        ``prefix``.
+        """
+        if self._error is not None:
+            raise self._error
+        self._plaintexts.put((prefix, data))
+
+    def close(self, timeout):
+        """Wait up to ``timeout`` seconds for the queued data to be written.
+        """
+        try:
+            self._plaintexts.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _encodeStage(self):
+        while True:
+            item = self._plaintexts.get()
+            if item is None:
+                self._covertexts.put(None)
+                return
+            if self._error is not None:
+                continue
+
+            prefix, data = item
+            try:
+                encoder = self._wrapper._encoder
+                encoder.push(data)
+                for cell in encoder.iter_cells():
+                    self._covertexts.put(prefix + cell)
+                    prefix = b''
+                if prefix:
+                    self._covertexts.put(prefix)
+            except Exception as e:
+                self._error = e
+
+    def _writeStage(self):
+        while True:
+            covertext = self._covertexts.get()
+            if covertext is None:
+                return
+            if self._error is not None:
+                continue
+
+            try:
+                start = time.perf_counter()
+                self._wrapper._socket.sendall(covertext)
+                self._wrapper._encoder.written(len(covertext), time.perf_counter() - start)
+            except Exception as e:
+                self._error = e
+
+
 class _FTESocketWrapper(FTEHelper, object):
 
     def __init__(self, _socket,
                  outgoing_regex=None, outgoing_fixed_slice=-1,
                  incoming_regex=None, incoming_fixed_slice=-1,
                  K1=None, K2=None,
-                 negotiate=True):
+                 negotiate=True, engine=None, language=None):
 
         self._socket = _socket
         self._outgoing_regex = outgoing_regex
@@ -261,11 +430,28 @@ class _FTESocketWrapper(FTEHelper, object):
         self._K1 = K1
         self._K2 = K2
         self._negotiate = negotiate
-
-        self._negotiation_manager = NegotiationManager(K1, K2)
-        self._incoming_buffer = b''
+        self._language = language
+        self._mux = False
+        self._accept_mux = False
+
+        self._negotiation_manager = NegotiationManager(K1, K2, engine)
+        self._pipeline_depth = fteproxy.conf.getValue('runtime.fteproxy.relay.pipeline_depth')
+        self._pipeline = None
+        # Writes held back by ``cork`` or the coalescing window, when they are
+        # due to be sent, and the thread that sends them then.
+        self._coalesce_window = 0
+        self._coalesce_bytes = 0
+        self._corked = False
+        self._held = []
+        self._held_bytes = 0
+        self._flush_deadline = None
+        self._flusher = None
+        self._flush_error = None
+        self._closed = False
+        self._send_lock = threading.Condition(threading.RLock())
         self._preNegotiationBuffer_outgoing = b''
         self._preNegotiationBuffer_incoming = b''
+        self._buffers = fteproxy.buffers.account()
 
         if negotiate:
             # Standard relay mode: client sends negotiation cell, server waits for it
@@ -292,6 +478,50 @@ class _FTESocketWrapper(FTEHelper, object):
             return self._socket.getsockopt(level, optname)
         return self._socket.getsockopt(level, optname, buflen)
 
+    def negotiate(self, mux=False):
+        """Complete the negotiation now, rather than along with the first
+        ``send`` or ``recv``, and return whether the connection carries
+        multiplexed streams (see ``fteproxy.mux``). A client sends its
+        negotiation cell, asking for multiplexing if ``mux`` is set; a server
+        reads until the client's negotiation cell has arrived, and keeps any
+        data that followed it for ``recv``.
+        """
+        if self._isClient:
+            with self._send_lock:
+                if not self._negotiationComplete:
+                    self._mux = mux
+                    self._socket.sendall(self._processSend())
+            return self._mux
+
+        self._accept_mux = True
+        while not self._negotiationComplete:
+            try:
+                data = self._socket.recv(self._buffers.room(
+                    'negotiation', len(self._preNegotiationBuffer_incoming),
+                    NegotiateCell._CELL_SIZE * 64))
+            except fteproxy.buffers.BufferFull:
+                time.sleep(fteproxy.conf.getValue('runtime.fteproxy.relay.throttle'))
+                continue
+            if not data:
+                raise NegotiationFailedException()
+            try:
+                self._processRecv(data)
+            except ChannelNotReadyException:
+                continue
+        self._holdDecoded()
+        self._mux = self._negotiation_manager.getMux()
+        return self._mux
+
+    def pending(self):
+        """Whether data already read from the socket is waiting to be decoded,
+        so that ``recv`` should be called even though ``select`` does not
+        report the socket readable; e.g. data that arrived along with the
+        negotiation cell read by ``negotiate``.
+        """
+        if not self._negotiationComplete or self._decoder is None:
+            return False
+        return len(self._decoder._buffer) >= max(1, self._decoder._cell_length)
+
     def recv(self, bufsize):
         # <HACK>
         # Required to deal with case when client attempts to recv
@@ -303,24 +533,54 @@ class _FTESocketWrapper(FTEHelper, object):
             assert numbytes == len(to_send)
         # </HACK>
 
+        if self.pending():
+            data = self._decoder.pop()
+            self._holdDecoded()
+            if data:
+                return data
+
         try:
             while True:
-                data = self._socket.recv(bufsize)
-                noData = (data == b'')
-                data = self._processRecv(data)
-
-                if noData and not self._incoming_buffer and not self._decoder._buffer:
+                if self._negotiationComplete:
+                    # Receive straight into the decoder's buffer, so that the
+                    # covertext is only copied once more, into fte.
+                    numbytes = self._buffers.room(
+                        'decoder', len(self._decoder._buffer), bufsize,
+                        self._decoder._buffer.allocated())
+                    if not self._decoder._buffer:
+                        # Nothing pending: read no more than fits the buffer
+                        # as it is, so that a connection idling here does not
+                        # grow it to ``bufsize``.
+                        numbytes = min(numbytes, self._decoder._buffer.capacity)
+                    numbytes = self._socket.recv_into(
+                        self._decoder.reserve(numbytes), numbytes)
+                    self._decoder.commit(numbytes)
+                    noData = (numbytes == 0)
+                else:
+                    data = self._socket.recv(self._buffers.room(
+                        'negotiation', len(self._preNegotiationBuffer_incoming), bufsize))
+                    noData = (data == b'')
+
+                    if noData:
+                        # The peer closed before negotiating; nothing can follow.
+                        return b''
+
+                    # On a server, this negotiates and creates the decoder.
+                    data = self._processRecv(data)
+                    self._decoder.push(data)
+
+                if noData and not self._decoder._buffer:
                     return b''
 
-                self._decoder.push(data)
-
+                fragments = []
                 while True:
                     frag = self._decoder.pop()
                     if not frag:
                         break
-                    self._incoming_buffer += frag
+                    fragments.append(frag)
+                self._holdDecoded()
 
-                if self._incoming_buffer:
+                if fragments:
                     break
 
                 if noData:
@@ -331,25 +591,155 @@ class _FTESocketWrapper(FTEHelper, object):
                     # Report EOF instead of busy-looping on the closed socket.
                     return b''
 
-            retval = self._incoming_buffer
-            self._incoming_buffer = b''
         except ChannelNotReadyException:
             raise socket.timeout
 
-        return retval
+        return b''.join(fragments)
+
+    def _holdDecoded(self):
+        # What the decoder holds after decoding what it could, and the length
+        # of the cell it waits for, against the limits of fteproxy.buffers.
+        self._buffers.hold('decoder', len(self._decoder._buffer),
+                           self._decoder._cell_length,
+                           self._decoder._buffer.allocated())
     
     def send(self, data):
-        to_send = self._processSend()
-        if to_send:
-            self._socket.sendall(to_send)
+        with self._send_lock:
+            if self._flush_error is not None:
+                error, self._flush_error = self._flush_error, None
+                raise error
+            if not self._corked and self._coalesce_window <= 0:
+                self._sendNow(data)
+                return len(data)
+
+            self._held.append(bytes(data))
+            self._held_bytes += len(data)
+            if self._corked:
+                return len(data)
+            if self._held_bytes >= self._coalesce_bytes:
+                self._flushHeld()
+            elif self._flush_deadline is None:
+                self._flush_deadline = time.monotonic() + self._coalesce_window
+                if self._flusher is None:
+                    # One thread for the lifetime of the socket: starting a
+                    # thread per window costs about as much as it saves.
+                    self._flusher = threading.Thread(target=self._flushLoop)
+                    self._flusher.daemon = True
+                    self._flusher.start()
+                self._send_lock.notify()
+        return len(data)
+
+    def set_coalescing(self, window, numbytes):
+        """Hold back data sent on this socket for up to ``window`` seconds, or
+        until ``numbytes`` bytes are held, and send it all at once, so that a
+        run of small writes becomes a single FTE cell instead of one cell
+        each. A ``window`` of 0 sends every write as it comes.
+        """
+        with self._send_lock:
+            self._coalesce_window = window
+            self._coalesce_bytes = numbytes
+            if window <= 0 and not self._corked:
+                self._flushHeld()
+            self._send_lock.notify()
+
+    def cork(self):
+        """Hold back all data sent on this socket until ``uncork``, however
+        much of it there is.
+        """
+        with self._send_lock:
+            self._corked = True
+
+    def uncork(self):
+        """Send the data held back since ``cork``, and stop holding data
+        back other than within the coalescing window.
+        """
+        with self._send_lock:
+            self._corked = False
+            self._flushHeld()
+
+    def flush(self):
+        """Send any data held back by ``cork`` or the coalescing window now.
+        """
+        with self._send_lock:
+            self._flushHeld()
+
+    def _flushHeld(self):
+        self._flush_deadline = None
+        if not self._held:
+            return
+        data = b''.join(self._held)
+        self._held = []
+        self._held_bytes = 0
+        self._sendNow(data)
+
+    def _flushLoop(self):
+        with self._send_lock:
+            while self._coalesce_window > 0:
+                if self._flush_deadline is None or self._corked:
+                    self._send_lock.wait()
+                    continue
+                remaining = self._flush_deadline - time.monotonic()
+                if remaining > 0:
+                    self._send_lock.wait(remaining)
+                    continue
+                try:
+                    self._flushHeld()
+                except Exception as e:
+                    # Raised by the next send instead.
+                    self._flush_error = e
+            self._flusher = None
+
+    def _sendNow(self, data):
+        # Called with ``_send_lock`` held, as is the check in ``close``.
+        if self._closed:
+            raise socket.error('send on a closed socket')
+        if self._pipeline_depth > 0:
+            # The negotiation cell is made here, on the caller's thread, as
+            # ``recv`` may make it too.
+            if self._pipeline is None:
+                self._pipeline = _SendPipeline(self, self._pipeline_depth)
+            self._pipeline.send(self._processSend(), data)
+            return
+
+        # Each cell is written as soon as it is encoded, so that the first one
+        # goes out while the rest are still being encoded.
+        prefix = self._processSend()
+        self._encoder.push(data)
+        numbytes = 0
+        seconds = 0
+        for cell in self._encoder.iter_cells():
+            if prefix:
+                cell, prefix = prefix + cell, b''
+            start = time.perf_counter()
+            self._socket.sendall(cell)
+            seconds += time.perf_counter() - start
+            numbytes += len(cell)
+        if prefix:
+            self._socket.sendall(prefix)
+        elif numbytes:
+            self._encoder.written(numbytes, seconds)
+
+    def encode(self, data):
+        """Return the covertext that ``send(data)`` would write to the wire,
+        including the negotiation cell if it has not been sent yet, without
+        writing anything. Non-blocking relays use this together with
+        ``send_encoded`` to manage partial writes themselves.
+        """
+        retval = self._processSend()
 
         self._encoder.push(data)
         while True:
             to_send = self._encoder.pop()
             if not to_send:
                 break
-            self._socket.sendall(to_send)
-        return len(data)
+            retval += to_send
+        return retval
+
+    def send_encoded(self, data):
+        """Write covertext previously returned by ``encode``. Like
+        ``socket.send``, returns the number of bytes written.
+        """
+        return self._socket.send(data)
 
     def sendall(self, data):
         return self.send(data)
@@ -361,9 +751,31 @@ class _FTESocketWrapper(FTEHelper, object):
         return self._socket.settimeout(val)
 
     def shutdown(self, flags):
+        if flags != socket.SHUT_RD:
+            self.flush()
         return self._socket.shutdown(flags)
 
     def close(self):
+        # Flush what was sent so far; later sends raise. The pipeline is taken
+        # under the lock too, so that no send starts another one, or queues
+        # data behind the end of this one.
+        with self._send_lock:
+            self._corked = False
+            self._coalesce_window = 0
+            self._send_lock.notify()
+            try:
+                self._flushHeld()
+            except Exception as e:
+                fteproxy.info('failed to flush on close: %s', e)
+            self._closed = True
+            self._pipeline_depth = 0
+            pipeline, self._pipeline = self._pipeline, None
+        if pipeline is not None:
+            timeout = self._socket.gettimeout()
+            if timeout is None:
+                timeout = fteproxy.conf.getValue('runtime.fteproxy.relay.socket_timeout')
+            pipeline.close(timeout)
+        self._buffers.release()
         return self._socket.close()
 
     def connect(self, addr):
@@ -375,7 +787,7 @@ class _FTESocketWrapper(FTEHelper, object):
                                  self._outgoing_regex, self._outgoing_fixed_slice,
                                  self._incoming_regex, self._incoming_fixed_slice,
                                  self._K1, self._K2,
-                                 self._negotiate)
+                                 self._negotiate, language=self._language)
 
         return conn, addr
 
@@ -390,7 +802,7 @@ def wrap_socket(sock,
                 outgoing_regex=None, outgoing_fixed_slice=-1,
                 incoming_regex=None, incoming_fixed_slice=-1,
                 K1=None, K2=None,
-                negotiate=True):
+                negotiate=True, engine=None, language=None):
     """``fteproxy.wrap_socket`` turns an existing socket into an fteproxy socket.
 
     The input parameter ``sock`` is the socket to wrap.
@@ -407,15 +819,27 @@ def wrap_socket(sock,
     cell to establish the format. Set to ``False`` when both sides already know
     the formats (e.g., in symmetric client/server examples). Default is ``True``
     for backwards compatibility with the relay use case.
+
+    The ``engine`` parameter names the ``fteproxy.engines`` engine that cells
+    are encoded and decoded with, which must be the same on both ends. It
+    defaults to ``runtime.fteproxy.record_layer.engine``.
+
+    The ``language`` parameter is the name of the format of ``outgoing_regex``,
+    which a client announces in its negotiation cell so that the server
+    decodes with the same one. It defaults to
+    ``runtime.state.upstream_language``.
     """
 
     assert K1 == None or len(K1) == 16
     assert K2 == None or len(K2) == 16
 
+    if language is None:
+        language = fteproxy.conf.getValue('runtime.state.upstream_language')
+
     socket_wrapped = _FTESocketWrapper(
         sock,
         outgoing_regex, outgoing_fixed_slice,
         incoming_regex, incoming_fixed_slice,
         K1, K2,
-        negotiate)
+        negotiate, engine, language)
     return socket_wrapped
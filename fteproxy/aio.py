@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+An asyncio implementation of the fteproxy relay, for embedding fteproxy in an
+asyncio application. ``client_listener`` and ``server_listener`` speak the same
+wire protocol as ``fteproxy.client.listener`` and ``fteproxy.server.listener``,
+so an asyncio client can talk to a threaded server and vice versa.
+"""
+
+import socket
+import asyncio
+
+import fteproxy
+import fteproxy.conf
+import fteproxy.buffers
+import fteproxy.settings
+
+
+class stream(object):
+
+    """``fteproxy.aio.stream`` is a plain byte stream over an asyncio
+    ``(reader, writer)`` pair, the asyncio counterpart of a socket in
+    ``fteproxy.relay``. ``send`` waits on ``drain()``, so a slow peer pushes
+    back on whoever is sending to it.
+    """
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+
+    async def recv(self, bufsize=2 ** 18):
+        """Return the next chunk of data from the stream, or ``b''`` once the
+        peer has closed it.
+        """
+        return await self._reader.read(bufsize)
+
+    async def send(self, data):
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def setsockopt(self, level, optname, value):
+        sock = self._writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(level, optname, value)
+
+    def close(self):
+        self._writer.close()
+
+
+class fte_stream(stream):
+
+    """``fteproxy.aio.fte_stream`` is the asyncio counterpart of
+    ``fteproxy._FTESocketWrapper``: it drives ``fteproxy.record_layer.Encoder``
+    and ``Decoder`` directly and performs the same in-band negotiation. If
+    ``outgoing_regex`` and ``incoming_regex`` are given it acts as a client and
+    sends a negotiation cell ahead of its first data, otherwise it acts as a
+    server and learns the formats from the client's first cell.
+
+    Negotiating, encoding and decoding run on the event loop's default
+    executor, so that a tunnel busy with FTE does not hold up the other
+    tunnels on the loop. A server drops a client that sends nothing for
+    ``socket_timeout`` seconds before its negotiation cell is read; after
+    that, as with the threads backend, a quiet tunnel stays open.
+    """
+
+    def __init__(self, reader, writer,
+                 outgoing_regex=None, outgoing_fixed_slice=-1,
+                 incoming_regex=None, incoming_fixed_slice=-1,
+                 K1=None, K2=None, engine=None, language=None):
+        stream.__init__(self, reader, writer)
+        self._outgoing_regex = outgoing_regex
+        self._outgoing_fixed_slice = outgoing_fixed_slice
+        self._incoming_regex = incoming_regex
+        self._incoming_fixed_slice = incoming_fixed_slice
+        self._language = language
+
+        self._negotiation_manager = fteproxy.NegotiationManager(K1, K2, engine)
+        self._preNegotiationBuffer_incoming = b''
+        self._buffers = fteproxy.buffers.account()
+        self._isClient = (outgoing_regex is not None and incoming_regex is not None)
+        self._negotiationSent = not self._isClient
+        self._negotiation_lock = asyncio.Lock()
+
+        if self._isClient:
+            [self._encoder, self._decoder] = self._negotiation_manager._init_encoders(
+                outgoing_regex, outgoing_fixed_slice,
+                incoming_regex, incoming_fixed_slice)
+        else:
+            self._encoder = None
+            self._decoder = None
+
+    async def _writeNegotiationCell(self):
+        # Locked, as ``recv`` and ``send`` may both get here first.
+        async with self._negotiation_lock:
+            if self._negotiationSent:
+                return
+            negotiation_cell = await asyncio.to_thread(
+                self._negotiation_manager.makeClientNegotiationCell,
+                self._outgoing_regex, self._outgoing_fixed_slice,
+                self._incoming_regex, self._incoming_fixed_slice,
+                self._language)
+            self._writer.write(negotiation_cell)
+            self._negotiationSent = True
+
+    async def _read(self, numbytes):
+        if self._decoder is not None:
+            return await self._reader.read(numbytes)
+        try:
+            return await asyncio.wait_for(self._reader.read(numbytes),
+                                          fteproxy.settings.current().socket_timeout)
+        except asyncio.TimeoutError:
+            fteproxy.info('fteproxy.aio client sent no negotiation cell in time')
+            return b''
+
+    async def recv(self, bufsize=2 ** 18):
+        # As in ``_FTESocketWrapper.recv``, a client that reads before it
+        # writes must still send its negotiation cell first.
+        if not self._negotiationSent:
+            await self._writeNegotiationCell()
+            await self._writer.drain()
+
+        while True:
+            if self._decoder is not None:
+                data = b''
+                if self._decoder._buffer:
+                    data = await asyncio.to_thread(self._decoder.pop)
+                self._buffers.hold('decoder', len(self._decoder._buffer),
+                                   self._decoder._cell_length,
+                                   self._decoder._buffer.allocated())
+                if data:
+                    return data
+                [limit, held, allocated] = ['decoder', len(self._decoder._buffer),
+                                            self._decoder._buffer.allocated()]
+            else:
+                [limit, held, allocated] = ['negotiation',
+                                            len(self._preNegotiationBuffer_incoming), None]
+
+            try:
+                numbytes = self._buffers.room(limit, held, bufsize, allocated)
+            except fteproxy.buffers.BufferFull:
+                await asyncio.sleep(fteproxy.settings.current().throttle)
+                continue
+            data = await self._read(numbytes)
+            if not data:
+                return b''
+
+            if self._decoder is not None:
+                self._decoder.push(data)
+                continue
+
+            self._preNegotiationBuffer_incoming += data
+            try:
+                [self._encoder, self._decoder] = await asyncio.to_thread(
+                    self._negotiation_manager.doServerSideNegotiation,
+                    self._preNegotiationBuffer_incoming)
+            except Exception:
+                # Not enough of the first cell has arrived yet.
+                self._buffers.hold('negotiation', len(self._preNegotiationBuffer_incoming))
+                continue
+            self._preNegotiationBuffer_incoming = b''
+            if self._negotiation_manager.getMux():
+                # Multiplexed connections are only demultiplexed by the
+                # threaded ``fteproxy.server.listener``.
+                fteproxy.warn('multiplexed connection refused by fteproxy.aio')
+                return b''
+
+    def close(self):
+        self._buffers.release()
+        stream.close(self)
+
+    async def send(self, data):
+        await self._writeNegotiationCell()
+        if self._encoder is None:
+            raise fteproxy.ChannelNotReadyException()
+
+        self._encoder.push(data)
+        cells = self._encoder.iter_cells()
+        while True:
+            cell = await asyncio.to_thread(next, cells, None)
+            if cell is None:
+                break
+            self._writer.write(cell)
+        await self._writer.drain()
+
+
+def wrap_stream(_stream,
+                outgoing_regex=None, outgoing_fixed_slice=-1,
+                incoming_regex=None, incoming_fixed_slice=-1,
+                K1=None, K2=None, engine=None, language=None):
+    """``fteproxy.aio.wrap_stream`` turns a ``stream`` into an ``fte_stream``.
+    The parameters are the same as those of ``fteproxy.wrap_socket``.
+    """
+
+    assert K1 == None or len(K1) == 16
+    assert K2 == None or len(K2) == 16
+
+    if language is None:
+        language = fteproxy.conf.getValue('runtime.state.upstream_language')
+
+    return fte_stream(_stream._reader, _stream._writer,
+                      outgoing_regex, outgoing_fixed_slice,
+                      incoming_regex, incoming_fixed_slice,
+                      K1, K2, engine, language)
+
+
+async def _pump(src, dst):
+    try:
+        while True:
+            data = await src.recv()
+            if not data:
+                break
+            await dst.send(data)
+    except (Exception, SystemExit) as e:
+        # Keep a failing tunnel, including the SystemExit raised by
+        # ``fatal_error`` on an unrecoverable decryption error, from
+        # stopping the event loop that every other tunnel runs on.
+        fteproxy.warn("fteproxy.aio relay terminated prematurely: %s", e)
+
+
+async def relay(stream1, stream2):
+    """Forward all data from ``stream1`` to ``stream2``, and ``stream2`` to
+    ``stream1``. Like ``fteproxy.relay.worker``, both streams are closed once
+    either one of them is closed.
+    """
+
+    tasks = [asyncio.ensure_future(_pump(stream1, stream2)),
+             asyncio.ensure_future(_pump(stream2, stream1))]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        stream1.close()
+        stream2.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class listener(object):
+
+    """``fteproxy.aio.listener`` is the asyncio counterpart of
+    ``fteproxy.relay.listener``. Once started it accepts connections on
+    ``local_ip:local_port`` and relays each one to ``remote_ip:remote_port``,
+    wrapping the two sides with ``onNewIncomingConnection`` and
+    ``onNewOutgoingConnection``. Tunnels are encoded with the
+    ``fteproxy.engines`` engine called ``engine``, by default
+    ``runtime.fteproxy.record_layer.engine``.
+    """
+
+    def __init__(self, local_ip, local_port,
+                 remote_ip, remote_port, engine=None):
+        if engine is None:
+            engine = fteproxy.conf.getValue('runtime.fteproxy.record_layer.engine')
+        self._engine = engine
+        self._local_ip = local_ip
+        self._local_port = local_port
+        self._remote_ip = remote_ip
+        self._remote_port = remote_port
+        self._server = None
+        self._tunnels = set()
+
+    async def start(self):
+        """Bind to ``local_ip:local_port`` and start accepting connections on
+        the running event loop.
+        """
+        self._server = await asyncio.start_server(
+            self._handle, self._local_ip, self._local_port,
+            backlog=fteproxy.conf.getValue('runtime.fteproxy.relay.backlog'),
+            reuse_address=True)
+        return self
+
+    def getsockname(self):
+        return self._server.sockets[0].getsockname()
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        await self._server.serve_forever()
+
+    def stop(self):
+        """Stop listening on ``local_ip:local_port`` and close all tunnels.
+        """
+        if self._server is not None:
+            self._server.close()
+        for task in list(self._tunnels):
+            task.cancel()
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._tunnels.add(task)
+        try:
+            try:
+                [remote_reader, remote_writer] = await asyncio.wait_for(
+                    asyncio.open_connection(self._remote_ip, self._remote_port),
+                    fteproxy.settings.current().socket_timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                fteproxy.warn('failed to connect in fteproxy.aio.listener: %s', e)
+                writer.close()
+                return
+
+            conn = stream(reader, writer)
+            new_stream = stream(remote_reader, remote_writer)
+
+            # Disable Nagle's algorithm on both hops, as relay.listener does.
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            new_stream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            try:
+                conn = self.onNewIncomingConnection(conn)
+                new_stream = self.onNewOutgoingConnection(new_stream)
+            except Exception as e:
+                fteproxy.warn('exception in fteproxy.aio.listener: %s', e)
+                conn.close()
+                new_stream.close()
+                return
+
+            await relay(conn, new_stream)
+        finally:
+            self._tunnels.discard(task)
+
+    def onNewIncomingConnection(self, stream):
+        """``onNewIncomingConnection`` returns the stream unmodified, by default we do not need to
+        perform any modifications to incoming data streams.
+        """
+
+        return stream
+
+    def onNewOutgoingConnection(self, stream):
+        """``onNewOutgoingConnection`` returns the stream unmodified, by default we do not need to
+        perform any modifications to outgoing data streams.
+        """
+
+        return stream
+
+
+class client_listener(listener):
+
+    def onNewOutgoingConnection(self, stream):
+        """On an outgoing data stream we wrap it with ``fteproxy.aio.wrap_stream``, with
+        the languages specified in the ``runtime.state.upstream_language`` and
+        ``runtime.state.downstream_language`` configuration parameters, as
+        resolved in the ``client`` profile of ``fteproxy.settings.current()``.
+        """
+
+        profile = fteproxy.settings.current().client
+        return wrap_stream(stream,
+                           profile.outgoing_regex, profile.outgoing_fixed_slice,
+                           profile.incoming_regex, profile.incoming_fixed_slice,
+                           profile.K1, profile.K2, self._engine, profile.language)
+
+
+class server_listener(listener):
+
+    def onNewIncomingConnection(self, stream):
+        """On an incoming data stream we wrap it with ``fteproxy.aio.wrap_stream``, with no parameters.
+        By default we want the regular expressions to be negotiated in-band, specified by the client.
+        """
+        profile = fteproxy.settings.current().server
+        return wrap_stream(stream, K1=profile.K1, K2=profile.K2, engine=self._engine)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Limits on the data that connections have received but not decoded yet.
+
+Two buffers of a connection are limited:
+
+- ``decoder``: what its ``record_layer.Decoder`` holds. This is at most
+  ``runtime.fteproxy.buffers.max_connection`` bytes.
+- ``negotiation``: what a server holds before the client's negotiation cell
+  has been read. This is at most ``runtime.fteproxy.buffers.max_negotiation``
+  bytes.
+
+Together, these buffers of every connection of the process take up at most
+``runtime.fteproxy.buffers.budget`` bytes of memory. That counts the memory
+allocated for them, which can be more than the data they hold.
+
+A connection that reaches a limit is handled by
+``runtime.fteproxy.buffers.policy``:
+
+- ``pause`` reads only as much as fits. If nothing fits the budget, nothing is
+  read until other connections free some of it, and TCP flow control pushes
+  back on the peer.
+- ``close`` reads as usual, and tears the connection down once what it holds
+  is over a limit.
+
+Under either policy, a connection is torn down if its buffer is full, or is
+waiting for a cell larger than its buffer. Buffers only drain by decoding, so
+no amount of waiting would free that buffer.
+
+``counters`` counts how often each limit fired. ``held`` tells how much of the
+budget is in use. Both cover this process only.
+"""
+
+import socket
+import threading
+
+import fteproxy
+import fteproxy.conf
+
+
+class BufferFull(socket.timeout):
+
+    """Raised by ``recv`` when the ``pause`` policy lets it read nothing for
+    now. Try again later.
+    """
+
+    pass
+
+
+class LimitExceeded(socket.error):
+
+    """Raised by ``recv`` when a connection is torn down for holding too
+    much data.
+    """
+
+    pass
+
+
+# How often each limit closed a connection, and the budget paused reads. A
+# read that is only cut down to fit a buffer's limit is not counted. Not
+# locked, like ``record_layer.counters``.
+counters = {'decoder_closed': 0, 'negotiation_closed': 0,
+            'budget_paused': 0, 'budget_closed': 0,
+            'mux_window_closed': 0}
+
+_LIMITS = {'decoder': 'runtime.fteproxy.buffers.max_connection',
+           'negotiation': 'runtime.fteproxy.buffers.max_negotiation'}
+
+_held = 0
+_lock = threading.Lock()
+
+
+def held():
+    """The bytes taken up by the buffers of every connection, toward the
+    budget."""
+    return _held
+
+
+def reset_counters():
+    for key in counters:
+        counters[key] = 0
+
+
+def _fire(limit, action):
+    counters[limit + '_' + action] += 1
+    fteproxy.warn('%s buffer limit reached, %s', limit,
+                  'closing the connection' if action == 'closed' else 'pausing reads')
+
+
+class account(object):
+
+    """``fteproxy.buffers.account`` keeps the buffers of one connection within
+    their limits, and counts what they hold toward the budget. The limits and
+    policy are read once, when the connection is set up.
+    """
+
+    def __init__(self):
+        self._limits = {limit: fteproxy.conf.getValue(key)
+                        for limit, key in _LIMITS.items()}
+        self._budget = fteproxy.conf.getValue('runtime.fteproxy.buffers.budget')
+        self._pause = fteproxy.conf.getValue('runtime.fteproxy.buffers.policy') == 'pause'
+        self._held = 0
+
+    def __del__(self):
+        self.release()
+
+    def room(self, limit, held, bufsize, allocated=None):
+        """Return how many bytes the connection may read now, at most
+        ``bufsize``, into the buffer ``limit`` (``decoder`` or
+        ``negotiation``), which holds ``held`` bytes in ``allocated`` bytes
+        of memory (``held`` by default). Raises ``BufferFull`` if it may not
+        read any now, and ``LimitExceeded`` if it never will.
+        """
+        room = self._limits[limit] - held
+        if room <= 0:
+            _fire(limit, 'closed')
+            raise LimitExceeded('%s buffer holds %d bytes, its limit' % (limit, held))
+        if not self._pause:
+            return bufsize
+
+        # Reading less than ``bufsize`` pauses nothing: the buffer still has
+        # room, and ``bufsize`` may be more than its limit to begin with.
+        bufsize = min(bufsize, room)
+        if self._budget:
+            # What the connection takes up is about to be replaced by the
+            # larger of ``allocated`` and ``held`` plus what it reads.
+            others = _held - self._held
+            allocated = held if allocated is None else allocated
+            available = self._budget - others - held
+            if available <= 0 or others + allocated > self._budget:
+                _fire('budget', 'paused')
+                raise BufferFull('buffer budget of %d bytes in use' % self._budget)
+            bufsize = min(bufsize, available)
+        return bufsize
+
+    def hold(self, limit, held, needed=0, allocated=None):
+        """Record that the buffer ``limit`` holds ``held`` bytes in
+        ``allocated`` bytes of memory (``held`` by default), and needs
+        ``needed`` bytes to decode what comes first in it. Raises
+        ``LimitExceeded``, and releases what the connection held, if that
+        is over a limit that the connection cannot come back under.
+        """
+        global _held
+
+        if needed > self._limits[limit] or (not self._pause and held > self._limits[limit]):
+            self.release()
+            _fire(limit, 'closed')
+            raise LimitExceeded('%s buffer needs %d bytes, over its limit'
+                                % (limit, max(held, needed)))
+
+        allocated = held if allocated is None else allocated
+        with _lock:
+            _held += allocated - self._held
+            self._held = allocated
+            over = not self._pause and self._budget and _held > self._budget
+        if over:
+            self.release()
+            _fire('budget', 'closed')
+            raise LimitExceeded('buffer budget of %d bytes exceeded' % self._budget)
+
+    def release(self):
+        """Stop counting what the connection holds toward the budget."""
+        global _held
+
+        with _lock:
+            _held -= self._held
+            self._held = 0
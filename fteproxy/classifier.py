@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Classification of a client's first bytes by request language, so that the
+server decodes the first cell only with languages it could belong to.
+
+The formatted part of an FTE cell is a word of exactly ``fixed_slice`` bytes
+of its language. Whether some bytes can start such a word is a walk of the
+language's DFA that stops as soon as no word of the right length remains, so
+``GET /`` rules out ssh and smtp after the first byte, with no ranking or
+decryption.
+"""
+
+import threading
+
+import fteproxy.defs
+import fteproxy.format_cache
+
+
+_index = None
+_unindexed = None
+_index_lock = threading.Lock()
+
+
+def candidates(data):
+    """Return the set of request languages of the loaded definitions that the
+    first cell of a connection starting with ``data`` may be in. Languages
+    whose tables are not loaded yet (see ``fteproxy.format_cache.warmup``)
+    are not ruled out, rather than loaded here.
+    """
+    [index, unindexed] = _getIndex()
+    return index.candidates(data) | unindexed
+
+
+def _getIndex():
+    # The index covers the request languages whose tables are loaded, and is
+    # rebuilt once more of them are.
+    global _index, _unindexed
+
+    with _index_lock:
+        if _index is None or any(fteproxy.format_cache.is_loaded(
+                fteproxy.defs.getRegex(language), fteproxy.defs.getFixedSlice(language))
+                for language in _unindexed):
+            languages = [language for language in fteproxy.defs.load_definitions()
+                         if language.endswith('-request')]
+            loaded = [language for language in languages
+                      if fteproxy.format_cache.is_loaded(
+                          fteproxy.defs.getRegex(language),
+                          fteproxy.defs.getFixedSlice(language))]
+            _index = prefix_index(loaded)
+            _unindexed = set(languages) - set(loaded)
+        return [_index, _unindexed]
+
+
+class prefix_index(object):
+
+    """``fteproxy.classifier.prefix_index`` tells which of ``languages`` the
+    first cell of a connection may be in. Languages are indexed by the bytes
+    their words can start with, so ``candidates`` only walks the DFAs of the
+    languages that the first byte leaves in.
+    """
+
+    def __init__(self, languages):
+        # First byte -> [(language, DFA, state after that byte), ...]
+        self._first = {}
+        for language in languages:
+            dfa = fteproxy.format_cache.get_dfa(
+                fteproxy.defs.getRegex(language),
+                fteproxy.defs.getFixedSlice(language))
+            start = dfa._delta[dfa._start_state]
+            for symbol, symbol_idx in dfa._sigma_reverse.items():
+                state = start[symbol_idx]
+                if dfa._T[state][dfa._fixed_slice - 1]:
+                    self._first.setdefault(symbol, []).append((language, dfa, state))
+        self._languages = list(languages)
+
+    def candidates(self, data):
+        """Return the set of languages whose cells can start with ``data``.
+        Only the first ``fixed_slice`` bytes of ``data`` are looked at, and
+        fewer bytes leave more candidates.
+        """
+        if not data:
+            return set(self._languages)
+
+        retval = set()
+        for language, dfa, state in self._first.get(data[0], []):
+            if _viable(dfa, state, data):
+                retval.add(language)
+        return retval
+
+
+def _viable(dfa, state, data):
+    # Whether words of ``dfa`` of length ``fixed_slice`` can start with
+    # ``data``, given ``state`` is the state after its first byte.
+    fixed_slice = dfa._fixed_slice
+    T = dfa._T
+    delta = dfa._delta
+    sigma_reverse = dfa._sigma_reverse
+
+    remaining = fixed_slice - 1
+    for symbol in data[1:fixed_slice]:
+        symbol_idx = sigma_reverse.get(symbol)
+        if symbol_idx is None:
+            return False
+        state = delta[state][symbol_idx]
+        remaining -= 1
+        if not T[state][remaining]:
+            return False
+    return True
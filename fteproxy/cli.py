@@ -7,17 +7,22 @@
 import sys
 import os
 import signal
+import socket
 import glob
 import argparse
 import threading
 import traceback
 
-import fte
-
 import fteproxy
 import fteproxy.conf
+import fteproxy.defs
+import fteproxy.buffers
+import fteproxy.engines
+import fteproxy.format_cache
+import fteproxy.settings
 import fteproxy.server
 import fteproxy.client
+import fteproxy.workers
 
 FTEPROXY_VERSION = fteproxy.__version__
 
@@ -27,6 +32,9 @@ class FTEMain(threading.Thread):
     def __init__(self, args):
         threading.Thread.__init__(self)
         self._args = args
+        self._client = None
+        self._server = None
+        self._warmup = None
 
     def run(self):
         try:
@@ -42,6 +50,9 @@ class FTEMain(threading.Thread):
             if self._args.stop:
                 FTEMain.do_stop(self)
 
+            if self._args.build_cache:
+                FTEMain.do_build_cache(self)
+
             try:
                 pid_file = get_pid_file()
 
@@ -80,6 +91,14 @@ class FTEMain(threading.Thread):
                 os.unlink(pid_file)
         sys.exit(0)
 
+    def do_build_cache(self):
+        languages = fteproxy.defs.load_definitions()
+        written = fteproxy.format_cache.build(languages.keys())
+        if not self._args.quiet:
+            print('Compiled ' + str(written) + ' of ' + str(len(languages))
+                  + ' formats into ' + fteproxy.format_cache.directory())
+        sys.exit(0)
+
     def init_listener(self, mode):
         server_ip = fteproxy.conf.getValue('runtime.server.ip')
         server_port = fteproxy.conf.getValue('runtime.server.port')
@@ -96,6 +115,42 @@ class FTEMain(threading.Thread):
         else:
             fteproxy.fatal_error('Unexpected mode in init_listener: ' + mode)
 
+    def init_relay(self, mode):
+        num_workers = fteproxy.conf.getValue('runtime.fteproxy.workers')
+        if num_workers > 1:
+            return fteproxy.workers.supervisor(
+                num_workers,
+                lambda: FTEMain.init_listener(self, mode),
+                fteproxy.conf.getValue('runtime.fteproxy.workers.cpu_affinity'))
+        return FTEMain.init_listener(self, mode)
+
+    def reload(self):
+        """Reload ``runtime.fteproxy.config_file``, in this process and in
+        every worker process.
+        """
+        fteproxy.settings.reload()
+        relay = self._server if self._server is not None else self._client
+        if isinstance(relay, fteproxy.workers.supervisor):
+            relay.reload()
+
+    def log_stats(self):
+        relay = self._server if self._server is not None else self._client
+        if relay is None:
+            return
+        counters = relay.stats.asdict()
+        if not isinstance(relay, fteproxy.workers.supervisor):
+            # Kept by the process that relays; each worker logs its own.
+            counters['buffered'] = fteproxy.buffers.held()
+            counters.update(fteproxy.buffers.counters)
+        if self._warmup is not None:
+            counters['warmup'] = '%d/%d' % tuple(self._warmup.progress())
+        pool_size = fteproxy.conf.getValue('runtime.fteproxy.relay.pool_size')
+        if pool_size > 0:
+            capacity = pool_size * fteproxy.conf.getValue('runtime.fteproxy.workers')
+            counters['utilization'] = '%d%%' % (100 * counters['active'] // capacity)
+        fteproxy.info('stats: %s', ' '.join(
+            key + '=' + str(value) for key, value in counters.items()))
+
     def init_encoder(self, stream_format):
 
         key = fteproxy.conf.getValue('runtime.fteproxy.encrypter.key')
@@ -106,17 +161,17 @@ class FTEMain(threading.Thread):
             fteproxy.fatal_error('Invalid format name ' + stream_format)
 
         fixed_slice = fteproxy.defs.getFixedSlice(stream_format)
-        fte.Encoder(regex, fixed_slice, key)
+        fteproxy.format_cache.get_encoder(regex, fixed_slice, key)
 
     def do_client(self):
 
-        FTEMain.init_encoder(self, self._args.downstream_format)
-        FTEMain.init_encoder(self, self._args.upstream_format)
+        FTEMain.init_encoder(self, fteproxy.conf.getValue('runtime.state.downstream_language'))
+        FTEMain.init_encoder(self, fteproxy.conf.getValue('runtime.state.upstream_language'))
 
         if not self._args.quiet:
             print('Client ready!')
 
-        self._client = FTEMain.init_listener(self, 'client')
+        self._client = FTEMain.init_relay(self, 'client')
         self._client.daemon = True
         self._client.start()
         self._client.join()
@@ -124,10 +179,25 @@ class FTEMain(threading.Thread):
     def do_server(self):
 
         languages = fteproxy.defs.load_definitions()
-        for language in languages.keys():
-            FTEMain.init_encoder(self, language)
+        status_file = fteproxy.conf.getValue('runtime.fteproxy.warmup.status_file')
+        if fteproxy.conf.getValue('runtime.fteproxy.lazy_warmup'):
+            configured = [fteproxy.conf.getValue('runtime.state.upstream_language'),
+                          fteproxy.conf.getValue('runtime.state.downstream_language')]
+            for language in configured:
+                FTEMain.init_encoder(self, language)
+            self._warmup = fteproxy.format_cache.warmup(
+                configured + [language for language in languages.keys()
+                              if language not in configured],
+                fteproxy.conf.getValue('runtime.fteproxy.encrypter.key'),
+                status_file)
+            self._warmup.start()
+        else:
+            for language in languages.keys():
+                FTEMain.init_encoder(self, language)
+            if status_file is not None:
+                fteproxy.format_cache.write_status(status_file, len(languages), len(languages))
 
-        self._server = FTEMain.init_listener(self, 'server')
+        self._server = FTEMain.init_relay(self, 'server')
         self._server.daemon = True
         self._server.start()
         if not self._args.quiet:
@@ -193,7 +263,34 @@ def get_args():
                 "--downstream-format":  "runtime.state.downstream_language",
                 "--upstream-format":    "runtime.state.upstream_language",
                 "--release":            "fteproxy.defs.release",
+                "--config":             "runtime.fteproxy.config_file",
+                "--format-cache":       "fteproxy.format_cache.dir",
+                "--lazy-warmup":        "runtime.fteproxy.lazy_warmup",
+                "--warmup-status-file": "runtime.fteproxy.warmup.status_file",
                 "--key":                "runtime.fteproxy.encrypter.key",
+                "--relay-backend":      "runtime.fteproxy.relay.backend",
+                "--relay-pool":         "runtime.fteproxy.relay.pool_size",
+                "--relay-queue-timeout": "runtime.fteproxy.relay.queue_timeout",
+                "--connect-timeout":    "runtime.fteproxy.relay.connect_timeout",
+                "--connect-concurrency": "runtime.fteproxy.relay.connect_concurrency",
+                "--upstream-pool":      "runtime.fteproxy.relay.upstream_pool.min_idle",
+                "--upstream-max-age":   "runtime.fteproxy.relay.upstream_pool.max_age",
+                "--pipeline-depth":     "runtime.fteproxy.relay.pipeline_depth",
+                "--coalesce-window":    "runtime.fteproxy.relay.coalesce_window",
+                "--coalesce-bytes":     "runtime.fteproxy.relay.coalesce_bytes",
+                "--workers":            "runtime.fteproxy.workers",
+                "--cpu-affinity":       "runtime.fteproxy.workers.cpu_affinity",
+                "--codec-pool":         "runtime.fteproxy.record_layer.codec_pool.workers",
+                "--engine":             "runtime.fteproxy.record_layer.engine",
+                "--max-buffer":         "runtime.fteproxy.buffers.max_connection",
+                "--max-negotiation-buffer": "runtime.fteproxy.buffers.max_negotiation",
+                "--buffer-budget":      "runtime.fteproxy.buffers.budget",
+                "--buffer-policy":      "runtime.fteproxy.buffers.policy",
+                "--adaptive-cells":     "runtime.fteproxy.record_layer.adaptive_cell_size",
+                "--min-cell-size":      "runtime.fteproxy.record_layer.min_cell_size",
+                "--target-latency":     "runtime.fteproxy.record_layer.target_latency",
+                "--mux":                "runtime.fteproxy.mux",
+                "--mux-frame-size":     "runtime.fteproxy.mux.frame_size",
             }
 
             if self.dest == "key_file":
@@ -202,12 +299,24 @@ def get_args():
                                        read_key_file(values))
                 return
 
+            if self.dest == "config":
+                setattr(namespace, self.dest, values)
+                fteproxy.conf.setValue(args_to_conf[options_string], values)
+                try:
+                    fteproxy.settings.load(values)
+                except fteproxy.settings.InvalidConfig as e:
+                    parser.error(str(e))
+                return
+
             if self.dest == "key":
                 values = parse_hex_key(values)
 
             if self.dest == 'quiet':
                 fteproxy.conf.setValue(args_to_conf[options_string], 0)
                 setattr(namespace, self.dest, True)
+            elif self.dest in ('cpu_affinity', 'adaptive_cells', 'mux', 'lazy_warmup'):
+                fteproxy.conf.setValue(args_to_conf[options_string], True)
+                setattr(namespace, self.dest, True)
             else:
                 setattr(namespace, self.dest, values)
                 if "port" in self.dest:
@@ -261,6 +370,138 @@ def get_args():
     parser.add_argument('--release', action=setConfValue,
                         help='Definitions file to use, specified as YYYYMMDD',
                         default=fteproxy.conf.getValue('fteproxy.defs.release'))
+    parser.add_argument('--config', action=setConfValue, metavar='PATH',
+                        help='Read the settings in the JSON file PATH, and read '
+                             'them again on SIGHUP: tunnels opened after that get '
+                             'the new settings, open tunnels keep theirs. Options '
+                             'given after --config override the file until then',
+                        default=fteproxy.conf.getValue('runtime.fteproxy.config_file'))
+    parser.add_argument('--format-cache', action=setConfValue, metavar='DIR',
+                        help='Read compiled format tables from DIR, and write '
+                             'the tables of formats not found there',
+                        default=fteproxy.conf.getValue('fteproxy.format_cache.dir'))
+    parser.add_argument('--build-cache', action='store_true',
+                        help='Compile every format of --release into '
+                             '--format-cache, then quit')
+    parser.add_argument('--lazy-warmup', action=setConfValue, default=False,
+                        help='In server mode, start listening once the upstream '
+                             'and downstream formats are loaded, and load the '
+                             'other formats in the background', nargs=0)
+    parser.add_argument('--warmup-status-file', action=setConfValue, metavar='PATH',
+                        help='In server mode, keep PATH updated with the progress '
+                             'of loading formats: "warming N/TOTAL", then '
+                             '"ready TOTAL/TOTAL"',
+                        default=fteproxy.conf.getValue('runtime.fteproxy.warmup.status_file'))
+    parser.add_argument('--relay-backend', action=setConfValue,
+                        choices=['threads', 'selectors'],
+                        help='Relay tunnels with two threads each, or all on '
+                             'one selectors (epoll/kqueue) event loop',
+                        default=fteproxy.conf.getValue('runtime.fteproxy.relay.backend'))
+    parser.add_argument('--relay-pool', action=setConfValue, type=int, metavar='N',
+                        help='With the threads backend, relay at most N tunnels '
+                             'at once on pre-spawned threads, queueing the rest '
+                             '(0 for a new pair of threads per tunnel)',
+                        default=fteproxy.conf.getValue('runtime.fteproxy.relay.pool_size'))
+    parser.add_argument('--relay-queue-timeout', action=setConfValue, type=float,
+                        metavar='SECONDS',
+                        help='Seconds a tunnel waits for a free --relay-pool slot '
+                             'before it is closed',
+                        default=fteproxy.conf.getValue('runtime.fteproxy.relay.queue_timeout'))
+    parser.add_argument('--connect-timeout', action=setConfValue, type=float,
+                        metavar='SECONDS',
+                        help='Seconds to wait for the connection to the upstream '
+                             'of a tunnel before giving up on the tunnel',
+                        default=fteproxy.conf.getValue('runtime.fteproxy.relay.connect_timeout'))
+    parser.add_argument('--connect-concurrency', action=setConfValue, type=int, metavar='N',
+                        help='Connect to the upstreams of at most N tunnels at once; '
+                             'further tunnels wait while new ones are still accepted',
+                        default=fteproxy.conf.getValue(
+                            'runtime.fteproxy.relay.connect_concurrency'))
+    parser.add_argument('--upstream-pool', action=setConfValue, type=int, metavar='N',
+                        help='In server mode, keep N idle connections to the proxy '
+                             'open, so that new tunnels do not wait for a connect '
+                             '(0 to disable)',
+                        default=fteproxy.conf.getValue(
+                            'runtime.fteproxy.relay.upstream_pool.min_idle'))
+    parser.add_argument('--upstream-max-age', action=setConfValue, type=float,
+                        metavar='SECONDS',
+                        help='Replace idle --upstream-pool connections after '
+                             'this many seconds',
+                        default=fteproxy.conf.getValue(
+                            'runtime.fteproxy.relay.upstream_pool.max_age'))
+    parser.add_argument('--pipeline-depth', action=setConfValue, type=int, metavar='N',
+                        help='With the threads backend, encode and write the data '
+                             'sent into a tunnel on separate threads, with up to N '
+                             'chunks queued between stages (0 to disable)',
+                        default=fteproxy.conf.getValue('runtime.fteproxy.relay.pipeline_depth'))
+    parser.add_argument('--coalesce-window', action=setConfValue, type=float,
+                        metavar='SECONDS',
+                        help='Hold back the data sent into a tunnel for up to '
+                             'SECONDS, so that small writes share one FTE cell '
+                             '(0 to disable)',
+                        default=fteproxy.conf.getValue('runtime.fteproxy.relay.coalesce_window'))
+    parser.add_argument('--coalesce-bytes', action=setConfValue, type=int, metavar='N',
+                        help='Send data held back by --coalesce-window as soon as '
+                             'N bytes are held',
+                        default=fteproxy.conf.getValue('runtime.fteproxy.relay.coalesce_bytes'))
+    parser.add_argument('--workers', action=setConfValue, type=int,
+                        help='Number of worker processes sharing the listening '
+                             'port via SO_REUSEPORT',
+                        default=fteproxy.conf.getValue('runtime.fteproxy.workers'))
+    parser.add_argument('--cpu-affinity', action=setConfValue, default=False,
+                        help='Pin each worker process to its own CPU', nargs=0)
+    parser.add_argument('--codec-pool', action=setConfValue, type=int, metavar='N',
+                        help='Encode and decode the cells of each stream in '
+                             'parallel on a pool of N processes (0 to disable)',
+                        default=fteproxy.conf.getValue(
+                            'runtime.fteproxy.record_layer.codec_pool.workers'))
+    parser.add_argument('--engine', action=setConfValue,
+                        choices=fteproxy.engines.names(),
+                        help='Encode cells with FTE, or only frame them with '
+                             'identity, to measure the relay without FTE; the '
+                             'client and server must use the same engine',
+                        default=fteproxy.conf.getValue('runtime.fteproxy.record_layer.engine'))
+    parser.add_argument('--max-buffer', action=setConfValue, type=int, metavar='BYTES',
+                        help='Hold at most BYTES of a connection\'s data '
+                             'received but not yet decoded',
+                        default=fteproxy.conf.getValue('runtime.fteproxy.buffers.max_connection'))
+    parser.add_argument('--max-negotiation-buffer', action=setConfValue, type=int,
+                        metavar='BYTES',
+                        help='In server mode, hold at most BYTES of a client\'s '
+                             'data before its negotiation cell has been read',
+                        default=fteproxy.conf.getValue('runtime.fteproxy.buffers.max_negotiation'))
+    parser.add_argument('--buffer-budget', action=setConfValue, type=int, metavar='BYTES',
+                        help='Allocate at most BYTES for the buffers limited by '
+                             '--max-buffer and --max-negotiation-buffer, across '
+                             'all connections (0 for no limit)',
+                        default=fteproxy.conf.getValue('runtime.fteproxy.buffers.budget'))
+    parser.add_argument('--buffer-policy', action=setConfValue,
+                        choices=['pause', 'close'],
+                        help='At a buffer limit, read only what fits, or close '
+                             'the connection',
+                        default=fteproxy.conf.getValue('runtime.fteproxy.buffers.policy'))
+    parser.add_argument('--mux', action=setConfValue, default=False,
+                        help='In client mode, carry all tunnels over one FTE '
+                             'connection to the server; in server mode, accept '
+                             'such connections', nargs=0)
+    parser.add_argument('--mux-frame-size', action=setConfValue, type=int, metavar='BYTES',
+                        help='Largest chunk of one --mux stream sent before the '
+                             'other streams get a turn',
+                        default=fteproxy.conf.getValue('runtime.fteproxy.mux.frame_size'))
+    parser.add_argument('--adaptive-cells', action=setConfValue, default=False,
+                        help='Size the cells of each tunnel between --min-cell-size '
+                             'and the maximum cell size, from its measured rate and '
+                             'write pattern', nargs=0)
+    parser.add_argument('--min-cell-size', action=setConfValue, type=int, metavar='BYTES',
+                        help='Smallest cell picked by --adaptive-cells',
+                        default=fteproxy.conf.getValue(
+                            'runtime.fteproxy.record_layer.min_cell_size'))
+    parser.add_argument('--target-latency', action=setConfValue, type=float,
+                        metavar='SECONDS',
+                        help='Seconds within which --adaptive-cells aims to encode '
+                             'and write a cell of an interactive tunnel',
+                        default=fteproxy.conf.getValue(
+                            'runtime.fteproxy.record_layer.target_latency'))
     key_group = parser.add_mutually_exclusive_group()
     key_group.add_argument('--key', action=setConfValue,
                         help='Cryptographic key, hex, must be exactly 64 characters',
@@ -275,6 +516,56 @@ def get_args():
 
     if args.stop and not args.mode:
         parser.error('--mode keyword is required with --stop')
+    if args.build_cache and not args.format_cache:
+        parser.error('--build-cache requires --format-cache')
+
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error('--workers requires SO_REUSEPORT, which this platform lacks')
+    if args.lazy_warmup and args.workers > 1:
+        parser.error('--lazy-warmup requires --workers 1, as workers share the '
+                     'formats loaded before they are forked')
+    if args.cpu_affinity and not hasattr(os, 'sched_setaffinity'):
+        parser.error('--cpu-affinity is not supported on this platform')
+    if args.pipeline_depth < 0:
+        parser.error('--pipeline-depth must not be negative')
+    if args.coalesce_window < 0:
+        parser.error('--coalesce-window must not be negative')
+    if args.coalesce_bytes < 1:
+        parser.error('--coalesce-bytes must be at least 1')
+    if args.connect_timeout <= 0:
+        parser.error('--connect-timeout must be positive')
+    if args.connect_concurrency < 1:
+        parser.error('--connect-concurrency must be at least 1')
+    if args.upstream_pool < 0:
+        parser.error('--upstream-pool must not be negative')
+    if args.upstream_max_age <= 0:
+        parser.error('--upstream-max-age must be positive')
+    if args.relay_pool < 0:
+        parser.error('--relay-pool must not be negative')
+    if args.codec_pool < 0:
+        parser.error('--codec-pool must not be negative')
+    max_cell_size = fteproxy.conf.getValue('runtime.fteproxy.record_layer.max_cell_size')
+    if not 0 < args.min_cell_size <= max_cell_size:
+        parser.error('--min-cell-size must be between 1 and ' + str(max_cell_size))
+    if args.target_latency <= 0:
+        parser.error('--target-latency must be positive')
+    if args.max_buffer < 2 * max_cell_size:
+        parser.error('--max-buffer must be at least ' + str(2 * max_cell_size))
+    if args.max_negotiation_buffer < 2**12:
+        parser.error('--max-negotiation-buffer must be at least ' + str(2**12))
+    if args.buffer_budget < 0:
+        parser.error('--buffer-budget must not be negative')
+    if not 0 < args.mux_frame_size < 2**16:
+        parser.error('--mux-frame-size must be between 1 and 65535')
+    if args.mux and args.mode == 'server' and \
+            fteproxy.conf.getValue('runtime.fteproxy.relay.backend') != 'threads':
+        parser.error('--mux in server mode requires --relay-backend threads')
+
+    if args.engine == 'identity':
+        fteproxy.warn('--engine identity neither encrypts nor formats the '
+                      'traffic of tunnels; use it for measurements only')
 
     if not args.mode:  # set client mode in conf if not set
         fteproxy.conf.setValue('runtime.mode', 'client')
@@ -290,10 +581,18 @@ def main():
         global running
         running = False
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
 
     try:
         args = get_args()
         main_thread = FTEMain(args)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1,
+                          lambda signum, frame: main_thread.log_stats())
+        # Without a config file, a hangup stops fteproxy as usual.
+        if hasattr(signal, 'SIGHUP') and fteproxy.conf.getValue('runtime.fteproxy.config_file'):
+            signal.signal(signal.SIGHUP,
+                          lambda signum, frame: main_thread.reload())
         main_thread.daemon = True
         main_thread.start()
         while running and main_thread.is_alive():
@@ -309,3 +608,9 @@ def main():
 
             if pid_file and os.path.exists(pid_file):
                 os.unlink(pid_file)
+
+        # A status file left behind would report a server that is gone as ready.
+        status_file = fteproxy.conf.getValue('runtime.fteproxy.warmup.status_file')
+        if fteproxy.conf.getValue('runtime.mode') == 'server' and status_file \
+                and os.path.exists(status_file):
+            os.unlink(status_file)
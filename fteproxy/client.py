@@ -3,33 +3,69 @@
 
 
 
+import socket
+import threading
+
 import fteproxy.relay
+import fteproxy.mux
 
 
 class listener(fteproxy.relay.listener):
 
+    """With ``runtime.fteproxy.mux`` set, the client carries every tunnel as a
+    stream of one ``fteproxy.mux.session`` to the server, which is connected
+    and negotiated once, and again only after the server closes it. That
+    happens on a connector thread with either relay backend, so that a slow
+    server does not hold up the ``selectors`` event loop.
+    """
+
+    def __init__(self, *args, **kwargs):
+        fteproxy.relay.listener.__init__(self, *args, **kwargs)
+        self._mux = fteproxy.conf.getValue('runtime.fteproxy.mux')
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._blocking_upstream = self._mux
+
+    def _readyUpstream(self, settings):
+        if not self._mux:
+            return fteproxy.relay.listener._readyUpstream(self, settings)
+
+        with self._session_lock:
+            if self._session is None or self._session.closed:
+                tunnel = socket.create_connection(
+                    (self._remote_ip, self._remote_port), settings.connect_timeout)
+                tunnel.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                tunnel = self._wrap(tunnel, settings)
+                tunnel.negotiate(mux=True)
+                self._session = fteproxy.mux.session(tunnel)
+                self._session.start()
+            return self._session.open_stream()
+
+    def stop(self):
+        fteproxy.relay.listener.stop(self)
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+
     def onNewOutgoingConnection(self, socket):
         """On an outgoing data stream we wrap it with ``fteproxy.wrap_socket``, with
         the languages specified in the ``runtime.state.upstream_language`` and
-        ``runtime.state.downstream_language`` configuration parameters.
+        ``runtime.state.downstream_language`` configuration parameters, as
+        resolved in the ``client`` profile of the tunnel's settings snapshot.
+        Streams of the ``fteproxy.mux.session`` are returned as they are, as the
+        session's own connection is wrapped instead.
         """
+        if self._mux:
+            return socket
 
-        outgoing_language = fteproxy.conf.getValue(
-            'runtime.state.upstream_language')
-        incoming_language = fteproxy.conf.getValue(
-            'runtime.state.downstream_language')
-
-        outgoing_regex = fteproxy.defs.getRegex(outgoing_language)
-        outgoing_fixed_slice = fteproxy.defs.getFixedSlice(outgoing_language)
-
-        incoming_regex = fteproxy.defs.getRegex(incoming_language)
-        incoming_fixed_slice = fteproxy.defs.getFixedSlice(incoming_language)
+        return self._wrap(socket, self._settings())
 
-        K1 = fteproxy.conf.getValue('runtime.fteproxy.encrypter.key')[:16]
-        K2 = fteproxy.conf.getValue('runtime.fteproxy.encrypter.key')[16:]
+    def _wrap(self, socket, settings):
+        profile = settings.client
         socket = fteproxy.wrap_socket(socket,
-                                 outgoing_regex, outgoing_fixed_slice,
-                                 incoming_regex, incoming_fixed_slice,
-                                 K1, K2)
+                                 profile.outgoing_regex, profile.outgoing_fixed_slice,
+                                 profile.incoming_regex, profile.incoming_fixed_slice,
+                                 profile.K1, profile.K2, engine=self._engine,
+                                 language=profile.language)
 
         return socket
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+import threading
+import multiprocessing
+import concurrent.futures
+
+import fteproxy.conf
+import fteproxy.engines
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _getEncoder(engine, regex, fixed_slice, key):
+    # Engines share their encoders between calls, within each worker process.
+    return fteproxy.engines.get(engine).get_encoder(regex, fixed_slice, key)
+
+
+def _encode(engine, regex, fixed_slice, key, plaintext):
+    return _getEncoder(engine, regex, fixed_slice, key).encode(plaintext)
+
+
+def _decode(engine, regex, fixed_slice, key, covertext):
+    msg, _ = _getEncoder(engine, regex, fixed_slice, key).decode(covertext)
+    return msg
+
+
+def get_pool():
+    """Return the process pool shared by every ``codec`` in this process,
+    creating it with ``runtime.fteproxy.record_layer.codec_pool.workers``
+    processes on first use. Workers are spawned rather than forked, since
+    the relay forks from a process that is already running threads.
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=fteproxy.conf.getValue(
+                    'runtime.fteproxy.record_layer.codec_pool.workers'),
+                mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def shutdown():
+    """Stop the shared process pool, if it was started."""
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+
+
+class codec(object):
+
+    """``fteproxy.codec_pool.codec`` encodes and decodes FTE cells of one format
+    on the shared process pool, so that the cells of a single stream can be
+    processed on several cores at once, with the ``fteproxy.engines`` engine
+    called ``engine``. ``encode`` and ``decode`` submit every cell before
+    waiting for any, and return futures in the order of their input, so that
+    results can be consumed in order as they complete.
+    """
+
+    def __init__(self, regex, fixed_slice, key=None, engine='fte'):
+        self._engine = engine
+        self._regex = regex
+        self._fixed_slice = fixed_slice
+        self._key = key
+
+    def encode(self, plaintexts):
+        pool = get_pool()
+        return [pool.submit(_encode, self._engine, self._regex, self._fixed_slice, self._key, p)
+                for p in plaintexts]
+
+    def decode(self, covertexts):
+        pool = get_pool()
+        return [pool.submit(_decode, self._engine, self._regex, self._fixed_slice, self._key, c)
+                for c in covertexts]
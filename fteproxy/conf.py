@@ -13,7 +13,14 @@ def getValue(key):
 
 
 def setValue(key, value):
+    global generation
     conf[key] = value
+    generation += 1
+
+
+# Counts the calls to setValue, so that fteproxy.settings can tell whether its
+# snapshot of conf is still current.
+generation = 0
 
 
 def we_are_frozen():
@@ -64,6 +71,17 @@ conf['runtime.mode'] = None
 conf['runtime.loglevel'] = 3
 
 
+"""The number of messages a second that each place in the code logs at most;
+the messages held back are counted on the next line it logs. 0 for no limit."""
+conf['runtime.log.rate_limit'] = 10
+
+
+"""The number of log lines that may wait to be written to stdout, beyond which
+further lines are dropped and counted rather than holding up the thread that
+logs them."""
+conf['runtime.log.queue_size'] = 10000
+
+
 """The maximum number of queued connections for sockets"""
 conf['runtime.fteproxy.relay.backlog'] = 100
 
@@ -91,10 +109,101 @@ conf['runtime.fteproxy.relay.socket_timeout'] = 30
 conf['runtime.fteproxy.relay.accept_timeout'] = 0.1
 
 
+"""The number of seconds a listener waits for a connection to its upstream
+(``remote_ip:remote_port``) to be established, before giving up on the tunnel."""
+conf['runtime.fteproxy.relay.connect_timeout'] = 10
+
+
+"""The maximum number of upstream connects a listener has in flight at once.
+Connections accepted beyond that wait for a connect to finish, while the
+listener keeps accepting."""
+conf['runtime.fteproxy.relay.connect_concurrency'] = 64
+
+
+"""The number of idle connections to its upstream (``runtime.proxy.ip:port``)
+that the server keeps established ahead of time, so that a new tunnel takes
+one instead of waiting for a connect, or 0 to connect for every tunnel."""
+conf['runtime.fteproxy.relay.upstream_pool.min_idle'] = 0
+
+
+"""The number of seconds after which an idle pooled upstream connection is
+replaced, before the upstream is likely to time it out."""
+conf['runtime.fteproxy.relay.upstream_pool.max_age'] = 60
+
+
+"""The number of seconds between checks that the idle pooled upstream
+connections are still open, and between attempts to connect while the
+upstream is unreachable."""
+conf['runtime.fteproxy.relay.upstream_pool.check_interval'] = 5
+
+
+"""Whether to carry tunnels as streams of one FTE connection. A client then
+connects to and negotiates with the server once, rather than once per tunnel;
+a server accepts such connections, along with ordinary ones from clients that
+do not multiplex."""
+conf['runtime.fteproxy.mux'] = False
+
+
+"""The largest number of bytes of one multiplexed stream that is sent before
+the other streams of its connection get a turn; at most 65535."""
+conf['runtime.fteproxy.mux.frame_size'] = 2**14
+
+
 """The default penalty after polling for network data, and not recieving anything."""
 conf['runtime.fteproxy.relay.throttle'] = 0.01
 
 
+"""The relay backend: ``threads`` relays each tunnel with a pair of
+``relay.worker`` threads, ``selectors`` relays every tunnel of a listener on a
+single readiness-driven ``relay.event_loop``."""
+conf['runtime.fteproxy.relay.backend'] = 'threads'
+
+
+"""With the ``threads`` backend, the number of tunnels relayed at once by a
+pool of pre-spawned thread pairs, or 0 to spawn a new pair of threads for
+every tunnel. Tunnels beyond the pool size wait for a free slot."""
+conf['runtime.fteproxy.relay.pool_size'] = 0
+
+
+"""The number of seconds a tunnel waits for a free ``relay.pool_size`` slot
+before it is closed."""
+conf['runtime.fteproxy.relay.queue_timeout'] = 10
+
+
+"""With the ``threads`` backend, the number of chunks of data that may be
+queued between reading, encoding and writing the data sent into a tunnel, or 0
+to encode and write each chunk on the reading thread. With a depth, a tunnel
+encodes on one thread and writes on another, so that encoding the next cell
+overlaps with transmitting the previous one."""
+conf['runtime.fteproxy.relay.pipeline_depth'] = 0
+
+
+"""The number of seconds for which the data sent into a tunnel is held back,
+so that a run of small writes is encoded into one FTE cell rather than one
+cell each, or 0 to encode every write as it comes.
+Held data is sent early once ``relay.coalesce_bytes`` bytes are held."""
+conf['runtime.fteproxy.relay.coalesce_window'] = 0
+
+
+"""The number of bytes held back by ``relay.coalesce_window`` at which they are
+sent without waiting for the rest of the window."""
+conf['runtime.fteproxy.relay.coalesce_bytes'] = 2 ** 12
+
+
+"""Whether listeners bind with SO_REUSEPORT, so that several worker processes
+can share one listening port."""
+conf['runtime.fteproxy.relay.reuse_port'] = False
+
+
+"""The number of worker processes, each running its own listener on the same
+port. With more than one, a supervisor process restarts workers that die."""
+conf['runtime.fteproxy.workers'] = 1
+
+
+"""Whether to pin each worker process to its own CPU."""
+conf['runtime.fteproxy.workers.cpu_affinity'] = False
+
+
 """The default timeout when establishing a new fteproxy socket."""
 conf['runtime.fteproxy.negotiate.timeout'] = 5
 
@@ -113,6 +222,59 @@ only ever as large as the data already available)."""
 conf['runtime.fteproxy.record_layer.max_cell_size'] = 2 ** 18
 
 
+"""Whether to size the cells of each connection adaptively, between
+``min_cell_size`` and ``max_cell_size``, rather than always filling cells up to
+``max_cell_size``: see ``fteproxy.record_layer.CellSizer``. Small cells let the
+peer decode the start of a large write sooner on a slow link, at the cost of
+more encodes per byte."""
+conf['runtime.fteproxy.record_layer.adaptive_cell_size'] = False
+
+
+"""The smallest cell, in bytes of plaintext, that adaptive cell sizing picks."""
+conf['runtime.fteproxy.record_layer.min_cell_size'] = 2 ** 14
+
+
+"""The time, in seconds, within which adaptive cell sizing aims to encode and
+write a cell of an interactive connection."""
+conf['runtime.fteproxy.record_layer.target_latency'] = 0.05
+
+
+"""The number of processes in the codec pool that encodes and decodes the
+cells of a stream in parallel, or 0 to encode and decode them in the relay
+thread itself. With a pool, the relay reads up to this many cells at a time,
+so that a bulk stream keeps every process of the pool busy."""
+conf['runtime.fteproxy.record_layer.codec_pool.workers'] = 0
+
+
+"""The most bytes that a connection holds received but not yet decoded, as
+``fteproxy.buffers`` limits it. It must fit the largest cell, with room to
+spare for reading the next one."""
+conf['runtime.fteproxy.buffers.max_connection'] = 2 ** 20
+
+
+"""The most bytes that a server holds of a client's data before the client's
+negotiation cell has been read."""
+conf['runtime.fteproxy.buffers.max_negotiation'] = 2 ** 16
+
+
+"""The most bytes of memory that the buffers limited by
+``buffers.max_connection`` and ``buffers.max_negotiation`` take up across every
+connection of a process, or 0 for no limit."""
+conf['runtime.fteproxy.buffers.budget'] = 2 ** 28
+
+
+"""What a connection does at a buffer limit: ``pause`` reads only what fits,
+and nothing while the budget is used up; ``close`` tears the connection down."""
+conf['runtime.fteproxy.buffers.policy'] = 'pause'
+
+
+"""The ``fteproxy.engines`` engine that cells are encoded and decoded with:
+``fte``, or ``identity`` to only frame the data, with neither encryption nor
+formatting, to measure the relay and the record layer on their own. Client and
+server must use the same engine."""
+conf['runtime.fteproxy.record_layer.engine'] = 'fte'
+
+
 """The default client-to-server language."""
 conf['runtime.state.upstream_language'] = 'manual-http-request'
 
@@ -121,6 +283,11 @@ conf['runtime.state.upstream_language'] = 'manual-http-request'
 conf['runtime.state.downstream_language'] = 'manual-http-response'
 
 
+"""A JSON file of settings that take effect without a restart, read at startup
+and again on SIGHUP, or None: see ``fteproxy.settings``."""
+conf['runtime.fteproxy.config_file'] = None
+
+
 """The default AE scheme key."""
 conf['runtime.fteproxy.encrypter.key'] = b'\xFF' * 16 + b'\x00' * 16
 
@@ -131,3 +298,21 @@ conf['fteproxy.default_fixed_slice'] = 2 ** 8
 
 """The default definitions file to use."""
 conf['fteproxy.defs.release'] = '20260110'
+
+
+"""The directory of the on-disk cache of compiled format tables, or None to
+compile every format in each process that uses it: see
+``fteproxy.format_cache``."""
+conf['fteproxy.format_cache.dir'] = None
+
+
+"""Whether a server loads only its configured upstream and downstream formats
+before it starts listening, and the other formats of the definitions release
+in the background, rather than all of them first."""
+conf['runtime.fteproxy.lazy_warmup'] = False
+
+
+"""A file that the server keeps updated with the progress of loading the
+formats of the definitions release, as ``warming N/TOTAL`` and finally
+``ready TOTAL/TOTAL``, or None for no such file."""
+conf['runtime.fteproxy.warmup.status_file'] = None
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Codec engines: what the record layer encodes cells with, and decodes them with.
+
+An ``engine`` hands out encoders for a format, given its regex, fixed slice
+and key, and reads the cells they make out of a stream of bytes. Encoders have
+the interface of ``fte.Encoder``: ``encode`` turns a plaintext into one cell,
+and ``decode`` turns the cell at the start of some bytes back into the
+plaintext, along with the bytes after it. Engines report a cell that cannot be
+decoded (yet) with the exceptions of ``fte.encoder`` and ``fte.encrypter``,
+which is what the record layer handles.
+
+``fte`` is the default engine, and the only one that disguises traffic.
+``identity`` only frames each plaintext with its length, and neither encrypts
+nor formats it: it is there to measure the relay and the record layer on their
+own, in benchmarks and tests. Other engines are made available with
+``register``, and picked by name, with ``runtime.fteproxy.record_layer.engine``
+or per listener. Both ends of a tunnel must use the same engine.
+"""
+
+import struct
+
+import fte.encoder
+import fte.encrypter
+import fte.bit_ops
+
+import fteproxy.conf
+import fteproxy.defs
+import fteproxy.format_cache
+import fteproxy.classifier
+
+
+class UnknownEngine(Exception):
+    pass
+
+
+class engine(object):
+
+    """The interface of a codec engine, called ``name``. Subclasses implement
+    ``get_encoder``, ``cell_length`` and ``decode_cell``.
+    """
+
+    name = None
+
+    def get_encoder(self, regex, fixed_slice, key=None):
+        """Return an encoder for the format of ``regex`` and ``fixed_slice``,
+        with the 32-byte ``key``, or the default key if ``None``. Encoders may
+        be shared between connections, so they must not keep state between
+        calls.
+        """
+        raise NotImplementedError
+
+    def cell_length(self, encoder, buffer, offset=0):
+        """Return the length of the cell that starts at ``offset`` in
+        ``buffer``, made by ``encoder``, without decoding the rest of the
+        cell. Returns ``None`` if that is not known yet, or cannot be.
+        """
+        raise NotImplementedError
+
+    def decode_cell(self, encoder, buffer, offset=0):
+        """Decode the cell at ``offset`` in ``buffer`` with ``encoder``.
+        Returns the message and the length of the cell, or ``None`` and the
+        length of the cell if it has not fully arrived yet. Raises
+        ``fte.encoder.DecodeFailureError`` if not even the length is known.
+        """
+        raise NotImplementedError
+
+    def candidates(self, data):
+        """Return the set of request languages that the first cell of a
+        connection starting with ``data`` may be in, for the server's
+        negotiation to try. By default, all of them.
+        """
+        return set(fteproxy.defs.load_definitions())
+
+
+class fte_engine(engine):
+
+    """Format-transforming encryption, with the encoders of
+    ``fteproxy.format_cache``.
+    """
+
+    name = 'fte'
+
+    def get_encoder(self, regex, fixed_slice, key=None):
+        return fteproxy.format_cache.get_encoder(regex, fixed_slice, key)
+
+    def cell_length(self, encoder, buffer, offset=0):
+        header = _readHeader(encoder, buffer, offset)
+        if header is None:
+            return None
+        return header[0]
+
+    def decode_cell(self, encoder, buffer, offset=0):
+        # What ``fte.Encoder.decode`` does, but ranking the cell's header only
+        # once, whether or not the cell is complete.
+        header = _readHeader(encoder, buffer, offset)
+        if header is None:
+            # Let fte report why the header could not be read.
+            msg, remaining = encoder.decode(buffer[offset:])
+            return [msg, len(buffer) - offset - len(remaining)]
+
+        [length, prefix] = header
+        if offset + length > len(buffer):
+            return [None, length]
+        dfa_encoder = encoder._encoder
+        ciphertext = prefix + buffer[offset + dfa_encoder._fixed_slice:offset + length]
+        return [dfa_encoder._encrypter.decrypt(ciphertext), length]
+
+    def candidates(self, data):
+        return fteproxy.classifier.candidates(data)
+
+
+def _readHeader(encoder, buffer, offset=0):
+    # The first ``fixed_slice`` bytes of a cell unrank to X: an encrypted
+    # 16-byte header carrying the length of the ciphertext prefix stored in X,
+    # followed by that prefix. The remainder of the ciphertext follows the
+    # ``fixed_slice`` bytes verbatim, and its total length is known from its
+    # first block.
+    #
+    # Returns [length, prefix], with ``length`` the length of the whole cell
+    # and ``prefix`` the ciphertext carried in X, or ``None`` if the header
+    # cannot be read (yet).
+    try:
+        dfa_encoder = encoder._encoder
+        fixed_slice = dfa_encoder._fixed_slice
+        encrypter = dfa_encoder._encrypter
+
+        if len(buffer) - offset < fixed_slice:
+            return None
+        rank = dfa_encoder._dfa.rank(buffer[offset:offset + fixed_slice])
+        X = fte.bit_ops.long_to_bytes(rank).rjust(dfa_encoder.getCapacity() // 8, b'\x00')
+        header = encrypter.decryptOneBlock(X[:16])
+        msg_len = fte.bit_ops.bytes_to_long(header[8:16])
+
+        prefix = X[16:16 + msg_len]
+        ciphertext = prefix + buffer[offset + fixed_slice:offset + fixed_slice + 16]
+        if len(ciphertext) < 16:
+            return None
+        return [fixed_slice + encrypter.getCiphertextLen(ciphertext) - len(prefix), prefix]
+    except Exception:
+        return None
+
+
+_HEADER = struct.Struct('>I')
+
+
+class identity_encoder(object):
+
+    """Cells of the ``identity`` engine: the plaintext, after its length as a
+    4-byte big-endian integer.
+    """
+
+    def encode(self, plaintext):
+        return _HEADER.pack(len(plaintext)) + plaintext
+
+    def decode(self, covertext):
+        if len(covertext) < _HEADER.size:
+            raise fte.encoder.DecodeFailureError('Covertext is shorter than a cell header')
+        length = _HEADER.size + _HEADER.unpack_from(covertext)[0]
+        if len(covertext) < length:
+            raise fte.encoder.DecodeFailureError('Covertext is shorter than its cell')
+        return [bytes(covertext[_HEADER.size:length]), covertext[length:]]
+
+
+class identity_engine(engine):
+
+    """Framing only: see ``identity_encoder``. Every format and key gets the
+    same encoder, and nothing is encrypted.
+    """
+
+    name = 'identity'
+
+    _encoder = identity_encoder()
+
+    def get_encoder(self, regex, fixed_slice, key=None):
+        return self._encoder
+
+    def cell_length(self, encoder, buffer, offset=0):
+        if len(buffer) - offset < _HEADER.size:
+            return None
+        return _HEADER.size + _HEADER.unpack_from(buffer, offset)[0]
+
+    def decode_cell(self, encoder, buffer, offset=0):
+        length = self.cell_length(encoder, buffer, offset)
+        if length is None:
+            raise fte.encoder.DecodeFailureError('Covertext is shorter than a cell header')
+        if offset + length > len(buffer):
+            return [None, length]
+        return [buffer[offset + _HEADER.size:offset + length], length]
+
+
+_engines = {}
+
+
+def register(engine):
+    """Make ``engine`` available by its ``name``, replacing any engine of the
+    same name. Pool workers of ``fteproxy.codec_pool`` only know the engines
+    registered when their modules are imported.
+    """
+    _engines[engine.name] = engine
+
+
+def get(name=None):
+    """Return the engine called ``name``, or the one named by
+    ``runtime.fteproxy.record_layer.engine`` if ``None``. Raises
+    ``UnknownEngine`` if there is no such engine.
+    """
+    if name is None:
+        name = fteproxy.conf.getValue('runtime.fteproxy.record_layer.engine')
+    try:
+        return _engines[name]
+    except KeyError:
+        raise UnknownEngine('No codec engine called ' + str(name)
+                            + '; choose from: ' + ', '.join(names()))
+
+
+def names():
+    """Return the names of the registered engines, in order."""
+    return sorted(_engines)
+
+
+register(fte_engine())
+register(identity_engine())
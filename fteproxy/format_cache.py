@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compiled format tables, shared within a process and cached on disk.
+
+An ``fte.Encoder`` compiles its regex to a DFA and builds the DFA's table of
+word counts, which takes milliseconds per format, every time a process starts.
+With ``fteproxy.format_cache.dir`` set, the compiled DFA and table of each
+format are written to a file in that directory the first time they are built,
+and later processes read them back instead. ``build`` fills the directory
+ahead of time, for every format of a definitions release, and ``warmup``
+loads them in the background of a process that is already serving.
+
+Files are kept in a subdirectory named after the fte version, the Python
+version and ``_VERSION``, so a cache is never read by a process that would
+build different tables, and named after a hash of the regex and fixed_slice.
+"""
+
+import os
+import sys
+import time
+import mmap
+import marshal
+import hashlib
+import tempfile
+import threading
+
+import fte
+import fte.dfa
+import fte.encoder
+import fte.encrypter
+import regex2dfa
+
+import fteproxy
+import fteproxy.conf
+import fteproxy.defs
+
+
+# The version of the file layout below; bump it when the layout changes.
+_VERSION = 1
+
+# fte.dfa.DFA instances, keyed by (regex, fixed_slice), and fte.Encoder
+# instances, keyed by (regex, fixed_slice, key). With a cache directory, the
+# encoders are built around the DFAs; without one, fte builds each encoder
+# itself, and the DFA of the first one is kept for ``get_dfa``.
+_dfas = {}
+_encoders = {}
+_lock = threading.Lock()
+
+# A lock per format being loaded, so that a thread needing a format waits for
+# that format only, rather than for every format being loaded.
+_loading = {}
+
+
+def get_encoder(regex, fixed_slice, key=None):
+    """Return an ``fte.Encoder`` for ``regex``, ``fixed_slice`` and ``key``.
+    With a cache directory, it is built around the format's DFA from memory,
+    from the directory, or compiled as a last resort; without one, it is
+    ``fte.Encoder(regex, fixed_slice, key)``. Encoders are shared: like those
+    ``fte`` caches itself, they hold no state between calls.
+    """
+    if directory() is None:
+        return _getEncoder(regex, fixed_slice, key)
+
+    with _lock:
+        encoder = _encoders.get((regex, fixed_slice, key))
+        if encoder is not None:
+            return encoder
+        dfa = _dfas.get((regex, fixed_slice))
+        if dfa is None:
+            loading = _loading.setdefault((regex, fixed_slice), threading.Lock())
+
+    if dfa is None:
+        with loading:
+            with _lock:
+                dfa = _dfas.get((regex, fixed_slice))
+            if dfa is None:
+                dfa = _loadDfa(regex, fixed_slice)
+                with _lock:
+                    _dfas[(regex, fixed_slice)] = dfa
+                    _loading.pop((regex, fixed_slice), None)
+
+    with _lock:
+        encoder = _encoders.get((regex, fixed_slice, key))
+        if encoder is None:
+            encoder = _newEncoder(regex, fixed_slice, key, dfa)
+            _encoders[(regex, fixed_slice, key)] = encoder
+    return encoder
+
+
+def get_dfa(regex, fixed_slice):
+    """Return the ``fte.dfa.DFA`` of the format, which is the same whatever
+    the key, loading the format first if it is not loaded yet.
+    """
+    with _lock:
+        dfa = _dfas.get((regex, fixed_slice))
+    if dfa is None:
+        get_encoder(regex, fixed_slice)
+        with _lock:
+            dfa = _dfas[(regex, fixed_slice)]
+    return dfa
+
+
+def _getEncoder(regex, fixed_slice, key):
+    # Without a cache directory. fte compiles the format for every key, so
+    # each encoder is built under the format's lock, and only once.
+    with _lock:
+        encoder = _encoders.get((regex, fixed_slice, key))
+        if encoder is not None:
+            return encoder
+        loading = _loading.setdefault((regex, fixed_slice), threading.Lock())
+
+    with loading:
+        with _lock:
+            encoder = _encoders.get((regex, fixed_slice, key))
+        if encoder is None:
+            encoder = fte.Encoder(regex, fixed_slice, key)
+            with _lock:
+                _encoders[(regex, fixed_slice, key)] = encoder
+                _dfas.setdefault((regex, fixed_slice), encoder._encoder._dfa)
+                _loading.pop((regex, fixed_slice), None)
+    return encoder
+
+
+def is_loaded(regex, fixed_slice):
+    """Whether the tables of the format are in memory, so that ``get_dfa``
+    returns without compiling or reading them, as does ``get_encoder`` with a
+    cache directory.
+    """
+    with _lock:
+        return (regex, fixed_slice) in _dfas
+
+
+def directory():
+    """Return the versioned subdirectory of ``fteproxy.format_cache.dir`` that
+    this process reads and writes, or None if there is no cache directory.
+    """
+    cache_dir = fteproxy.conf.getValue('fteproxy.format_cache.dir')
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, 'fte-%s-py%d%d-v%d' % (
+        fte.__version__, sys.version_info[0], sys.version_info[1], _VERSION))
+
+
+def build(languages):
+    """Compile every language in ``languages`` into the cache directory, and
+    return the number of formats whose tables were written rather than found.
+    """
+    written = 0
+    for language in languages:
+        regex = fteproxy.defs.getRegex(language)
+        fixed_slice = fteproxy.defs.getFixedSlice(language)
+        if _readDfa(regex, fixed_slice) is None:
+            _writeDfa(regex, fixed_slice, _compileDfa(regex, fixed_slice))
+            written += 1
+    return written
+
+
+class warmup(threading.Thread):
+
+    """``fteproxy.format_cache.warmup`` loads the formats of ``languages`` in
+    the background, in order, so that a process can serve its configured
+    formats while the rest are still being compiled. A connection that needs a
+    format before its turn loads it itself. ``progress`` tells how far the
+    warm-up is; if ``status_file`` is given, it is rewritten after every
+    format with ``warming N/TOTAL``, and finally ``ready TOTAL/TOTAL``, for
+    orchestrators to check readiness against.
+
+    Formats are loaded one at a time: compiling them is pure Python, which
+    threads would not run in parallel, and a process pool takes longer to
+    start than compiling every format of a release.
+    """
+
+    def __init__(self, languages, key=None, status_file=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._languages = list(languages)
+        self._key = key
+        self._status_file = status_file
+        self._done = 0
+
+    def run(self):
+        start = time.time()
+        self._writeStatus()
+        for language in self._languages:
+            get_encoder(fteproxy.defs.getRegex(language),
+                        fteproxy.defs.getFixedSlice(language), self._key)
+            self._done += 1
+            self._writeStatus()
+        fteproxy.info('Loaded %d formats in %.2f seconds',
+                      self._done, time.time() - start)
+
+    def progress(self):
+        """Return the number of ``languages`` loaded, and their total."""
+        return [self._done, len(self._languages)]
+
+    @property
+    def ready(self):
+        return self._done == len(self._languages)
+
+    def _writeStatus(self):
+        if self._status_file is None:
+            return
+        write_status(self._status_file, self._done, len(self._languages))
+
+
+def write_status(status_file, done, total):
+    """Write the warm-up status ``done`` of ``total`` to ``status_file``,
+    replacing it in one step so that readers never see a partial line.
+    """
+    state = 'ready' if done == total else 'warming'
+    tmp_path = status_file + '.tmp'
+    try:
+        with open(tmp_path, 'w') as fh:
+            fh.write('%s %d/%d\n' % (state, done, total))
+        os.replace(tmp_path, status_file)
+    except (IOError, OSError) as e:
+        fteproxy.warn('Failed to write warm-up status to %s: %s', status_file, e)
+
+
+def _path(regex, fixed_slice):
+    name = hashlib.sha256(('%s\0%d' % (regex, fixed_slice)).encode('utf-8')).hexdigest()
+    return os.path.join(directory(), name)
+
+
+def _loadDfa(regex, fixed_slice):
+    dfa = _readDfa(regex, fixed_slice)
+    if dfa is None:
+        dfa = _compileDfa(regex, fixed_slice)
+        _writeDfa(regex, fixed_slice, dfa)
+    return dfa
+
+
+def _compileDfa(regex, fixed_slice):
+    return fte.dfa.DFA(regex2dfa.regex2dfa(regex), fixed_slice)
+
+
+def _readDfa(regex, fixed_slice):
+    # The file is mapped rather than read, so that its pages stay in the page
+    # cache, which processes on the host share; each process still builds its
+    # own copy of the tables from them.
+    try:
+        with open(_path(regex, fixed_slice), 'rb') as fh:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                [cached_regex, cached_fixed_slice, state] = marshal.loads(mapped)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        fteproxy.warn('Ignoring unreadable format cache file for %s: %s', regex, e)
+        return None
+    if (cached_regex, cached_fixed_slice) != (regex, fixed_slice):
+        return None
+    if not isinstance(state, dict):
+        fteproxy.warn('Ignoring malformed format cache file for %s', regex)
+        return None
+
+    dfa = fte.dfa.DFA.__new__(fte.dfa.DFA)
+    dfa.__dict__.update(state)
+    return dfa
+
+
+def _writeDfa(regex, fixed_slice, dfa):
+    # Written to a temporary file and renamed into place, so that processes
+    # reading the cache never see a partial file.
+    tmp_path = None
+    try:
+        os.makedirs(directory(), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory())
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(marshal.dumps([regex, fixed_slice, vars(dfa)]))
+        os.replace(tmp_path, _path(regex, fixed_slice))
+    except (IOError, OSError) as e:
+        fteproxy.warn('Failed to write format cache file for %s: %s', regex, e)
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def _newEncoder(regex, fixed_slice, key, dfa):
+    # What fte.Encoder(regex, fixed_slice, key) builds, but around ``dfa``
+    # instead of compiling it again. This relies on fte's internals, so it is
+    # only used for DFAs from the cache directory.
+    if key is not None and len(key) != 32:
+        raise ValueError('Key must be exactly 32 bytes (16 for encryption + 16 for MAC)')
+    K1, K2 = (key[:16], key[16:]) if key is not None else (None, None)
+
+    dfa_encoder = fte.encoder.DfaEncoderObject.__new__(fte.encoder.DfaEncoderObject)
+    dfa_encoder._fixed_slice = fixed_slice
+    dfa_encoder._dfa = dfa
+    dfa_encoder._encrypter = fte.encrypter.Encrypter(K1, K2)
+
+    encoder = fte.Encoder.__new__(fte.Encoder)
+    encoder.regex = regex
+    encoder.fixed_slice = fixed_slice
+    encoder._encoder = dfa_encoder
+    return encoder
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+The log behind ``fteproxy.info``, ``fteproxy.warn`` and
+``fteproxy.fatal_error``.
+
+A message is only formatted if its level is enabled by ``runtime.loglevel``,
+from a format string and arguments, like ``logging``'s. Each call site logs
+at most ``runtime.log.rate_limit`` messages a second, and says how many it
+held back once it logs again, so a failure repeated on every read of a busy
+relay costs a counter increment. Lines are written by a background thread
+from a bounded queue: a thread that logs never waits for stdout, and lines
+beyond ``runtime.log.queue_size`` are dropped and counted rather than queued.
+"""
+
+import os
+import sys
+import time
+import queue
+import atexit
+import threading
+
+import fteproxy.conf
+
+
+ERROR = 1
+WARN = 2
+INFO = 3
+
+_PREFIXES = {ERROR: 'ERROR:', WARN: 'WARN:', INFO: 'INFO:'}
+
+# Per call site, keyed by (code, line): [second, messages logged in it,
+# messages held back since the last one logged].
+_sites = {}
+_sites_lock = threading.Lock()
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def enabled(level):
+    """Whether messages of ``level`` are logged."""
+    return 0 < level <= fteproxy.conf.getValue('runtime.loglevel')
+
+
+def log(level, msg, args=(), depth=1):
+    """Log ``msg % args`` at ``level``, for the call site ``depth`` frames up
+    from the caller.
+    """
+    if not enabled(level):
+        return
+
+    frame = sys._getframe(depth + 1)
+    held_back = _count((frame.f_code, frame.f_lineno))
+    if held_back is None:
+        return
+
+    line = _PREFIXES[level] + ' ' + (msg % args if args else str(msg))
+    if held_back:
+        line += ' (%d more like this held back)' % held_back
+    _getWriter().write(line)
+
+
+def error(msg, args=()):
+    """Log ``msg % args`` as an error right away, after the lines already
+    queued, since the process is about to exit.
+    """
+    if not enabled(ERROR):
+        return
+    flush()
+    print(_PREFIXES[ERROR], msg % args if args else msg)
+    sys.stdout.flush()
+
+
+def flush(timeout=1.0):
+    """Wait up to ``timeout`` seconds for the queued lines to be written."""
+    writer = _writer
+    if writer is not None and writer.pid == os.getpid():
+        writer.flush(timeout)
+
+
+def _count(site):
+    # Returns None if the site is over its rate, or else the number of its
+    # messages held back since it last logged.
+    rate_limit = fteproxy.conf.getValue('runtime.log.rate_limit')
+    now = int(time.monotonic())
+    with _sites_lock:
+        state = _sites.get(site)
+        if state is None:
+            state = _sites[site] = [now, 0, 0]
+        if state[0] != now:
+            state[0] = now
+            state[1] = 0
+        if rate_limit and state[1] >= rate_limit:
+            state[2] += 1
+            return None
+        state[1] += 1
+        held_back = state[2]
+        state[2] = 0
+        return held_back
+
+
+def _getWriter():
+    # A forked process gets a writer of its own: the parent's thread did not
+    # survive the fork.
+    global _writer
+
+    writer = _writer
+    if writer is None or writer.pid != os.getpid():
+        with _writer_lock:
+            if _writer is None or _writer.pid != os.getpid():
+                _writer = _lineWriter(fteproxy.conf.getValue('runtime.log.queue_size'))
+            writer = _writer
+    return writer
+
+
+class _lineWriter(object):
+
+    def __init__(self, queue_size):
+        self.pid = os.getpid()
+        self._queue = queue.Queue(queue_size)
+        self._dropped = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, line):
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self._dropped += 1
+
+    def flush(self, timeout):
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def _run(self):
+        while True:
+            line = self._queue.get()
+            try:
+                if self._dropped:
+                    dropped, self._dropped = self._dropped, 0
+                    line += ' (%d log lines dropped)' % dropped
+                sys.stdout.write(line + '\n')
+                if self._queue.empty():
+                    sys.stdout.flush()
+            except Exception:
+                pass
+            finally:
+                self._queue.task_done()
+
+
+atexit.register(flush)
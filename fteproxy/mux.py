@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Stream multiplexing: many tunnels carried as streams of one negotiated FTE
+connection, so that a short-lived application connection does not pay for a
+TCP handshake and an FTE negotiation of its own.
+
+Inside the FTE connection the data is a sequence of frames, each a header of
+stream id, frame type and payload length, followed by the payload. The client
+opens streams with ``_OPEN``; either side sends ``_DATA`` and, once its end of
+a stream has nothing more to send, ``_CLOSE``. A side never has more than
+``_WINDOW`` bytes of a stream in flight that the other side has not yet
+handed on: the receiver grants more with ``_CREDIT`` frames as it delivers
+data, so a stream whose reader is slow stops without holding up the others.
+"""
+
+import time
+import socket
+import struct
+import selectors
+import threading
+
+import fteproxy
+import fteproxy.conf
+import fteproxy.buffers
+import fteproxy.network_io
+
+
+_HEADER = struct.Struct('!IBH')
+_CREDIT_PAYLOAD = struct.Struct('!I')
+
+_OPEN = 0
+_DATA = 1
+_CLOSE = 2
+_CREDIT = 3
+
+# The bytes of a stream that may be in flight before the receiver grants
+# more. Part of the protocol: both sides assume it for every new stream.
+_WINDOW = 2 ** 18
+
+# Credit is granted back once this many bytes have been delivered, rather
+# than a frame per read.
+_GRANT_THRESHOLD = _WINDOW // 4
+
+
+def is_stream(sock):
+    """Whether ``sock`` is the relay's end of a stream of a ``session``."""
+    return getattr(sock, 'family', None) == socket.AF_UNIX
+
+
+def _frame(stream_id, kind, payload=b''):
+    return _HEADER.pack(stream_id, kind, len(payload)) + payload
+
+
+class _stream(object):
+
+    def __init__(self, stream_id, inner):
+        self.id = stream_id
+        # The session's end of the socket pair; the relay has the other.
+        self.inner = inner
+        # Data from the peer not yet written to ``inner``.
+        self.inbound = bytearray()
+        # Bytes that may still be sent to the peer, and bytes delivered from
+        # it that have not been granted back yet.
+        self.credit = _WINDOW
+        self.granted = 0
+        # Whether ``inner`` reached EOF (and ``_CLOSE`` was sent), and whether
+        # the peer sent ``_CLOSE``.
+        self.local_closed = False
+        self.peer_closed = False
+        self.shut = False
+        self.events = 0
+
+
+class session(object):
+
+    """``fteproxy.mux.session`` carries streams over ``tunnel``, an fteproxy
+    socket whose negotiation is complete. Each stream is handed out as one end
+    of a local socket pair, so that it can be relayed like any other socket.
+    On a client, ``open_stream`` starts a new stream. On a server,
+    ``on_open`` is called with each stream the client opens; it must not
+    block, as frames of every stream are read on the same thread.
+
+    The session writes the frames of all its streams on one thread. Each
+    round, every stream with data and credit gets to send at most
+    ``runtime.fteproxy.mux.frame_size`` bytes, and the frames of the round are
+    sent together, so a bulk stream cannot starve an interactive one and small
+    writes of several streams share cells.
+    """
+
+    def __init__(self, tunnel, on_open=None):
+        self._tunnel = tunnel
+        self._on_open = on_open
+        self._frame_size = fteproxy.conf.getValue('runtime.fteproxy.mux.frame_size')
+        self._bufsize = fteproxy.conf.getValue('runtime.fteproxy.record_layer.max_cell_size')
+        self._streams = {}
+        self._next_id = 1
+        # Frames queued by other threads, for the writer thread to send.
+        self._control = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        self._reader = threading.Thread(target=self._readLoop)
+        self._reader.daemon = True
+        self._writer = threading.Thread(target=self._writeLoop)
+        self._writer.daemon = True
+
+    def start(self):
+        self._tunnel.settimeout(None)
+        self._reader.start()
+        self._writer.start()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def open_stream(self):
+        """Open a new stream to the server and return the socket that
+        carries it.
+        """
+        with self._lock:
+            if self._closed:
+                raise socket.error('fteproxy.mux.session is closed')
+            stream_id = self._next_id
+            self._next_id += 1
+            outer = self._addStream(stream_id)
+            self._control.append(_frame(stream_id, _OPEN))
+        self._wakeup()
+        return outer
+
+    def close(self):
+        """Close the tunnel and every stream carried over it."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            streams = list(self._streams.values())
+            self._streams.clear()
+        for stream in streams:
+            fteproxy.network_io.close_socket(stream.inner)
+        # Shut the tunnel down first: closing it alone would leave the reader
+        # thread blocked in ``recv``, and the peer unaware.
+        try:
+            self._tunnel.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        fteproxy.network_io.close_socket(self._tunnel)
+        self._wakeup()
+
+    def _addStream(self, stream_id):
+        inner, outer = socket.socketpair()
+        inner.setblocking(False)
+        self._streams[stream_id] = _stream(stream_id, inner)
+        return outer
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b'\x00')
+        except socket.error:
+            pass
+
+    def _readLoop(self):
+        buffer = bytearray()
+        try:
+            while not self._closed:
+                try:
+                    data = self._tunnel.recv(self._bufsize)
+                except fteproxy.buffers.BufferFull:
+                    time.sleep(fteproxy.conf.getValue('runtime.fteproxy.relay.throttle'))
+                    continue
+                if not data:
+                    break
+                buffer += data
+
+                offset = 0
+                while len(buffer) - offset >= _HEADER.size:
+                    stream_id, kind, length = _HEADER.unpack_from(buffer, offset)
+                    end = offset + _HEADER.size + length
+                    if len(buffer) < end:
+                        break
+                    self._dispatch(stream_id, kind,
+                                   bytes(buffer[offset + _HEADER.size:end]))
+                    offset = end
+                del buffer[:offset]
+        except Exception as e:
+            if not self._closed:
+                fteproxy.info('fteproxy.mux.session read failed: %s', e)
+        finally:
+            self.close()
+
+    def _dispatch(self, stream_id, kind, payload):
+        outer = None
+        with self._lock:
+            stream = self._streams.get(stream_id)
+            if kind == _OPEN:
+                if stream is None and self._on_open is not None:
+                    outer = self._addStream(stream_id)
+            elif stream is None:
+                # A stream this side has already finished with.
+                return
+            elif kind == _DATA:
+                if len(stream.inbound) + len(payload) > _WINDOW:
+                    # The peer sent more than it had credit for.
+                    fteproxy.buffers.counters['mux_window_closed'] += 1
+                    raise ValueError('stream ' + str(stream_id) + ' overran its window')
+                stream.inbound += payload
+            elif kind == _CLOSE:
+                stream.peer_closed = True
+            elif kind == _CREDIT:
+                stream.credit += _CREDIT_PAYLOAD.unpack(payload)[0]
+            else:
+                raise ValueError('unknown frame type ' + str(kind))
+        if outer is not None:
+            self._on_open(outer)
+        self._wakeup()
+
+    def _writeLoop(self):
+        try:
+            while not self._closed:
+                self._updateEvents()
+                frames = []
+                readable = []
+                for key, mask in self._selector.select():
+                    if key.data is None:
+                        try:
+                            while self._wakeup_r.recv(4096):
+                                pass
+                        except (BlockingIOError, InterruptedError):
+                            pass
+                        continue
+                    if mask & selectors.EVENT_WRITE:
+                        self._deliver(key.data, frames)
+                    if mask & selectors.EVENT_READ:
+                        readable.append(key.data)
+
+                # Take a frame from each readable stream in turn, for as long
+                # as they have more, until the round fills a cell.
+                numbytes = 0
+                while readable and numbytes < self._bufsize:
+                    readable = [stream for stream in readable
+                                if self._forward(stream, frames)]
+                    numbytes = sum(len(frame) for frame in frames)
+
+                with self._lock:
+                    frames = self._control + frames
+                    self._control = []
+                if frames:
+                    self._tunnel.sendall(b''.join(frames))
+        except Exception as e:
+            if not self._closed:
+                fteproxy.info('fteproxy.mux.session write failed: %s', e)
+        finally:
+            self.close()
+            self._selector.close()
+            fteproxy.network_io.close_socket(self._wakeup_r)
+            fteproxy.network_io.close_socket(self._wakeup_w)
+
+    def _updateEvents(self):
+        # Read a stream while it has credit, and write to it while the peer's
+        # data is waiting; streams with neither are left out of the select.
+        with self._lock:
+            streams = list(self._streams.values())
+        for stream in streams:
+            with self._lock:
+                events = 0
+                if not stream.local_closed and stream.credit > 0:
+                    events |= selectors.EVENT_READ
+                if stream.inbound:
+                    events |= selectors.EVENT_WRITE
+                elif stream.peer_closed and not stream.shut:
+                    self._shutdown(stream)
+            if events == stream.events:
+                continue
+            if stream.events == 0:
+                self._selector.register(stream.inner, events, stream)
+            elif events == 0:
+                self._selector.unregister(stream.inner)
+            else:
+                self._selector.modify(stream.inner, events, stream)
+            stream.events = events
+
+    def _forward(self, stream, frames):
+        # Returns whether the stream may have more to send right away.
+        with self._lock:
+            numbytes = min(stream.credit, self._frame_size)
+        if numbytes <= 0:
+            return False
+        try:
+            data = stream.inner.recv(numbytes)
+        except (BlockingIOError, InterruptedError):
+            return False
+        except socket.error:
+            data = b''
+
+        with self._lock:
+            if data:
+                stream.credit -= len(data)
+                frames.append(_frame(stream.id, _DATA, data))
+                return len(data) == numbytes
+            stream.local_closed = True
+            frames.append(_frame(stream.id, _CLOSE))
+            self._finish(stream)
+            return False
+
+    def _deliver(self, stream, frames):
+        with self._lock:
+            try:
+                numbytes = stream.inner.send(stream.inbound)
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket.error:
+                # The relay closed its end; the rest of the stream is dropped.
+                stream.inbound = bytearray()
+                if not stream.local_closed:
+                    stream.local_closed = True
+                    frames.append(_frame(stream.id, _CLOSE))
+                self._finish(stream)
+                return
+            del stream.inbound[:numbytes]
+            stream.granted += numbytes
+            if stream.granted >= _GRANT_THRESHOLD and not stream.peer_closed:
+                frames.append(_frame(stream.id, _CREDIT,
+                                     _CREDIT_PAYLOAD.pack(stream.granted)))
+                stream.granted = 0
+
+    def _shutdown(self, stream):
+        # Everything the peer sent was delivered: pass its EOF on.
+        stream.shut = True
+        try:
+            stream.inner.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+        self._finish(stream)
+
+    def _finish(self, stream):
+        # Called with the lock held.
+        if stream.local_closed and stream.peer_closed and not stream.inbound:
+            if stream.events:
+                self._selector.unregister(stream.inner)
+                stream.events = 0
+            fteproxy.network_io.close_socket(stream.inner)
+            self._streams.pop(stream.id, None)
@@ -28,7 +28,11 @@ def recvall_from_socket(sock,
     is_alive = False
 
     try:
-        ready = select.select([sock], [], [sock], select_timeout)
+        pending = getattr(sock, 'pending', None)
+        if pending is not None and pending():
+            ready = [[sock]]
+        else:
+            ready = select.select([sock], [], [sock], select_timeout)
         if ready[0]:
             _data = sock.recv(bufsize)
             if _data:
@@ -51,6 +55,32 @@ def recvall_from_socket(sock,
     return [is_alive, retval]
 
 
+def encode_for_socket(sock, data):
+    """Given a socket ``sock`` returns ``data`` as it must appear on the wire
+    of ``sock``. For an fteproxy socket this is the FTE-encoded covertext, for
+    a plain socket it is ``data`` unmodified.
+    """
+
+    encode = getattr(sock, 'encode', None)
+    if encode is None:
+        return data
+    return encode(data)
+
+
+def send_some_to_socket(sock, data):
+    """Given a non-blocking socket ``sock`` writes as much of ``data``, as
+    returned by ``encode_for_socket``, as the socket accepts without blocking.
+    The return value is the number of bytes written, which is 0 if ``sock``
+    is not ready for writing.
+    """
+
+    send = getattr(sock, 'send_encoded', None) or sock.send
+    try:
+        return send(data)
+    except (BlockingIOError, InterruptedError):
+        return 0
+
+
 def close_socket(sock, lock=None):
     """Given socket ``sock`` closes the socket for reading and writing.
     If the optional ``lock`` parameter is provided, protects all accesses
@@ -3,50 +3,320 @@
 
 
 
+import time
+import functools
+import collections
+
 import fte.encoder
+import fte.encrypter
 
 import fteproxy.conf
+import fteproxy.engines
 
 
 MAX_CELL_SIZE = fteproxy.conf.getValue('runtime.fteproxy.record_layer.max_cell_size')
 
 
+# Buffers allocated by the record layer, copies of payload data it made on the
+# way between the socket and fte, and decodes that failed (mostly on cells that
+# had not fully arrived), for benchmark.py. Not locked: updates from concurrent
+# streams may occasionally be lost.
+counters = {'allocations': 0, 'copies': 0, 'bytes_copied': 0, 'failed_decodes': 0}
+
+
+def reset_counters():
+    for key in counters:
+        counters[key] = 0
+
+
+def _countCopy(numbytes):
+    counters['copies'] += 1
+    counters['bytes_copied'] += numbytes
+
+
+class RingBuffer(object):
+
+    """A FIFO of bytes on a growable ``bytearray``. Data is written at the
+    tail, either copied in by ``write`` or received in place through the view
+    returned by ``reserve``, and read at the head through ``memoryview``s, so
+    that neither end is ever cut off with a copy of the rest.
+
+    Rather than wrapping around, the unread bytes are moved back to the front
+    of the array once the tail reaches its end, which keeps the readable bytes
+    contiguous, as fte needs them. The array is only reallocated, to twice its
+    size, if the unread bytes do not fit. Once emptied, an array that grew
+    goes back to ``capacity`` bytes, so that an idle connection does not keep
+    the room its largest cell needed.
+    """
+
+    def __init__(self, capacity=2 ** 14):
+        self.capacity = capacity
+        self._data = bytearray(capacity)
+        self._head = 0
+        self._tail = 0
+        counters['allocations'] += 1
+
+    def __len__(self):
+        return self._tail - self._head
+
+    def __bytes__(self):
+        return self.read(len(self))
+
+    def allocated(self):
+        """The size of the array, which the unread bytes take up in memory."""
+        return len(self._data)
+
+    def _makeRoom(self, numbytes):
+        if len(self._data) - self._tail >= numbytes:
+            return
+
+        unread = len(self)
+        if unread + numbytes <= len(self._data):
+            self._data[:unread] = self._data[self._head:self._tail]
+        else:
+            # A new array rather than a resize: views handed out by ``peek``
+            # and ``reserve`` keep the old one alive.
+            data = bytearray(max(2 * len(self._data), unread + numbytes))
+            data[:unread] = self._data[self._head:self._tail]
+            self._data = data
+            counters['allocations'] += 1
+        _countCopy(unread)
+        self._head = 0
+        self._tail = unread
+
+    def reserve(self, numbytes):
+        """Return a writable view of ``numbytes`` bytes at the tail, to be
+        filled by, e.g., ``socket.recv_into`` and then added with ``commit``.
+        """
+        self._makeRoom(numbytes)
+        return memoryview(self._data)[self._tail:self._tail + numbytes]
+
+    def commit(self, numbytes):
+        """Add the first ``numbytes`` bytes of the view returned by ``reserve``."""
+        self._tail += numbytes
+
+    def write(self, data):
+        """Append a copy of ``data``."""
+        numbytes = len(data)
+        self.reserve(numbytes)[:] = data
+        self.commit(numbytes)
+        _countCopy(numbytes)
+
+    def peek(self):
+        """Return a read-only view of the unread bytes, valid until the next
+        ``write`` or ``reserve``.
+        """
+        return memoryview(self._data)[self._head:self._tail].toreadonly()
+
+    def read(self, numbytes):
+        """Return a copy of the first ``numbytes`` unread bytes, without
+        consuming them.
+        """
+        data = bytes(memoryview(self._data)[self._head:self._head + numbytes])
+        _countCopy(len(data))
+        return data
+
+    def consume(self, numbytes):
+        """Drop the first ``numbytes`` unread bytes."""
+        self._head += numbytes
+        if self._head == self._tail:
+            self._head = 0
+            self._tail = 0
+            if len(self._data) > self.capacity:
+                self._data = bytearray(self.capacity)
+                counters['allocations'] += 1
+
+
+def cell_length(decoder, buffer, offset=0):
+    """Return the length of the FTE cell that starts at ``offset`` in
+    ``buffer``, as read from the cell's header with ``decoder`` (an
+    ``fte.Encoder``), without decoding the rest of the cell. Returns ``None``
+    if the header has not fully arrived yet, or cannot be read. Cells of
+    other engines are read with ``fteproxy.engines.engine.cell_length``.
+    """
+    return fteproxy.engines.get('fte').cell_length(decoder, buffer, offset)
+
+
+class CellSizer(object):
+
+    """``CellSizer`` picks the plaintext size of the cells of one connection,
+    between ``min_size`` and ``max_size`` bytes, from how fast the connection
+    encodes and drains data and how the application writes it.
+
+    Large cells amortize the fixed cost of an FTE encode, but the peer can only
+    decode a cell once all of it has arrived. A connection whose writes come
+    back to back and fill whole cells is a bulk transfer, and switches to
+    ``max_size`` cells. Otherwise the cell size halves, at most once per write,
+    toward the cell that the connection encodes and writes within
+    ``target_latency`` seconds at the rate measured so far. Writes smaller than
+    ``min_size`` are dominated by fixed costs, and do not count toward that
+    rate; a connection starts out with ``min_size`` cells, so that the first
+    write of a slow connection is not stuck behind one large cell.
+    """
+
+    # Weight of the newest sample in the moving average of each rate.
+    _ALPHA = 0.25
+
+    def __init__(self, min_size, max_size, target_latency):
+        self._min_size = min_size
+        self._max_size = max_size
+        self._target_latency = target_latency
+        self.cell_size = min_size
+        self._encode_rate = None
+        self._write_rate = None
+        self._last_end = None
+
+    def _average(self, average, numbytes, seconds):
+        if numbytes < self._min_size or seconds <= 0:
+            return average
+        if average is None:
+            return numbytes / seconds
+        return average + self._ALPHA * (numbytes / seconds - average)
+
+    def rate(self):
+        """The measured rate, in bytes per second, at which data is encoded
+        and then written, or ``None`` before anything was measured.
+        """
+        if self._encode_rate is None:
+            return None
+        if self._write_rate is None:
+            return self._encode_rate
+        return 1.0 / (1.0 / self._encode_rate + 1.0 / self._write_rate)
+
+    def encoded(self, numbytes, seconds, start=None):
+        """Report that ``numbytes`` of plaintext took ``seconds`` to encode,
+        starting at ``start`` (by ``time.monotonic``), or ``seconds`` ago.
+        """
+        end = time.monotonic()
+        if start is None:
+            start = end - seconds
+        idle = None if self._last_end is None else start - self._last_end
+        self._last_end = end
+        self._encode_rate = self._average(self._encode_rate, numbytes, seconds)
+
+        if idle is not None and idle < seconds and numbytes >= self.cell_size:
+            self.cell_size = self._max_size
+        elif self.rate() is not None:
+            target = max(self._min_size, int(self.rate() * self._target_latency))
+            if target > self.cell_size:
+                self.cell_size = min(self._max_size, target)
+            else:
+                self.cell_size = max(target, self.cell_size // 2)
+
+    def written(self, numbytes, seconds):
+        """Report that ``numbytes`` of covertext took ``seconds`` to write."""
+        self._last_end = time.monotonic()
+        self._write_rate = self._average(self._write_rate, numbytes, seconds)
+
+
 class Encoder:
 
     def __init__(
         self,
         encoder,
+        codec=None,
+        sizer=None,
     ):
         self._encoder = encoder
-        self._buffer = b''
+        self._codec = codec
+        self._sizer = sizer
+        # The pushed chunks themselves, unjoined: each cell is assembled from
+        # ``memoryview`` slices of them with a single copy, or none at all if
+        # a chunk makes up a whole cell by itself.
+        self._chunks = collections.deque()
 
     def push(self, data):
         """Push data onto the FIFO buffer."""
         if isinstance(data, str):
             data = data.encode('utf-8')
-        self._buffer += data
+        elif not isinstance(data, bytes):
+            # Keep our own copy of mutable data.
+            data = bytes(data)
+            _countCopy(len(data))
+        if data:
+            self._chunks.append(data)
+
+    def _plaintexts(self, cell_size):
+        # Split the pushed chunks into ``cell_size`` plaintexts.
+        plaintexts = []
+        pieces = []
+        room = cell_size
+        for chunk in self._chunks:
+            view = memoryview(chunk)
+            while view:
+                piece = view[:room]
+                pieces.append(piece)
+                view = view[len(piece):]
+                room -= len(piece)
+                if room == 0:
+                    plaintexts.append(_join(pieces))
+                    pieces = []
+                    room = cell_size
+        if pieces:
+            plaintexts.append(_join(pieces))
+
+        self._chunks.clear()
+        return plaintexts
 
     def pop(self):
         """Pop data off the FIFO buffer. We pop at most
         ``runtime.fteproxy.record_layer.max_cell_size``
         bytes. The returned value is encrypted and encoded
         with ``encoder`` specified in ``__init__``.
+
+        If a ``codec`` (an ``fteproxy.codec_pool.codec``) was given, and there
+        is more than one cell to encode, the cells are encoded in parallel on
+        its process pool and joined in their original order.
+
+        If a ``sizer`` (a ``CellSizer``) was given, cells are at most its
+        ``cell_size`` bytes, and it is told how long they took to encode.
         """
-        buffer = self._buffer
-        if not buffer:
-            return b''
+        return b''.join(self.iter_cells())
+
+    def iter_cells(self):
+        """Pop data off the FIFO buffer like ``pop``, but yield each cell on
+        its own, as soon as it is encoded, so that it can be written while the
+        next one is encoded. The data is taken off the buffer on the first
+        iteration.
+
+        The ``sizer``, if any, is told how long the caller waited for cells,
+        once the last one was yielded.
+        """
+        if not self._chunks:
+            return
 
-        # Encode each ``MAX_CELL_SIZE`` slice via a moving offset and join the
-        # cells once at the end. Slicing the head off ``self._buffer`` inside the
-        # loop instead would recopy the whole remaining buffer every iteration,
-        # making a single large ``push`` quadratic in the number of cells.
-        cells = []
-        for offset in range(0, len(buffer), MAX_CELL_SIZE):
-            plaintext = buffer[offset:offset + MAX_CELL_SIZE]
-            cells.append(self._encoder.encode(plaintext))
+        start = time.monotonic()
+        cell_size = MAX_CELL_SIZE if self._sizer is None else self._sizer.cell_size
+        plaintexts = self._plaintexts(cell_size)
+        if self._codec is not None and len(plaintexts) > 1:
+            cells = [future.result for future in self._codec.encode(plaintexts)]
+        else:
+            cells = [functools.partial(self._encoder.encode, p) for p in plaintexts]
+
+        seconds = 0
+        for cell in cells:
+            tic = time.perf_counter()
+            cell = cell()
+            seconds += time.perf_counter() - tic
+            yield cell
+
+        if self._sizer is not None:
+            self._sizer.encoded(sum(len(p) for p in plaintexts), seconds, start)
+
+    def written(self, numbytes, seconds):
+        """Report that ``numbytes`` of the covertext returned by ``pop`` or
+        ``iter_cells`` took ``seconds`` to write, for the ``sizer``, if any.
+        """
+        if self._sizer is not None:
+            self._sizer.written(numbytes, seconds)
 
-        self._buffer = b''
-        return b''.join(cells)
+
+def _join(pieces):
+    if len(pieces) == 1 and len(pieces[0]) == len(pieces[0].obj):
+        return pieces[0].obj
+    plaintext = b''.join(pieces)
+    _countCopy(len(plaintext))
+    return plaintext
 
 
 class Decoder:
@@ -54,44 +324,88 @@ class Decoder:
     def __init__(
         self,
         decoder,
+        codec=None,
+        engine=None,
     ):
         self._decoder = decoder
-        self._buffer = b''
+        self._codec = codec
+        # The ``fteproxy.engines.engine`` that ``decoder`` belongs to, which
+        # reads the cells it made.
+        self._engine = fteproxy.engines.get('fte') if engine is None else engine
+        self._buffer = RingBuffer()
+        # The length of the cell at the head of the buffer, once a decode
+        # found it incomplete; no decode is attempted until it has arrived.
+        self._cell_length = 0
 
     def push(self, data):
         """Push data onto the FIFO buffer."""
         if isinstance(data, str):
             data = data.encode('utf-8')
-        self._buffer += data
+        self._buffer.write(data)
+
+    def reserve(self, numbytes):
+        """Return a writable view of ``numbytes`` bytes at the end of the FIFO
+        buffer, to receive data into, e.g. with ``socket.recv_into``, without
+        the copy made by ``push``. The data received must then be added with
+        ``commit``.
+        """
+        return self._buffer.reserve(numbytes)
+
+    def commit(self, numbytes):
+        """Add the first ``numbytes`` bytes received into ``reserve``'s view."""
+        self._buffer.commit(numbytes)
 
     def pop(self, oneCell=False):
         """Pop data off the FIFO buffer.
         The returned value is decoded with ``_decoder`` then decrypted
         with ``_decrypter`` specified in ``__init__``.
+
+        If a ``codec`` (an ``fteproxy.codec_pool.codec``) was given, every
+        complete cell in the buffer is decoded in parallel on its process pool,
+        and the messages are returned in their original order.
         """
 
-        # Consume cells from a local buffer and join the decoded messages once at
-        # the end; ``+= msg`` per cell would be quadratic in the number of cells.
-        # ``self._buffer`` is written back once, and on a decode failure it keeps
-        # the undecodable remainder (``buffer`` is unchanged by a raising decode).
-        buffer = self._buffer
+        # fte decodes from ``bytes``, so the unread data is copied out of the
+        # ring buffer once, cells are decoded at increasing offsets into that
+        # copy, and the decoded messages are joined once at the end; ``+= msg``
+        # per cell would be quadratic in the number of cells. The ring buffer
+        # is advanced once, and on a decode failure it keeps the undecodable
+        # remainder.
+        if not self._buffer or len(self._buffer) < self._cell_length:
+            return b''
+        buffer = self._buffer.read(len(self._buffer))
+        offset = 0
         messages = []
+        self._cell_length = 0
+
+        if self._codec is not None and not oneCell:
+            [messages, offset] = self._popParallel(buffer)
 
-        while len(buffer) > 0:
+        while len(buffer) - offset > self._cell_length:
             try:
-                msg, buffer = self._decoder.decode(buffer)
+                [msg, length] = self._engine.decode_cell(self._decoder, buffer, offset)
+                if msg is None:
+                    # Wait for the rest of the cell, rather than decoding it
+                    # again on every push until it is complete.
+                    self._cell_length = length
+                    break
                 messages.append(msg)
-            except fte.encoder.DecodeFailureError as e:
-                fteproxy.info("fteproxy.encoder.DecodeFailure: "+str(e))
+                offset += length
+            except fte.encoder.DecodeFailureError:
+                # Not even the cell's header has arrived yet.
+                counters['failed_decodes'] += 1
                 break
             except fte.encrypter.RecoverableDecryptionError as e:
-                fteproxy.info("fteproxy.encrypter.RecoverableDecryptionError: "+str(e))
+                counters['failed_decodes'] += 1
+                fteproxy.info("fteproxy.encrypter.RecoverableDecryptionError: %s", e)
                 break
             except fte.encrypter.UnrecoverableDecryptionError as e:
-                fteproxy.fatal_error("fteproxy.encrypter.UnrecoverableDecryptionError: "+str(e))
+                counters['failed_decodes'] += 1
+                fteproxy.fatal_error("fteproxy.encrypter.UnrecoverableDecryptionError: %s", e)
                 # exit
             except Exception as e:
-                fteproxy.warn("fteproxy.record_layer exception: "+str(e))
+                counters['failed_decodes'] += 1
+                fteproxy.warn("fteproxy.record_layer exception: %s", e)
                 break
 
             # Stop after a single cell only once one was decoded successfully.
@@ -103,5 +417,40 @@ class Decoder:
             if oneCell:
                 break
 
-        self._buffer = buffer
+        self._buffer.consume(offset)
         return b''.join(messages)
+
+    def _popParallel(self, buffer):
+        """Decode the complete cells at the head of ``buffer`` on the codec's
+        process pool. Returns the decoded messages, in order, and the number of
+        bytes of ``buffer`` they were decoded from. Decoding stops short of the
+        first cell that failed, which is left for the sequential loop in
+        ``pop`` to report.
+        """
+
+        offsets = [0]
+        while True:
+            length = self._engine.cell_length(self._decoder, buffer, offsets[-1])
+            if length is None or offsets[-1] + length > len(buffer):
+                break
+            offsets.append(offsets[-1] + length)
+        pending = length or 0
+
+        if len(offsets) < 3:
+            # Fewer than two complete cells, nothing to parallelize.
+            return [[], 0]
+
+        futures = self._codec.decode([buffer[start:end]
+                                      for start, end in zip(offsets, offsets[1:])])
+        messages = []
+        for future in futures:
+            try:
+                messages.append(future.result())
+            except Exception:
+                break
+        for future in futures[len(messages):]:
+            future.cancel()
+
+        if len(messages) == len(futures):
+            self._cell_length = pending
+        return [messages, offsets[len(messages)]]
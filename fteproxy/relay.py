@@ -4,13 +4,68 @@
 
 
 import time
+import errno
+import queue
 import socket
+import selectors
 import threading
+import collections
+import concurrent.futures
 
 import fteproxy.conf
+import fteproxy.buffers
+import fteproxy.settings
 import fteproxy.network_io
 
 
+# Passed to ``event_loop._ready`` alongside the selectors events, for a
+# channel whose coalescing window has ended.
+_EVENT_HELD = 1 << 8
+
+
+def _recv_bufsize():
+    # With a codec pool, read up to one cell per pool process at a time, so
+    # that a bulk stream hands the record layer enough cells to encode or
+    # decode in parallel.
+    return fteproxy.conf.getValue('runtime.fteproxy.record_layer.max_cell_size') * \
+        max(1, fteproxy.conf.getValue('runtime.fteproxy.record_layer.codec_pool.workers'))
+
+
+class stats(object):
+
+    """``fteproxy.relay.stats`` holds the counters kept by a ``listener``: the
+    number of connections ``accepted``, of connections that ``failed`` before
+    relaying started (e.g. the upstream connect was refused, or the connection
+    waited too long for a ``worker_pool`` slot), of tunnels currently
+    ``active``, of tunnels currently ``queued`` for a slot, and of connections
+    currently ``connecting`` to the upstream or waiting to. ``connect_ms`` and
+    ``setup_ms`` add up the milliseconds that tunnels spent connecting to the
+    upstream, and in the rest of their setup between being accepted and being
+    relayed. The counters are stored in ``counters``, a mutable
+    sequence of ints with one slot per entry of ``FIELDS``. By default this is a
+    list; a ``multiprocessing.Array`` lets another process read the counters.
+    """
+
+    FIELDS = ['accepted', 'active', 'failed', 'queued',
+              'connecting', 'connect_ms', 'setup_ms']
+
+    def __init__(self, counters=None):
+        if counters is None:
+            counters = [0] * len(stats.FIELDS)
+        self._counters = counters
+        self._lock = threading.Lock()
+
+    def add(self, field, n=1):
+        with self._lock:
+            self._counters[stats.FIELDS.index(field)] += n
+
+    def get(self, field):
+        return self._counters[stats.FIELDS.index(field)]
+
+    def asdict(self):
+        return dict(zip(stats.FIELDS, self._counters[:]))
+
+
 class worker(threading.Thread):
 
     """``fteproxy.relay.worker`` is responsible for relaying data between two sockets. Given ``socket1`` and
@@ -18,12 +73,16 @@ class worker(threading.Thread):
     from ``socket1`` to ``socket2``, and ``socket2`` to ``socket1``. This class is a subclass of
     threading.Thread and does not start relaying until start() is called. The run
     method terminates when either ``socket1`` or ``socket2`` is detected to be closed.
+    If ``stats`` is given, the tunnel is counted as no longer active once the
+    worker terminates; a ``listener`` passes it to one worker of each pair,
+    since either worker closes both sockets when it terminates.
     """
 
-    def __init__(self, socket1, socket2):
+    def __init__(self, socket1, socket2, stats=None):
         threading.Thread.__init__(self)
         self._socket1 = socket1
         self._socket2 = socket2
+        self._stats = stats
         self._running = False
 
     def run(self):
@@ -35,10 +94,11 @@ class worker(threading.Thread):
         
         self._running = True
         try:
-            throttle = fteproxy.conf.getValue('runtime.fteproxy.relay.throttle')
+            throttle = fteproxy.settings.current().throttle
+            bufsize = _recv_bufsize()
             while self._running:
                 [success, _data] = fteproxy.network_io.recvall_from_socket(
-                    self._socket1)
+                    self._socket1, bufsize)
                 if not success:
                     break
                 if _data:
@@ -46,10 +106,12 @@ class worker(threading.Thread):
                 else:
                     time.sleep(throttle)
         except Exception as e:
-            fteproxy.warn("fteproxy.worker terminated prematurely: " + str(e))
+            fteproxy.warn("fteproxy.worker terminated prematurely: %s", e)
         finally:
             fteproxy.network_io.close_socket(self._socket1)
             fteproxy.network_io.close_socket(self._socket2)
+            if self._stats is not None:
+                self._stats.add('active', -1)
 
     def stop(self):
         """Terminate the thread and stop listening on ``local_ip:local_port``.
@@ -57,6 +119,676 @@ class worker(threading.Thread):
         self._running = False
 
 
+class worker_pool(object):
+
+    """``fteproxy.relay.worker_pool`` relays at most ``size`` tunnels at a time,
+    each on a pair of threads that are spawned up front and reused, so that a
+    burst of connections cannot turn into a burst of thread creation. Tunnels
+    submitted while every slot is busy wait in a FIFO admission queue; one
+    that has waited longer than ``queue_timeout`` seconds when ``expire()`` is
+    called, or when a slot frees up, is closed and counted as ``failed``.
+    """
+
+    def __init__(self, size, queue_timeout, stats):
+        self._size = size
+        self._queue_timeout = queue_timeout
+        self._stats = stats
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._running = True
+        self._threads = []
+
+        for _ in range(size):
+            reverse = queue.Queue()
+            for target, args in [(self._runSlot, (reverse,)),
+                                 (self._runReverse, (reverse,))]:
+                thread = threading.Thread(target=target, args=args)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    @property
+    def size(self):
+        return self._size
+
+    def submit(self, conn, new_stream):
+        """Queue the tunnel between ``conn`` and ``new_stream`` for the next
+        free slot.
+        """
+        with self._condition:
+            self._queue.append((conn, new_stream, time.time()))
+            self._stats.add('queued')
+            self._condition.notify()
+
+    def expire(self):
+        """Close the tunnels that have waited in the queue for longer than
+        ``queue_timeout``.
+        """
+        deadline = time.time() - self._queue_timeout
+        expired = []
+        with self._condition:
+            while self._queue and self._queue[0][2] < deadline:
+                expired.append(self._queue.popleft())
+                self._stats.add('queued', -1)
+
+        for conn, new_stream, _ in expired:
+            fteproxy.warn('fteproxy.worker_pool: no free slot within %ss, '
+                          'dropping connection', self._queue_timeout)
+            self._stats.add('failed')
+            fteproxy.network_io.close_socket(conn)
+            fteproxy.network_io.close_socket(new_stream)
+
+    def stop(self):
+        """Close the queued tunnels, and stop the slots once their current
+        tunnels finish.
+        """
+        with self._condition:
+            self._running = False
+            queued = list(self._queue)
+            self._queue.clear()
+            self._stats.add('queued', -len(queued))
+            self._condition.notify_all()
+
+        for conn, new_stream, _ in queued:
+            fteproxy.network_io.close_socket(conn)
+            fteproxy.network_io.close_socket(new_stream)
+
+    def _next(self):
+        with self._condition:
+            while self._running and not self._queue:
+                self._condition.wait()
+            if not self._running:
+                return None
+            self._stats.add('queued', -1)
+            return self._queue.popleft()
+
+    def _runSlot(self, reverse):
+        # Each slot relays one direction of its tunnel on this thread, and
+        # hands the other direction to its partner thread, ``_runReverse``.
+        done = threading.Event()
+        while True:
+            self.expire()
+            tunnel = self._next()
+            if tunnel is None:
+                reverse.put(None)
+                return
+            conn, new_stream, _ = tunnel
+
+            self._stats.add('active')
+            done.clear()
+            reverse.put((worker(new_stream, conn), done))
+            worker(conn, new_stream, self._stats).run()
+            done.wait()
+
+    def _runReverse(self, reverse):
+        while True:
+            job = reverse.get()
+            if job is None:
+                return
+            w, done = job
+            try:
+                w.run()
+            finally:
+                done.set()
+
+
+def _is_open(sock):
+    # An idle connection is open unless the peer has closed it: a non-blocking
+    # peek then finds EOF or an error instead of nothing to read.
+    timeout = sock.gettimeout()
+    try:
+        sock.settimeout(0.0)
+        return sock.recv(1, socket.MSG_PEEK) != b''
+    except (BlockingIOError, InterruptedError):
+        return True
+    except socket.error:
+        return False
+    finally:
+        try:
+            sock.settimeout(timeout)
+        except socket.error:
+            pass
+
+
+class upstream_pool(object):
+
+    """``fteproxy.relay.upstream_pool`` keeps ``min_idle`` connections to
+    ``remote_ip:remote_port`` established ahead of time, on a thread of its
+    own, so that a new tunnel can take one with ``get()`` instead of waiting
+    for a connect. Every ``check_interval`` seconds, idle connections that the
+    upstream closed, or that are older than ``max_age`` seconds, are replaced.
+    """
+
+    def __init__(self, remote_ip, remote_port, min_idle, max_age,
+                 connect_timeout, check_interval):
+        self._remote_ip = remote_ip
+        self._remote_port = remote_port
+        self._min_idle = min_idle
+        self._max_age = max_age
+        self._connect_timeout = connect_timeout
+        self._check_interval = check_interval
+        # Idle connections, oldest first, with the time each was established.
+        self._idle = collections.deque()
+        self._condition = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def get(self):
+        """Return an established connection to the upstream, or ``None`` if
+        there is no idle one.
+        """
+        while True:
+            with self._condition:
+                if not self._idle:
+                    return None
+                sock, connected = self._idle.popleft()
+                self._condition.notify()
+            if time.time() - connected < self._max_age and _is_open(sock):
+                return sock
+            fteproxy.network_io.close_socket(sock)
+
+    def stop(self):
+        """Close the idle connections and stop establishing new ones."""
+        with self._condition:
+            self._running = False
+            idle = list(self._idle)
+            self._idle.clear()
+            self._condition.notify()
+        for sock, _ in idle:
+            fteproxy.network_io.close_socket(sock)
+
+    def _expire(self):
+        with self._condition:
+            idle = list(self._idle)
+            self._idle.clear()
+        deadline = time.time() - self._max_age
+        keep = []
+        for sock, connected in idle:
+            if connected > deadline and _is_open(sock):
+                keep.append((sock, connected))
+            else:
+                fteproxy.network_io.close_socket(sock)
+        with self._condition:
+            if self._running:
+                self._idle.extendleft(reversed(keep))
+                keep = []
+        for sock, _ in keep:
+            fteproxy.network_io.close_socket(sock)
+
+    def _run(self):
+        next_check = time.time() + self._check_interval
+        while True:
+            with self._condition:
+                while self._running and len(self._idle) >= self._min_idle \
+                        and time.time() < next_check:
+                    self._condition.wait(next_check - time.time())
+                if not self._running:
+                    return
+                missing = self._min_idle - len(self._idle)
+
+            if time.time() >= next_check:
+                self._expire()
+                next_check = time.time() + self._check_interval
+                continue
+
+            if missing > 0:
+                try:
+                    sock = socket.create_connection(
+                        (self._remote_ip, self._remote_port), self._connect_timeout)
+                except socket.error as e:
+                    fteproxy.warn('fteproxy.upstream_pool failed to connect: %s', e)
+                    # Retry at the next check, rather than in a tight loop
+                    # while the upstream is down.
+                    with self._condition:
+                        while self._running and time.time() < next_check:
+                            self._condition.wait(next_check - time.time())
+                    continue
+                with self._condition:
+                    if self._running:
+                        self._idle.append((sock, time.time()))
+                        continue
+                fteproxy.network_io.close_socket(sock)
+
+
+class _channel(object):
+
+    """One side of a tunnel relayed by the ``fteproxy.relay.event_loop``
+    ``loop``: a non-blocking socket, the channel on the other side of the
+    tunnel, the bytes already encoded for this socket that it has not yet
+    accepted, and the data held back for it by the listener's coalescing
+    window.
+    """
+
+    def __init__(self, sock, loop):
+        self.sock = sock
+        self.loop = loop
+        self.peer = None
+        self.pending = b''
+        self.coalesce = False
+        self.held = []
+        self.held_bytes = 0
+        self.eof = False
+        self.closed = False
+        self.paused = False
+        self.events = 0
+
+    def ready(self, mask):
+        self.loop._ready(self, mask)
+
+
+class event_loop(object):
+
+    """``fteproxy.relay.event_loop`` relays every connection accepted by a
+    ``listener`` on one readiness-driven loop built on ``selectors`` (epoll or
+    kqueue where available), instead of a pair of ``worker`` threads per tunnel.
+    A side of a tunnel is read only when the selector reports it readable and
+    only while the other side has no unsent data, so an idle tunnel costs no
+    wakeups and a slow reader pushes back on its writer via TCP flow control.
+    Upstream connects are non-blocking too; at most
+    ``runtime.fteproxy.relay.connect_concurrency`` are in flight at once, and
+    one that takes longer than ``runtime.fteproxy.relay.connect_timeout`` is
+    abandoned; a listener whose upstream connections block, like a client's
+    mux session, makes them on its connector threads instead. Once connected,
+    a tunnel's sockets are wrapped on one of those threads, as wrapping them
+    may block, e.g. on building an encoder, and handed back to the loop to be
+    relayed. The listener's coalescing window is kept here too: data read for
+    an fteproxy socket is held back and encoded in one go once the window ends
+    or enough of it is held, as ``set_coalescing`` does for ``worker`` threads.
+    """
+
+    def __init__(self, listener):
+        self._listener = listener
+        self._selector = selectors.DefaultSelector()
+        self._running = False
+        self._channels = set()
+        # Upstream connects in flight, by socket: the accepted connection, when
+        # it was accepted, when the connect started and when it times out.
+        # Accepted connections beyond the connect limit wait in ``_waiting``.
+        self._connecting = {}
+        self._waiting = collections.deque()
+        # Channels whose reads were paused by fteproxy.buffers, until when.
+        self._paused = {}
+        # Channels holding data back to coalesce it, until when.
+        self._coalescing = {}
+        self._connect_concurrency = fteproxy.conf.getValue(
+            'runtime.fteproxy.relay.connect_concurrency')
+        self._bufsize = _recv_bufsize()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        # Functions that other threads left for the loop to call, with their
+        # arguments; None once the loop has stopped.
+        self._calls = collections.deque()
+        self._calls_lock = threading.Lock()
+
+    def run(self):
+        """Accept on the ``listener``'s socket and relay all tunnels until
+        ``stop()`` is called. Runs in the calling thread.
+        """
+        listen_sock = self._listener._sock
+        listen_sock.setblocking(False)
+        self._selector.register(listen_sock, selectors.EVENT_READ, self._accept)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, self._wakeup)
+
+        self._running = True
+        try:
+            while self._running:
+                for key, mask in self._selector.select(self._selectTimeout()):
+                    key.data(mask)
+                    if not self._running:
+                        break
+                self._expireConnects()
+                self._resumeReads()
+                self._sendHeld()
+        finally:
+            # Tunnels set up in the meantime are relayed, so as to be closed
+            # with the others below.
+            with self._calls_lock:
+                calls, self._calls = self._calls, None
+            for function, args in calls:
+                function(*args)
+            for new_stream, (conn, _, _, _, _) in list(self._connecting.items()):
+                fteproxy.network_io.close_socket(conn)
+                fteproxy.network_io.close_socket(new_stream)
+            for conn, _ in self._waiting:
+                fteproxy.network_io.close_socket(conn)
+            self._listener.stats.add('connecting', -len(self._connecting) - len(self._waiting))
+            for channel in list(self._channels):
+                self._close(channel)
+            self._selector.close()
+            fteproxy.network_io.close_socket(listen_sock)
+            fteproxy.network_io.close_socket(self._wakeup_r)
+            fteproxy.network_io.close_socket(self._wakeup_w)
+
+    def stop(self):
+        """Wake the loop so that ``run()`` closes every tunnel and returns.
+        """
+        self._running = False
+        self._wake()
+
+    def _call(self, function, *args):
+        """Have the loop call ``function(*args)``; for other threads. Returns
+        False, and calls nothing, if the loop has stopped.
+        """
+        with self._calls_lock:
+            if self._calls is None:
+                return False
+            self._calls.append((function, args))
+        self._wake()
+        return True
+
+    def _wake(self):
+        try:
+            self._wakeup_w.send(b'\x00')
+        except socket.error:
+            # Full, so the loop is due to wake up anyway; or closed.
+            pass
+
+    def _wakeup(self, mask):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self._running:
+            with self._calls_lock:
+                if not self._calls:
+                    return
+                function, args = self._calls.popleft()
+            function(*args)
+
+    def _accept(self, mask):
+        listen_sock = self._listener._sock
+        for _ in range(fteproxy.conf.getValue('runtime.fteproxy.relay.backlog')):
+            try:
+                conn, addr = listen_sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket.error as e:
+                fteproxy.warn('socket.error in fteproxy.event_loop: %s', e)
+                return
+            self._listener.stats.add('accepted')
+            self._listener.stats.add('connecting')
+            self._waiting.append((conn, time.time()))
+            self._startConnects()
+
+    def _startConnects(self):
+        while self._waiting and len(self._connecting) < self._connect_concurrency:
+            conn, accepted = self._waiting.popleft()
+            settings = fteproxy.settings.current()
+
+            if self._listener._blocking_upstream:
+                try:
+                    self._listener._connector.submit(
+                        self._connectUpstream, conn, accepted, settings)
+                except RuntimeError:
+                    # Stopped.
+                    fteproxy.network_io.close_socket(conn)
+                    self._listener.stats.add('connecting', -1)
+                    self._listener.stats.add('failed')
+                continue
+
+            new_stream = self._listener._readyUpstream(settings)
+            if new_stream is not None:
+                self._listener.stats.add('connecting', -1)
+                self._relay(conn, new_stream, accepted, time.time(), settings)
+                continue
+
+            new_stream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            new_stream.setblocking(False)
+            err = new_stream.connect_ex((self._listener._remote_ip,
+                                         self._listener._remote_port))
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                self._abort(conn, new_stream, err)
+                continue
+
+            start = time.time()
+            self._connecting[new_stream] = (
+                conn, accepted, start, start + settings.connect_timeout, settings)
+            self._selector.register(
+                new_stream, selectors.EVENT_WRITE,
+                lambda mask, new_stream=new_stream: self._connected(new_stream))
+
+    def _selectTimeout(self):
+        deadlines = [deadline for _, _, _, deadline, _ in self._connecting.values()]
+        deadlines += self._paused.values()
+        deadlines += self._coalescing.values()
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.time())
+
+    def _resumeReads(self):
+        now = time.time()
+        for channel, deadline in list(self._paused.items()):
+            if deadline <= now:
+                del self._paused[channel]
+                channel.paused = False
+                self._update(channel)
+
+    def _sendHeld(self):
+        now = time.time()
+        for channel, deadline in list(self._coalescing.items()):
+            if deadline <= now:
+                self._ready(channel, _EVENT_HELD)
+
+    def _expireConnects(self):
+        now = time.time()
+        for new_stream, (conn, _, _, deadline, _) in list(self._connecting.items()):
+            if deadline <= now:
+                self._selector.unregister(new_stream)
+                del self._connecting[new_stream]
+                self._abort(conn, new_stream, errno.ETIMEDOUT)
+        self._startConnects()
+
+    def _connected(self, new_stream):
+        self._selector.unregister(new_stream)
+        conn, accepted, start, _, settings = self._connecting.pop(new_stream)
+        self._startConnects()
+        err = new_stream.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self._abort(conn, new_stream, err)
+            return
+
+        self._listener.stats.add('connecting', -1)
+        self._relay(conn, new_stream, accepted, start, settings)
+
+    def _relay(self, conn, new_stream, accepted, start, settings):
+        connected = time.time()
+        self._listener.stats.add('connect_ms', int(1000 * (connected - start)))
+        try:
+            self._listener._connector.submit(
+                self._setUp, conn, new_stream, accepted, start, connected, settings)
+        except RuntimeError:
+            # Stopped.
+            self._failed(conn, new_stream)
+
+    def _connectUpstream(self, conn, accepted, settings):
+        # On a connector thread, for a listener whose ``_readyUpstream`` may
+        # block; it then always returns a connection, or raises.
+        start = time.time()
+        try:
+            new_stream = self._listener._readyUpstream(settings)
+        except Exception as e:
+            fteproxy.warn('failed to connect in fteproxy.event_loop: %s', e)
+            fteproxy.network_io.close_socket(conn)
+            self._listener.stats.add('connecting', -1)
+            self._listener.stats.add('failed')
+            return
+
+        self._listener.stats.add('connecting', -1)
+        connected = time.time()
+        self._listener.stats.add('connect_ms', int(1000 * (connected - start)))
+        self._setUp(conn, new_stream, accepted, start, connected, settings)
+
+    def _setUp(self, conn, new_stream, accepted, start, connected, settings):
+        # On a connector thread.
+        try:
+            conn.setblocking(True)
+            new_stream.setblocking(True)
+            [conn, new_stream] = self._listener._setupConnection(conn, new_stream, settings)
+            conn.settimeout(0.0)
+            new_stream.settimeout(0.0)
+            self._listener.stats.add(
+                'setup_ms', int(1000 * (time.time() - connected + start - accepted)))
+        except Exception as e:
+            fteproxy.warn('exception in fteproxy.event_loop: %s', e)
+            self._failed(conn, new_stream)
+            return
+
+        if not self._call(self._register, conn, new_stream):
+            self._failed(conn, new_stream)
+
+    def _failed(self, conn, new_stream):
+        fteproxy.network_io.close_socket(conn)
+        fteproxy.network_io.close_socket(new_stream)
+        self._listener.stats.add('failed')
+
+    def _register(self, conn, new_stream):
+        self._listener.stats.add('active')
+        channel1 = _channel(conn, self)
+        channel2 = _channel(new_stream, self)
+        channel1.peer = channel2
+        channel2.peer = channel1
+        for channel in (channel1, channel2):
+            # As in ``listener._setupConnection``, only fteproxy sockets.
+            channel.coalesce = self._listener._coalesce_window > 0 and \
+                hasattr(channel.sock, 'set_coalescing')
+            self._channels.add(channel)
+            self._update(channel)
+
+    def _abort(self, conn, new_stream, err):
+        fteproxy.warn('failed to connect in fteproxy.event_loop: %s',
+                      errno.errorcode.get(err, err))
+        fteproxy.network_io.close_socket(conn)
+        fteproxy.network_io.close_socket(new_stream)
+        self._listener.stats.add('connecting', -1)
+        self._listener.stats.add('failed')
+
+    def _update(self, channel):
+        """(Re-)register ``channel`` for the events it is waiting on: readable
+        while its peer can take more data, writable while it has pending output.
+        """
+        if channel.closed:
+            return
+
+        events = 0
+        if not channel.eof and not channel.peer.eof and not channel.peer.pending \
+                and not channel.paused:
+            events |= selectors.EVENT_READ
+        if channel.pending:
+            events |= selectors.EVENT_WRITE
+
+        if events == channel.events:
+            return
+        if not events:
+            self._selector.unregister(channel.sock)
+        elif not channel.events:
+            self._selector.register(channel.sock, events, channel.ready)
+        else:
+            self._selector.modify(channel.sock, events, channel.ready)
+        channel.events = events
+
+    def _ready(self, channel, mask):
+        try:
+            if mask & _EVENT_HELD:
+                self._encodeHeld(channel)
+            if mask & selectors.EVENT_WRITE:
+                self._flush(channel)
+            if mask & selectors.EVENT_READ:
+                self._read(channel)
+        except socket.error:
+            self._close(channel)
+            return
+        except (Exception, SystemExit) as e:
+            # A thread-per-tunnel ``worker`` that hits an unexpected error,
+            # including the SystemExit raised by ``fatal_error`` on an
+            # unrecoverable decryption error, only ends its own tunnel. Keep
+            # that isolation here instead of taking down every tunnel.
+            fteproxy.warn("fteproxy.event_loop tunnel terminated prematurely: %s", e)
+            self._close(channel)
+            return
+
+        if channel.eof and not channel.peer.pending:
+            self._close(channel)
+        elif channel.peer.eof and not channel.pending:
+            self._close(channel)
+        else:
+            self._update(channel)
+            self._update(channel.peer)
+
+    def _read(self, channel):
+        try:
+            data = channel.sock.recv(self._bufsize)
+        except fteproxy.buffers.BufferFull:
+            # The socket stays readable: leave it out of the select for a
+            # while, rather than spinning on it.
+            channel.paused = True
+            self._paused[channel] = time.time() + fteproxy.settings.current().throttle
+            return
+        except (BlockingIOError, InterruptedError, socket.timeout):
+            return
+
+        peer = channel.peer
+        if not data:
+            channel.eof = True
+            self._encodeHeld(peer)
+            return
+
+        if peer.coalesce:
+            peer.held.append(data)
+            peer.held_bytes += len(data)
+            if peer.held_bytes < self._listener._coalesce_bytes:
+                self._coalescing.setdefault(
+                    peer, time.time() + self._listener._coalesce_window)
+                return
+            self._encodeHeld(peer)
+            return
+
+        peer.pending += fteproxy.network_io.encode_for_socket(peer.sock, data)
+        self._flush(peer)
+
+    def _encodeHeld(self, channel):
+        """Encode the data held back for ``channel`` as one write, and send
+        what its socket takes of it.
+        """
+        self._coalescing.pop(channel, None)
+        if not channel.held:
+            return
+        data = b''.join(channel.held)
+        channel.held = []
+        channel.held_bytes = 0
+        channel.pending += fteproxy.network_io.encode_for_socket(channel.sock, data)
+        self._flush(channel)
+
+    def _flush(self, channel):
+        while channel.pending:
+            numbytes = fteproxy.network_io.send_some_to_socket(
+                channel.sock, channel.pending)
+            if not numbytes:
+                break
+            channel.pending = channel.pending[numbytes:]
+
+    def _close(self, channel):
+        """Close both sides of ``channel``'s tunnel, as ``worker`` does once
+        either side is closed.
+        """
+        if not channel.closed:
+            self._listener.stats.add('active', -1)
+        for c in (channel, channel.peer):
+            if c.closed:
+                continue
+            if c.events:
+                self._selector.unregister(c.sock)
+                c.events = 0
+            c.closed = True
+            self._paused.pop(c, None)
+            self._coalescing.pop(c, None)
+            self._channels.discard(c)
+            fteproxy.network_io.close_socket(c.sock)
+
+
 class listener(threading.Thread):
 
     """It's the responsibility of ``fteproxy.relay.listener`` to bind to
@@ -66,10 +798,25 @@ class listener(threading.Thread):
     All new outgoing connections are wrapped with ``onNewOutgoingConnection``.
     By default the functions ``onNewIncomingConnection`` and
     ``onNewOutgoingConnection`` are the identity function.
+    The listener counts its connections in ``stats``, an ``fteproxy.relay.stats``.
+    If ``coalesce_window`` is given, fteproxy sockets of this listener's tunnels
+    hold back the data sent on them for up to that many seconds, or until
+    ``coalesce_bytes`` bytes are held; both default to
+    ``runtime.fteproxy.relay.coalesce_window`` and ``coalesce_bytes``.
+    Subclasses that wrap their connections encode them with the
+    ``fteproxy.engines`` engine called ``engine``, by default
+    ``runtime.fteproxy.record_layer.engine``.
+    A subclass that sets ``pool_upstream`` takes the connections to
+    ``remote_ip:remote_port`` from an ``upstream_pool`` of
+    ``runtime.fteproxy.relay.upstream_pool.min_idle`` connections, if that
+    is set, instead of connecting for every tunnel.
     """
 
+    pool_upstream = False
+
     def __init__(self, local_ip, local_port,
-                 remote_ip, remote_port):
+                 remote_ip, remote_port,
+                 coalesce_window=None, coalesce_bytes=None, engine=None):
         threading.Thread.__init__(self)
 
         self._running = False
@@ -77,11 +824,35 @@ class listener(threading.Thread):
         self._local_port = local_port
         self._remote_ip = remote_ip
         self._remote_port = remote_port
+        self._event_loop = None
+        self._worker_pool = None
+        self._connector = None
+        self._upstream_pool = None
+        # Whether ``_readyUpstream`` may block, e.g. to connect, so that the
+        # ``event_loop`` calls it on a connector thread.
+        self._blocking_upstream = False
+        # The settings of the tunnel being set up on each thread.
+        self._tunnel = threading.local()
+        self.stats = stats()
+
+        if coalesce_window is None:
+            coalesce_window = fteproxy.conf.getValue('runtime.fteproxy.relay.coalesce_window')
+        if coalesce_bytes is None:
+            coalesce_bytes = fteproxy.conf.getValue('runtime.fteproxy.relay.coalesce_bytes')
+        self._coalesce_window = coalesce_window
+        self._coalesce_bytes = coalesce_bytes
+        if engine is None:
+            engine = fteproxy.conf.getValue('runtime.fteproxy.record_layer.engine')
+        self._engine = engine
 
     def _instantiateSocket(self):
         try:
             self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if fteproxy.conf.getValue('runtime.fteproxy.relay.reuse_port'):
+                # Let several processes bind the same port; the kernel then
+                # spreads incoming connections across their listeners.
+                self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self._sock.bind((self._local_ip, self._local_port))
             self._sock.listen(fteproxy.conf.getValue('runtime.fteproxy.relay.backlog'))
             self._sock.settimeout(
@@ -92,51 +863,177 @@ class listener(threading.Thread):
 
     def run(self):
         """Bind to ``local_ip:local_port`` and forward all connections to
-        ``remote_ip:remote_port``.
+        ``remote_ip:remote_port``. With ``runtime.fteproxy.relay.backend`` set
+        to ``selectors`` all tunnels are relayed by one ``event_loop`` on this
+        thread, otherwise each tunnel gets a pair of ``worker`` threads: new
+        ones per tunnel, or, with ``runtime.fteproxy.relay.pool_size`` set, a
+        pair from a ``worker_pool`` of that many tunnel slots. Connections to
+        ``remote_ip:remote_port`` are made on up to
+        ``runtime.fteproxy.relay.connect_concurrency`` connector threads, so
+        that a slow upstream does not hold up accepting other connections;
+        the ``event_loop`` connects on its own, and wraps the sockets of its
+        tunnels on those threads.
         """
         self._instantiateSocket()
 
+        min_idle = fteproxy.conf.getValue('runtime.fteproxy.relay.upstream_pool.min_idle')
+        if self.pool_upstream and min_idle > 0:
+            self._upstream_pool = upstream_pool(
+                self._remote_ip, self._remote_port, min_idle,
+                fteproxy.conf.getValue('runtime.fteproxy.relay.upstream_pool.max_age'),
+                fteproxy.conf.getValue('runtime.fteproxy.relay.connect_timeout'),
+                fteproxy.conf.getValue('runtime.fteproxy.relay.upstream_pool.check_interval'))
+
+        self._connector = concurrent.futures.ThreadPoolExecutor(
+            max_workers=fteproxy.conf.getValue('runtime.fteproxy.relay.connect_concurrency'))
+
+        if fteproxy.conf.getValue('runtime.fteproxy.relay.backend') == 'selectors':
+            self._event_loop = event_loop(self)
+            self._running = True
+            self._event_loop.run()
+            return
+
+        pool_size = fteproxy.conf.getValue('runtime.fteproxy.relay.pool_size')
+        if pool_size > 0:
+            self._worker_pool = worker_pool(
+                pool_size,
+                fteproxy.conf.getValue('runtime.fteproxy.relay.queue_timeout'),
+                self.stats)
+
         self._running = True
         while self._running:
+            if self._worker_pool is not None:
+                self._worker_pool.expire()
             try:
                 conn, addr = self._sock.accept()
-
-                new_stream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                new_stream.connect((self._remote_ip, self._remote_port))
-
-                # Disable Nagle's algorithm on both hops. fteproxy is an
-                # interactive tunnel that emits small encoded cells; Nagle would
-                # hold a small segment for up to ~40 ms waiting to coalesce,
-                # which directly inflates round-trip latency.
-                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                new_stream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-
-                conn = self.onNewIncomingConnection(conn)
-                new_stream = self.onNewOutgoingConnection(new_stream)
-
-                conn.settimeout(
-                    fteproxy.conf.getValue('runtime.fteproxy.relay.socket_timeout'))
-                new_stream.settimeout(
-                    fteproxy.conf.getValue('runtime.fteproxy.relay.socket_timeout'))
-
-                w1 = worker(conn, new_stream)
-                w2 = worker(new_stream, conn)
-                w1.start()
-                w2.start()
+                self.stats.add('accepted')
+                self.stats.add('connecting')
+                self._connector.submit(self._connect, conn, time.time())
             except socket.timeout:
                 continue
             except socket.error as e:
-                fteproxy.warn('socket.error in fteproxy.listener: ' + str(e))
+                fteproxy.warn('socket.error in fteproxy.listener: %s', e)
                 continue
             except Exception as e:
-                fteproxy.warn('exception in fteproxy.listener: ' + str(e))
+                fteproxy.warn('exception in fteproxy.listener: %s', e)
                 break
-            
+
+    def _connect(self, conn, accepted, settings=None):
+        """Connect to ``remote_ip:remote_port`` for ``conn``, which was accepted
+        at time ``accepted``, then relay the tunnel between them. Runs on a
+        connector thread. The tunnel is set up with the ``settings`` snapshot
+        given, or else with the current one, taken once for all of it.
+        """
+        if settings is None:
+            settings = fteproxy.settings.current()
+        new_stream = None
+        try:
+            if not self._running:
+                fteproxy.network_io.close_socket(conn)
+                return
+
+            start = time.time()
+            new_stream = self._readyUpstream(settings)
+            if new_stream is None:
+                new_stream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                new_stream.settimeout(settings.connect_timeout)
+                new_stream.connect((self._remote_ip, self._remote_port))
+            connected = time.time()
+
+            [conn, new_stream] = self._setupConnection(conn, new_stream, settings)
+            self.stats.add('connect_ms', int(1000 * (connected - start)))
+            self.stats.add('setup_ms', int(1000 * (time.time() - connected + start - accepted)))
+        except Exception as e:
+            fteproxy.warn('failed to connect in fteproxy.listener: %s', e)
+            fteproxy.network_io.close_socket(conn)
+            if new_stream is not None:
+                fteproxy.network_io.close_socket(new_stream)
+            # No longer connecting by the time it counts as failed, so that
+            # stats never show a tunnel as both.
+            self.stats.add('connecting', -1)
+            self.stats.add('failed')
+            return
+        self.stats.add('connecting', -1)
+
+        if self._worker_pool is not None:
+            self._worker_pool.submit(conn, new_stream)
+            return
+
+        self.stats.add('active')
+        w1 = worker(conn, new_stream, self.stats)
+        w2 = worker(new_stream, conn)
+        w1.start()
+        w2.start()
+
+    def _setupConnection(self, conn, new_stream, settings):
+        """Prepare a newly accepted ``conn`` and its connected ``new_stream``
+        for relaying with the ``settings`` snapshot of the tunnel, returning
+        both as wrapped by ``onNewIncomingConnection`` and
+        ``onNewOutgoingConnection``.
+        """
+        # Disable Nagle's algorithm on both hops. fteproxy is an
+        # interactive tunnel that emits small encoded cells; Nagle would
+        # hold a small segment for up to ~40 ms waiting to coalesce,
+        # which directly inflates round-trip latency.
+        for sock in (conn, new_stream):
+            # Streams of an ``fteproxy.mux.session`` are local socket pairs.
+            if getattr(sock, 'family', socket.AF_INET) != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self._tunnel.settings = settings
+        try:
+            conn = self.onNewIncomingConnection(conn)
+            new_stream = self.onNewOutgoingConnection(new_stream)
+        finally:
+            self._tunnel.settings = None
+
+        conn.settimeout(settings.socket_timeout)
+        new_stream.settimeout(settings.socket_timeout)
+
+        if self._coalesce_window > 0:
+            for sock in (conn, new_stream):
+                set_coalescing = getattr(sock, 'set_coalescing', None)
+                if set_coalescing is not None:
+                    set_coalescing(self._coalesce_window, self._coalesce_bytes)
+
+        return [conn, new_stream]
+
+    def _settings(self):
+        """The ``fteproxy.settings.snapshot`` that the tunnel being set up on
+        this thread was given, for ``onNewIncomingConnection`` and
+        ``onNewOutgoingConnection``; outside of that, the current one.
+        """
+        settings = getattr(self._tunnel, 'settings', None)
+        return fteproxy.settings.current() if settings is None else settings
+
+    def _readyUpstream(self, settings):
+        """Return a socket that carries a new tunnel to ``remote_ip:remote_port``
+        without a connect of its own, or None to connect one. By default this
+        is an idle connection from the ``upstream_pool``, if there is one.
+        """
+        if self._upstream_pool is None:
+            return None
+        new_stream = self._upstream_pool.get()
+        if new_stream is not None:
+            new_stream.settimeout(None)
+        return new_stream
+
     def stop(self):
         """Terminate the thread and stop listening on ``local_ip:local_port``.
         """
         self._running = False
-        fteproxy.network_io.close_socket(self._sock)
+        if self._event_loop is not None:
+            # The loop closes the listening socket itself once it wakes up.
+            self._event_loop.stop()
+        else:
+            fteproxy.network_io.close_socket(self._sock)
+        if self._connector is not None:
+            # Connections still waiting for a connector are closed by it.
+            self._connector.shutdown(wait=False)
+        if self._worker_pool is not None:
+            self._worker_pool.stop()
+        if self._upstream_pool is not None:
+            self._upstream_pool.stop()
 
     def onNewIncomingConnection(self, socket):
         """``onNewIncomingConnection`` returns the socket unmodified, by default we do not need to
@@ -4,17 +4,112 @@
 
 
 
+import time
+import socket
+import weakref
+import concurrent.futures
+
 import fteproxy.relay
+import fteproxy.mux
+import fteproxy.settings
 
 
 class listener(fteproxy.relay.listener):
 
+    """With ``runtime.fteproxy.mux`` set, the server also accepts clients that
+    multiplex their tunnels over one connection: it reads each client's
+    negotiation before connecting upstream, and gives every stream of a
+    ``fteproxy.mux.session`` an upstream connection of its own. Clients that do
+    not multiplex are relayed as usual. This needs the ``threads`` relay
+    backend. Negotiations are read on up to
+    ``runtime.fteproxy.relay.connect_concurrency`` threads of their own, for at
+    most ``runtime.fteproxy.negotiate.timeout`` seconds each, so that clients
+    that stay silent do not hold up the connector threads that streams and
+    other tunnels connect upstream on.
+    """
+
+    # The server's upstream is the proxy it forwards to, which is fixed and
+    # usually close by, so idle connections to it can be kept ready.
+    pool_upstream = True
+
+    def __init__(self, *args, **kwargs):
+        fteproxy.relay.listener.__init__(self, *args, **kwargs)
+        self._mux = fteproxy.conf.getValue('runtime.fteproxy.mux')
+        self._sessions = weakref.WeakSet()
+        self._negotiator = None
+        if self._mux:
+            self._negotiator = concurrent.futures.ThreadPoolExecutor(
+                max_workers=fteproxy.conf.getValue('runtime.fteproxy.relay.connect_concurrency'))
+
+    def _connect(self, conn, accepted):
+        if not self._mux or fteproxy.mux.is_stream(conn):
+            return fteproxy.relay.listener._connect(self, conn, accepted)
+        try:
+            self._negotiator.submit(self._negotiate, conn, accepted,
+                                    fteproxy.settings.current())
+        except RuntimeError:
+            # Stopped.
+            self._failed(conn)
+
+    def _failed(self, conn):
+        # No longer connecting by the time it counts as failed, so that stats
+        # never show a tunnel as both.
+        self.stats.add('connecting', -1)
+        self.stats.add('failed')
+        fteproxy.network_io.close_socket(conn)
+
+    def _negotiate(self, conn, accepted, settings):
+        try:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._tunnel.settings = settings
+            try:
+                conn = self.onNewIncomingConnection(conn)
+            finally:
+                self._tunnel.settings = None
+            conn.settimeout(fteproxy.conf.getValue('runtime.fteproxy.negotiate.timeout'))
+            mux = conn.negotiate()
+        except Exception as e:
+            fteproxy.warn('failed to negotiate in fteproxy.server: %s', e)
+            self._failed(conn)
+            return
+
+        if not mux:
+            try:
+                self._connector.submit(fteproxy.relay.listener._connect,
+                                       self, conn, accepted, settings)
+            except RuntimeError:
+                self._failed(conn)
+            return
+
+        self.stats.add('connecting', -1)
+        session = fteproxy.mux.session(conn, self._openStream)
+        self._sessions.add(session)
+        session.start()
+
+    def _openStream(self, stream):
+        # Each stream is relayed like an accepted connection of its own.
+        self.stats.add('accepted')
+        self.stats.add('connecting')
+        self._connector.submit(self._connect, stream, time.time())
+
+    def stop(self):
+        fteproxy.relay.listener.stop(self)
+        if self._negotiator is not None:
+            self._negotiator.shutdown(wait=False)
+        for session in list(self._sessions):
+            session.close()
+
     def onNewIncomingConnection(self, socket):
         """On an incoming data stream we wrap it with ``fteproxy.wrap_socket``, with no parameters.
         By default we want the regular expressions to be negotiated in-band, specified by the client.
+        Connections that were already wrapped to read their negotiation, and
+        the streams of an ``fteproxy.mux.session``, are returned as they are.
         """
-        K1 = fteproxy.conf.getValue('runtime.fteproxy.encrypter.key')[:16]
-        K2 = fteproxy.conf.getValue('runtime.fteproxy.encrypter.key')[16:]
-        socket = fteproxy.wrap_socket(socket, K1=K1, K2=K2)
+        if isinstance(socket, fteproxy._FTESocketWrapper) or fteproxy.mux.is_stream(socket):
+            return socket
+
+        profile = self._settings().server
+        socket = fteproxy.wrap_socket(socket, K1=profile.K1, K2=profile.K2,
+                                      engine=self._engine)
 
         return socket
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Immutable snapshots of ``fteproxy.conf``, for the code that reads its settings
+once per tunnel.
+
+A ``snapshot`` holds the values of ``fteproxy.conf`` at one point in time,
+along with the settings that tunnels need resolved ahead of time: the regexes,
+fixed slices and keys that the client and server wrap their connections with,
+as a ``profile`` each. A listener takes ``current()`` for each new tunnel, and
+the tunnel keeps what it was set up with.
+
+``load`` reads a config file into ``fteproxy.conf`` and swaps in a snapshot of
+the result; ``reload`` does so again for ``runtime.fteproxy.config_file``,
+which is what a SIGHUP does. Tunnels accepted after a reload get the new
+settings, and tunnels already relayed keep theirs. A config file is a JSON
+object of ``fteproxy.conf`` keys, and may only hold those in ``RELOADABLE``:
+the others, like ports or the relay backend, take a restart to change.
+"""
+
+import json
+import threading
+import collections
+import types
+
+import fteproxy
+import fteproxy.conf
+import fteproxy.defs
+import fteproxy.format_cache
+
+
+class InvalidConfig(Exception):
+    pass
+
+
+class profile(collections.namedtuple('profile', [
+        'outgoing_regex', 'outgoing_fixed_slice',
+        'incoming_regex', 'incoming_fixed_slice',
+        'K1', 'K2', 'language'])):
+
+    """The arguments that a listener passes to ``fteproxy.wrap_socket`` for
+    each of its connections. ``language`` is the name of the outgoing format,
+    which a client announces in its negotiation cell.
+    """
+
+    __slots__ = ()
+
+
+class snapshot(collections.namedtuple('snapshot', [
+        'generation', 'values',
+        'throttle', 'connect_timeout', 'socket_timeout',
+        'client', 'server'])):
+
+    """``fteproxy.settings.snapshot`` is a read-only copy of ``fteproxy.conf``,
+    as of ``fteproxy.conf.generation``. ``get`` looks up any key in
+    ``values``; the settings read for every tunnel are attributes, and
+    ``client`` and ``server`` are the ``profile`` of the client and server
+    listeners.
+    """
+
+    __slots__ = ()
+
+    def get(self, key):
+        return self.values[key]
+
+
+def _language(value):
+    try:
+        fteproxy.defs.getRegex(value)
+    except fteproxy.defs.InvalidRegexName:
+        raise ValueError('no such format in release '
+                         + fteproxy.conf.getValue('fteproxy.defs.release'))
+    return value
+
+
+def _key(value):
+    key = bytes.fromhex(value)
+    if len(key) != 32:
+        raise ValueError('must be 64 hex characters')
+    return key
+
+
+def _loglevel(value):
+    if value not in (0, 1, 2, 3):
+        raise ValueError('must be 0, 1, 2 or 3')
+    return value
+
+
+def _count(value):
+    if not isinstance(value, int) or value < 0:
+        raise ValueError('must be a whole number, at least 0')
+    return value
+
+
+def _seconds(value):
+    if not isinstance(value, (int, float)) or value < 0:
+        raise ValueError('must be a number of seconds, at least 0')
+    return value
+
+
+def _timeout(value):
+    if _seconds(value) == 0:
+        raise ValueError('must be more than 0 seconds')
+    return value
+
+
+"""The keys that a config file may set, each with the function that checks its
+value from the file, and returns it as ``fteproxy.conf`` holds it."""
+RELOADABLE = {
+    'runtime.loglevel': _loglevel,
+    'runtime.log.rate_limit': _count,
+    'runtime.state.upstream_language': _language,
+    'runtime.state.downstream_language': _language,
+    'runtime.fteproxy.encrypter.key': _key,
+    'runtime.fteproxy.relay.throttle': _seconds,
+    'runtime.fteproxy.relay.connect_timeout': _timeout,
+    'runtime.fteproxy.relay.socket_timeout': _timeout,
+}
+
+
+_current = None
+_lock = threading.Lock()
+
+
+def current():
+    """Return the ``snapshot`` of ``fteproxy.conf`` as it is now. Snapshots
+    are shared: a new one is only taken once ``fteproxy.conf.setValue`` has
+    been called since the last.
+    """
+    latest = _current
+    if latest is not None and latest.generation == fteproxy.conf.generation:
+        return latest
+    with _lock:
+        return _update()
+
+
+def load(path):
+    """Read the config file at ``path`` into ``fteproxy.conf``, and return the
+    ``snapshot`` that ``current`` returns from then on. Raises
+    ``InvalidConfig``, and changes nothing, if the file cannot be read or any
+    of its settings is invalid.
+    """
+    try:
+        with open(path) as fh:
+            settings = json.load(fh)
+    except (IOError, OSError, ValueError) as e:
+        raise InvalidConfig('Failed to read config file ' + path + ': ' + str(e))
+    if not isinstance(settings, dict):
+        raise InvalidConfig('Config file ' + path + ' must hold a JSON object')
+
+    values = {}
+    for key, value in settings.items():
+        check = RELOADABLE.get(key)
+        if check is None:
+            raise InvalidConfig('Config file ' + path + ' sets ' + key
+                                + ', which is not one of: ' + ', '.join(sorted(RELOADABLE)))
+        try:
+            values[key] = check(value)
+        except (TypeError, ValueError) as e:
+            raise InvalidConfig('Config file ' + path + ' sets ' + key + ' to '
+                                + repr(value) + ', which ' + str(e))
+
+    with _lock:
+        for key, value in values.items():
+            fteproxy.conf.setValue(key, value)
+        return _update()
+
+
+def reload():
+    """Load ``runtime.fteproxy.config_file`` again, if one is set. On failure,
+    the settings in effect are kept, and the failure logged.
+    """
+    path = fteproxy.conf.getValue('runtime.fteproxy.config_file')
+    if path is None:
+        return
+    try:
+        load(path)
+    except InvalidConfig as e:
+        fteproxy.warn('%s; keeping the settings in effect', e)
+        return
+    fteproxy.info('Reloaded settings from %s', path)
+
+
+def _update():
+    # Takes a new snapshot, with _lock held, unless the current one is still
+    # current. The formats of the client profile are loaded before the
+    # snapshot is put in place, so that the first tunnel with them does not
+    # wait for them.
+    global _current
+
+    generation = fteproxy.conf.generation
+    if _current is not None and _current.generation == generation:
+        return _current
+
+    values = dict(fteproxy.conf.conf)
+    key = values['runtime.fteproxy.encrypter.key']
+    outgoing_language = values['runtime.state.upstream_language']
+    incoming_language = values['runtime.state.downstream_language']
+    client = profile(
+        fteproxy.defs.getRegex(outgoing_language),
+        fteproxy.defs.getFixedSlice(outgoing_language),
+        fteproxy.defs.getRegex(incoming_language),
+        fteproxy.defs.getFixedSlice(incoming_language),
+        key[:16], key[16:], outgoing_language)
+    for regex, fixed_slice in [(client.outgoing_regex, client.outgoing_fixed_slice),
+                               (client.incoming_regex, client.incoming_fixed_slice)]:
+        fteproxy.format_cache.get_encoder(regex, fixed_slice, key)
+
+    _current = snapshot(
+        generation, types.MappingProxyType(values),
+        values['runtime.fteproxy.relay.throttle'],
+        values['runtime.fteproxy.relay.connect_timeout'],
+        values['runtime.fteproxy.relay.socket_timeout'],
+        client,
+        profile(None, -1, None, -1, key[:16], key[16:], None))
+    return _current
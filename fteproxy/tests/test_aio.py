@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for the asyncio relay (fteproxy.aio), including wire compatibility with
+the threaded client and server listeners.
+"""
+
+import socket
+import asyncio
+
+import pytest
+
+import fteproxy
+import fteproxy.aio
+import fteproxy.conf
+import fteproxy.client
+import fteproxy.server
+
+
+LOCAL_INTERFACE = '127.0.0.1'
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((LOCAL_INTERFACE, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+async def _echo(reader, writer):
+    while True:
+        data = await reader.read(65536)
+        if not data:
+            break
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+async def _roundtrip(port, payload):
+    reader, writer = await asyncio.open_connection(LOCAL_INTERFACE, port)
+    writer.write(payload)
+    await writer.drain()
+    received = b''
+    while len(received) < len(payload):
+        data = await asyncio.wait_for(reader.read(65536), 10)
+        if not data:
+            break
+        received += data
+    writer.close()
+    return received
+
+
+async def _run(client_cls, server_cls, payloads):
+    """Start ``client_cls`` and ``server_cls`` in front of an echo server and
+    return what comes back for each of ``payloads``, sent concurrently."""
+    echo = await asyncio.start_server(_echo, LOCAL_INTERFACE, 0)
+    echo_port = echo.sockets[0].getsockname()[1]
+    server_port = free_port()
+    client_port = free_port()
+
+    server = server_cls(LOCAL_INTERFACE, server_port, LOCAL_INTERFACE, echo_port)
+    client = client_cls(LOCAL_INTERFACE, client_port, LOCAL_INTERFACE, server_port)
+    listeners = [server, client]
+    for l in listeners:
+        if isinstance(l, fteproxy.aio.listener):
+            await l.start()
+        else:
+            l.start()
+
+    # Threaded listeners bind from their own thread.
+    await asyncio.sleep(0.5)
+    try:
+        return await asyncio.gather(*[_roundtrip(client_port, p) for p in payloads])
+    finally:
+        for l in listeners:
+            l.stop()
+        echo.close()
+
+
+class TestAsyncioRelay:
+    """End-to-end tests of fteproxy.aio listeners."""
+
+    @pytest.mark.parametrize('client_cls,server_cls', [
+        (fteproxy.aio.client_listener, fteproxy.aio.server_listener),
+        (fteproxy.aio.client_listener, fteproxy.server.listener),
+        (fteproxy.client.listener, fteproxy.aio.server_listener),
+    ])
+    def test_roundtrip(self, client_cls, server_cls):
+        """asyncio and threaded listeners interoperate in every combination."""
+        payloads = [b'Hello, world' * 100 + str(i).encode('utf-8') for i in range(5)]
+        payloads.append(b'X' * (512 * 1024))
+        received = asyncio.run(_run(client_cls, server_cls, payloads))
+        assert received == payloads
+
+    def test_stop_closes_tunnels(self):
+        """stop() closes tunnels that are still open."""
+        async def run():
+            echo = await asyncio.start_server(_echo, LOCAL_INTERFACE, 0)
+            echo_port = echo.sockets[0].getsockname()[1]
+            relay = fteproxy.aio.listener(LOCAL_INTERFACE, 0, LOCAL_INTERFACE, echo_port)
+            await relay.start()
+            port = relay.getsockname()[1]
+
+            reader, writer = await asyncio.open_connection(LOCAL_INTERFACE, port)
+            writer.write(b'ping')
+            assert await asyncio.wait_for(reader.read(4), 5) == b'ping'
+
+            relay.stop()
+            assert await asyncio.wait_for(reader.read(4), 5) == b''
+            writer.close()
+            echo.close()
+
+        asyncio.run(run())
+
+    def test_silent_client_is_dropped(self):
+        """A server drops a client that sends no negotiation cell within
+        socket_timeout."""
+        saved = fteproxy.conf.getValue('runtime.fteproxy.relay.socket_timeout')
+        fteproxy.conf.setValue('runtime.fteproxy.relay.socket_timeout', 0.5)
+
+        async def run():
+            echo = await asyncio.start_server(_echo, LOCAL_INTERFACE, 0)
+            echo_port = echo.sockets[0].getsockname()[1]
+            relay = fteproxy.aio.server_listener(LOCAL_INTERFACE, 0, LOCAL_INTERFACE, echo_port)
+            await relay.start()
+            port = relay.getsockname()[1]
+
+            reader, writer = await asyncio.open_connection(LOCAL_INTERFACE, port)
+            try:
+                assert await asyncio.wait_for(reader.read(4), 5) == b''
+            finally:
+                writer.close()
+                relay.stop()
+                echo.close()
+
+        try:
+            asyncio.run(run())
+        finally:
+            fteproxy.conf.setValue('runtime.fteproxy.relay.socket_timeout', saved)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for fteproxy.buffers: the limits on what connections hold received but
+not yet decoded, and how connections that reach them are handled.
+"""
+
+import os
+import socket
+import struct
+
+import pytest
+
+import fteproxy
+import fteproxy.conf
+import fteproxy.buffers
+import fteproxy.settings
+import fteproxy.mux
+
+
+KEYS = ['runtime.fteproxy.buffers.max_connection',
+        'runtime.fteproxy.buffers.max_negotiation',
+        'runtime.fteproxy.buffers.budget',
+        'runtime.fteproxy.buffers.policy']
+
+
+@pytest.fixture(autouse=True)
+def _conf():
+    saved = {key: fteproxy.conf.getValue(key) for key in KEYS}
+    fteproxy.buffers.reset_counters()
+
+    yield
+
+    for key, value in saved.items():
+        fteproxy.conf.setValue(key, value)
+
+
+def _limits(max_connection=1000, max_negotiation=100, budget=0, policy='pause'):
+    fteproxy.conf.setValue('runtime.fteproxy.buffers.max_connection', max_connection)
+    fteproxy.conf.setValue('runtime.fteproxy.buffers.max_negotiation', max_negotiation)
+    fteproxy.conf.setValue('runtime.fteproxy.buffers.budget', budget)
+    fteproxy.conf.setValue('runtime.fteproxy.buffers.policy', policy)
+
+
+class TestAccount:
+
+    def test_pause_reads_only_what_fits(self):
+        _limits()
+        account = fteproxy.buffers.account()
+        assert account.room('decoder', 0, 400) == 400
+        assert account.room('decoder', 900, 400) == 100
+        assert account.room('negotiation', 60, 400) == 40
+        assert not any(fteproxy.buffers.counters.values())
+
+    def test_full_buffer_is_closed(self):
+        for policy in ['pause', 'close']:
+            _limits(policy=policy)
+            with pytest.raises(fteproxy.buffers.LimitExceeded):
+                fteproxy.buffers.account().room('decoder', 1000, 400)
+        assert fteproxy.buffers.counters['decoder_closed'] == 2
+
+    def test_cell_larger_than_the_buffer_is_closed(self):
+        _limits()
+        account = fteproxy.buffers.account()
+        account.hold('decoder', 10, needed=1000)
+        with pytest.raises(fteproxy.buffers.LimitExceeded):
+            account.hold('decoder', 10, needed=1001)
+
+    def test_close_policy(self):
+        _limits(policy='close')
+        account = fteproxy.buffers.account()
+        assert account.room('decoder', 900, 400) == 400
+        account.hold('decoder', 1000)
+        with pytest.raises(fteproxy.buffers.LimitExceeded):
+            account.hold('decoder', 1001)
+        assert fteproxy.buffers.counters['decoder_closed'] == 1
+
+    def test_budget(self):
+        held = fteproxy.buffers.held()
+        _limits(budget=held + 1500)
+        first = fteproxy.buffers.account()
+        second = fteproxy.buffers.account()
+
+        first.hold('decoder', 1000)
+        assert fteproxy.buffers.held() == held + 1000
+        assert second.room('decoder', 0, 1000) == 500
+        second.hold('decoder', 500)
+        with pytest.raises(fteproxy.buffers.BufferFull):
+            second.room('decoder', 500, 1000)
+        assert fteproxy.buffers.counters['budget_paused'] == 1
+
+        first.release()
+        assert fteproxy.buffers.held() == held + 500
+        assert second.room('decoder', 500, 1000) == 500
+        second.release()
+        assert fteproxy.buffers.held() == held
+
+    def test_budget_counts_allocated_memory(self):
+        held = fteproxy.buffers.held()
+        _limits(budget=held + 1500)
+        first = fteproxy.buffers.account()
+        second = fteproxy.buffers.account()
+
+        first.hold('decoder', 0, allocated=1000)
+        assert fteproxy.buffers.held() == held + 1000
+        assert second.room('decoder', 0, 1000, allocated=100) == 500
+        with pytest.raises(fteproxy.buffers.BufferFull):
+            second.room('decoder', 0, 1000, allocated=600)
+        first.release()
+
+    def test_budget_close_policy(self):
+        _limits(budget=fteproxy.buffers.held() + 1500, policy='close')
+        first = fteproxy.buffers.account()
+        second = fteproxy.buffers.account()
+        first.hold('decoder', 1000)
+        second.hold('decoder', 500)
+        with pytest.raises(fteproxy.buffers.LimitExceeded):
+            second.hold('decoder', 501)
+        assert fteproxy.buffers.counters['budget_closed'] == 1
+        first.release()
+
+
+def _recvUntilClosed(sock):
+    for _ in range(1000):
+        try:
+            sock.recv(2 ** 16)
+        except socket.timeout:
+            continue
+    raise AssertionError('the connection was never closed')
+
+
+class TestSocket:
+
+    def test_negotiation_counts_nothing(self):
+        """A negotiation that stays within the limits fires none of them,
+        though the server reads with a buffer larger than max_negotiation."""
+        profile = fteproxy.settings.current().client
+        [near, far] = socket.socketpair()
+        try:
+            client = fteproxy.wrap_socket(far,
+                                          profile.outgoing_regex, profile.outgoing_fixed_slice,
+                                          profile.incoming_regex, profile.incoming_fixed_slice,
+                                          profile.K1, profile.K2)
+            server = fteproxy.wrap_socket(near, K1=profile.K1, K2=profile.K2)
+            client.sendall(b'hello')
+            assert server.recv(2 ** 18) == b'hello'
+            assert not any(fteproxy.buffers.counters.values())
+        finally:
+            near.close()
+            far.close()
+
+    def test_undecodable_first_cell(self):
+        """A server holds at most max_negotiation bytes of a client that
+        never completes its negotiation cell."""
+        _limits(max_negotiation=2 ** 12)
+        key = fteproxy.conf.getValue('runtime.fteproxy.encrypter.key')
+        [near, far] = socket.socketpair()
+        try:
+            server = fteproxy.wrap_socket(near, K1=key[:16], K2=key[16:])
+            far.sendall(os.urandom(2 ** 14))
+            near.settimeout(1)
+            with pytest.raises(fteproxy.buffers.LimitExceeded):
+                _recvUntilClosed(server)
+            assert fteproxy.buffers.counters['negotiation_closed'] == 1
+        finally:
+            near.close()
+            far.close()
+
+    def test_oversized_cell(self):
+        """A connection waiting for a cell larger than max_connection is closed
+        once the cell's header has been read."""
+        _limits()
+        [near, far] = socket.socketpair()
+        try:
+            receiver = fteproxy.wrap_socket(near, 'a', 1, 'a', 1,
+                                            negotiate=False, engine='identity')
+            far.sendall(struct.pack('>I', 2 ** 30) + b'x' * 100)
+            near.settimeout(1)
+            with pytest.raises(fteproxy.buffers.LimitExceeded):
+                _recvUntilClosed(receiver)
+            assert fteproxy.buffers.counters['decoder_closed'] == 1
+        finally:
+            near.close()
+            far.close()
+
+
+class TestMux:
+
+    def test_window_overrun_is_refused(self):
+        session = fteproxy.mux.session(None)
+        outer = session._addStream(1)
+        try:
+            session._dispatch(1, fteproxy.mux._DATA, b'x' * fteproxy.mux._WINDOW)
+            with pytest.raises(ValueError):
+                session._dispatch(1, fteproxy.mux._DATA, b'x')
+            assert fteproxy.buffers.counters['mux_window_closed'] == 1
+        finally:
+            outer.close()
+            session._streams[1].inner.close()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for fteproxy.engines: the codec engines that the record layer and the
+negotiation encode and decode cells with.
+"""
+
+import pytest
+
+import fte.encoder
+
+import fteproxy
+import fteproxy.conf
+import fteproxy.defs
+import fteproxy.engines
+import fteproxy.record_layer
+
+
+FORMAT = 'manual-http-request'
+
+
+@pytest.fixture(autouse=True)
+def _defs():
+    fteproxy.defs.load_definitions()
+    fteproxy._recent_languages.clear()
+
+
+def _encoder(engine):
+    return fteproxy.engines.get(engine).get_encoder(
+        fteproxy.defs.getRegex(FORMAT), fteproxy.defs.getFixedSlice(FORMAT))
+
+
+def _manager(engine):
+    key = fteproxy.conf.getValue('runtime.fteproxy.encrypter.key')
+    return fteproxy.NegotiationManager(key[:16], key[16:], engine)
+
+
+def _first_cell(engine):
+    manager = _manager(engine)
+    [encoder, _] = manager._init_encoders(
+        fteproxy.defs.getRegex(FORMAT), fteproxy.defs.getFixedSlice(FORMAT), None, -1)
+    return manager._makeNegotiationCell(encoder, FORMAT)
+
+
+class TestRegistry:
+
+    def test_default_is_fte(self):
+        assert fteproxy.engines.get().name == 'fte'
+        assert isinstance(_encoder('fte'), fte.Encoder)
+
+    def test_unknown_engine(self):
+        with pytest.raises(fteproxy.engines.UnknownEngine):
+            fteproxy.engines.get('no-such-engine')
+
+    def test_register(self):
+        class reversing_encoder(fteproxy.engines.identity_encoder):
+            def encode(self, plaintext):
+                return fteproxy.engines.identity_encoder.encode(self, plaintext[::-1])
+
+            def decode(self, covertext):
+                [msg, remaining] = fteproxy.engines.identity_encoder.decode(self, covertext)
+                return [msg[::-1], remaining]
+
+        class reversing_engine(fteproxy.engines.identity_engine):
+            name = 'reversing'
+            _encoder = reversing_encoder()
+
+            def decode_cell(self, encoder, buffer, offset=0):
+                [msg, length] = fteproxy.engines.identity_engine.decode_cell(
+                    self, encoder, buffer, offset)
+                return [msg if msg is None else msg[::-1], length]
+
+        fteproxy.engines.register(reversing_engine())
+        try:
+            assert 'reversing' in fteproxy.engines.names()
+            manager = _manager('reversing')
+            [encoder, decoder] = manager._init_encoders(
+                fteproxy.defs.getRegex(FORMAT), fteproxy.defs.getFixedSlice(FORMAT),
+                fteproxy.defs.getRegex(FORMAT), fteproxy.defs.getFixedSlice(FORMAT))
+            encoder.push(b'hello')
+            covertext = encoder.pop()
+            assert covertext.endswith(b'olleh')
+            decoder.push(covertext)
+            assert decoder.pop() == b'hello'
+        finally:
+            del fteproxy.engines._engines['reversing']
+
+
+class TestIdentity:
+
+    def test_cells_are_framed_plaintext(self):
+        encoder = _encoder('identity')
+        assert encoder.encode(b'hello') == b'\x00\x00\x00\x05hello'
+        assert encoder.decode(b'\x00\x00\x00\x05hello, world') == [b'hello', b', world']
+
+    def test_incomplete_cells(self):
+        engine = fteproxy.engines.get('identity')
+        encoder = engine.get_encoder(None, -1)
+        cell = encoder.encode(b'x' * 100)
+
+        assert engine.cell_length(encoder, cell[:3]) is None
+        assert engine.cell_length(encoder, b'..' + cell, 2) == len(cell)
+        assert engine.decode_cell(encoder, cell[:50]) == [None, len(cell)]
+        with pytest.raises(fte.encoder.DecodeFailureError):
+            engine.decode_cell(encoder, cell[:3])
+        with pytest.raises(fte.encoder.DecodeFailureError):
+            encoder.decode(cell[:50])
+
+    def test_record_layer(self):
+        engine = fteproxy.engines.get('identity')
+        encoder = fteproxy.record_layer.Encoder(_encoder('identity'))
+        decoder = fteproxy.record_layer.Decoder(_encoder('identity'), engine=engine)
+
+        plaintext = bytes(range(256)) * 4096
+        encoder.push(plaintext)
+        encoder.push(b'tail')
+        covertext = encoder.pop()
+
+        received = b''
+        for i in range(0, len(covertext), 10000):
+            decoder.push(covertext[i:i + 10000])
+            received += decoder.pop()
+        assert received == plaintext + b'tail'
+
+
+class TestNegotiation:
+
+    def test_identity_negotiation(self):
+        cell = _first_cell('identity')
+        [encoder, decoder] = _manager('identity').doServerSideNegotiation(cell + b'more')
+        assert isinstance(encoder._encoder, fteproxy.engines.identity_encoder)
+
+    def test_engines_must_match(self):
+        with pytest.raises(fteproxy.NegotiationFailedException):
+            _manager('fte')._acceptNegotiation(_first_cell('identity'))
+        with pytest.raises(fteproxy.NegotiationFailedException):
+            _manager('identity')._acceptNegotiation(_first_cell('fte'))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for fteproxy.format_cache: compiled format tables written to and read
+back from a cache directory.
+"""
+
+import os
+import marshal
+
+import pytest
+
+import fte
+
+import fteproxy
+import fteproxy.conf
+import fteproxy.defs
+import fteproxy.format_cache
+
+
+FORMAT = 'manual-http-request'
+KEY = b'\x01' * 32
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    """An empty cache directory, and a process with no tables in memory."""
+    cache_dir = fteproxy.conf.getValue('fteproxy.format_cache.dir')
+    fteproxy.conf.setValue('fteproxy.format_cache.dir', str(tmp_path))
+    monkeypatch.setattr(fteproxy.format_cache, '_dfas', {})
+    monkeypatch.setattr(fteproxy.format_cache, '_encoders', {})
+    fteproxy.defs.load_definitions()
+
+    yield tmp_path
+
+    fteproxy.conf.setValue('fteproxy.format_cache.dir', cache_dir)
+
+
+def _regex_slice():
+    return (fteproxy.defs.getRegex(FORMAT), fteproxy.defs.getFixedSlice(FORMAT))
+
+
+def _forget(monkeypatch):
+    # As if a new process started: nothing in memory, and no compiling.
+    def compile_dfa(regex, fixed_slice):
+        raise AssertionError('compiled ' + regex)
+    monkeypatch.setattr(fteproxy.format_cache, '_dfas', {})
+    monkeypatch.setattr(fteproxy.format_cache, '_encoders', {})
+    monkeypatch.setattr(fteproxy.format_cache, '_compileDfa', compile_dfa)
+
+
+class TestFormatCache:
+
+    def test_cached_tables_are_read_back(self, cache_dir, monkeypatch):
+        regex, fixed_slice = _regex_slice()
+        assert fteproxy.format_cache.build([FORMAT]) == 1
+        assert fteproxy.format_cache.build([FORMAT]) == 0
+
+        _forget(monkeypatch)
+        encoder = fteproxy.format_cache.get_encoder(regex, fixed_slice, KEY)
+        covertext = fte.Encoder(regex, fixed_slice, KEY).encode(b'hello')
+        assert encoder.decode(covertext)[0] == b'hello'
+        assert fte.Encoder(regex, fixed_slice, KEY).decode(
+            encoder.encode(b'world'))[0] == b'world'
+
+    def test_tables_built_on_demand_are_written(self, cache_dir, monkeypatch):
+        regex, fixed_slice = _regex_slice()
+        fteproxy.format_cache.get_encoder(regex, fixed_slice, KEY)
+
+        _forget(monkeypatch)
+        assert fteproxy.format_cache.get_encoder(regex, fixed_slice, KEY) is not None
+
+    def test_unreadable_file_is_rebuilt(self, cache_dir):
+        regex, fixed_slice = _regex_slice()
+        fteproxy.format_cache.build([FORMAT])
+        [path] = [os.path.join(fteproxy.format_cache.directory(), name)
+                  for name in os.listdir(fteproxy.format_cache.directory())]
+        with open(path, 'wb') as fh:
+            fh.write(b'not a table')
+
+        assert fteproxy.format_cache.build([FORMAT]) == 1
+        fteproxy.format_cache._dfas.clear()
+        encoder = fteproxy.format_cache.get_encoder(regex, fixed_slice, KEY)
+        assert encoder.decode(encoder.encode(b'hello'))[0] == b'hello'
+
+    def test_no_directory_writes_nothing(self, cache_dir):
+        fteproxy.conf.setValue('fteproxy.format_cache.dir', None)
+        regex, fixed_slice = _regex_slice()
+
+        encoder = fteproxy.format_cache.get_encoder(regex, fixed_slice, KEY)
+        assert encoder.decode(encoder.encode(b'hello'))[0] == b'hello'
+        assert fteproxy.format_cache.directory() is None
+        assert os.listdir(str(cache_dir)) == []
+
+    def test_no_directory_uses_fte_constructor(self, cache_dir):
+        fteproxy.conf.setValue('fteproxy.format_cache.dir', None)
+        regex, fixed_slice = _regex_slice()
+
+        encoder = fteproxy.format_cache.get_encoder(regex, fixed_slice, KEY)
+        assert type(encoder) is fte.Encoder
+        assert fteproxy.format_cache.get_dfa(regex, fixed_slice) is not None
+        assert fteproxy.format_cache.get_encoder(regex, fixed_slice, KEY) is encoder
+
+    def test_malformed_file_is_rebuilt(self, cache_dir):
+        regex, fixed_slice = _regex_slice()
+        fteproxy.format_cache.build([FORMAT])
+        [path] = [os.path.join(fteproxy.format_cache.directory(), name)
+                  for name in os.listdir(fteproxy.format_cache.directory())]
+        with open(path, 'wb') as fh:
+            fh.write(marshal.dumps([regex, fixed_slice, 'not a dict']))
+
+        assert fteproxy.format_cache.build([FORMAT]) == 1
+
+
+class TestWarmup:
+
+    def test_loads_every_language_and_reports_ready(self, cache_dir, tmp_path):
+        status_path = str(tmp_path / 'status')
+        languages = ['manual-http-request', 'manual-http-response', 'ssh-request']
+        warmup = fteproxy.format_cache.warmup(languages, KEY, status_path)
+        assert warmup.progress() == [0, 3]
+        assert not warmup.ready
+
+        warmup.start()
+        warmup.join(30)
+        assert warmup.ready
+        assert warmup.progress() == [3, 3]
+        with open(status_path) as fh:
+            assert fh.read() == 'ready 3/3\n'
+        for language in languages:
+            assert fteproxy.format_cache.is_loaded(
+                fteproxy.defs.getRegex(language), fteproxy.defs.getFixedSlice(language))
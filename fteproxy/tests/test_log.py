@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for fteproxy.log: the levels, lazy formatting and rate limiting behind
+fteproxy.info and fteproxy.warn.
+"""
+
+import sys
+import threading
+
+import pytest
+
+import fteproxy
+import fteproxy.conf
+import fteproxy.log
+
+
+@pytest.fixture(autouse=True)
+def _conf():
+    saved = {key: fteproxy.conf.getValue(key)
+             for key in ('runtime.loglevel', 'runtime.log.rate_limit')}
+    fteproxy.log._sites.clear()
+
+    yield
+
+    for key, value in saved.items():
+        fteproxy.conf.setValue(key, value)
+
+
+def _lines(capsys):
+    fteproxy.log.flush(5)
+    return capsys.readouterr().out.splitlines()
+
+
+class _Exploding(object):
+    def __str__(self):
+        raise AssertionError('formatted a message that is not logged')
+
+
+class TestLog:
+
+    def test_levels(self, capsys):
+        fteproxy.conf.setValue('runtime.loglevel', 2)
+        fteproxy.info('an info')
+        fteproxy.warn('a warning about %s', 'something')
+        assert _lines(capsys) == ['WARN: a warning about something']
+
+    def test_disabled_message_is_not_formatted(self, capsys):
+        fteproxy.conf.setValue('runtime.loglevel', 2)
+        fteproxy.info('not formatted: %s', _Exploding())
+        assert _lines(capsys) == []
+
+    def test_message_without_arguments_is_not_formatted(self, capsys):
+        fteproxy.conf.setValue('runtime.loglevel', 3)
+        fteproxy.info('100% literal')
+        assert _lines(capsys) == ['INFO: 100% literal']
+
+    def test_each_site_is_rate_limited(self, capsys):
+        fteproxy.conf.setValue('runtime.loglevel', 3)
+        fteproxy.conf.setValue('runtime.log.rate_limit', 3)
+        for i in range(10):
+            fteproxy.info('repeated %d', i)
+        fteproxy.info('another site')
+
+        assert _lines(capsys) == ['INFO: repeated 0', 'INFO: repeated 1',
+                                  'INFO: repeated 2', 'INFO: another site']
+
+    def test_held_back_messages_are_counted(self, capsys, monkeypatch):
+        fteproxy.conf.setValue('runtime.loglevel', 3)
+        fteproxy.conf.setValue('runtime.log.rate_limit', 1)
+        now = [100.0]
+        monkeypatch.setattr(fteproxy.log.time, 'monotonic', lambda: now[0])
+
+        for second in range(2):
+            now[0] += second
+            for i in range(5):
+                fteproxy.info('tick %d', i)
+
+        assert _lines(capsys) == ['INFO: tick 0',
+                                  'INFO: tick 0 (4 more like this held back)']
+
+    def test_full_queue_drops_lines(self, capsys, monkeypatch):
+        """A thread that logs while stdout is stuck is not held up: lines
+        that do not fit the queue are dropped, and counted."""
+        writing = threading.Event()
+        release = threading.Event()
+        write = sys.stdout.write
+
+        def stuck_write(text):
+            writing.set()
+            release.wait(5)
+            return write(text)
+        monkeypatch.setattr(sys.stdout, 'write', stuck_write)
+
+        writer = fteproxy.log._lineWriter(1)
+        writer.write('INFO: first')
+        writing.wait(5)
+        writer.write('INFO: second')
+        writer.write('INFO: third')
+        release.set()
+        writer.flush(5)
+
+        assert capsys.readouterr().out.splitlines() == \
+            ['INFO: first', 'INFO: second (1 log lines dropped)']
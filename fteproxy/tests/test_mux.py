@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for fteproxy.mux: streams multiplexed over one connection, and the
+negotiation flag that asks for it.
+
+The sessions here run over a plain socket pair, since a session only needs
+its tunnel to be a reliable byte stream; tests/test_relay.py covers sessions
+over FTE between a client and a server listener.
+"""
+
+import time
+import queue
+import socket
+import threading
+
+import pytest
+
+import fteproxy
+import fteproxy.mux
+
+
+class TestNegotiateCell:
+    """Tests for the multiplexing flag of the negotiation cell."""
+
+    def test_mux_flag_round_trips(self):
+        cell = fteproxy.NegotiateCell()
+        cell.setDefFile("20131224")
+        cell.setLanguage("manual-http")
+        cell.setMux(True)
+
+        parsed = fteproxy.NegotiateCell().fromBytes(cell.toBytes())
+        assert parsed.getMux()
+        assert parsed.getDefFile() == "20131224"
+        assert parsed.getLanguage() == "manual-http"
+
+    def test_cell_without_flag_is_not_mux(self):
+        cell = fteproxy.NegotiateCell()
+        cell.setDefFile("20131224")
+        cell.setLanguage("manual-http")
+
+        cell_bytes = cell.toBytes()
+        assert cell_bytes[:fteproxy.NegotiateCell._PADDING_LEN] == \
+            fteproxy.NegotiateCell._PADDING_CHAR * fteproxy.NegotiateCell._PADDING_LEN
+        assert not fteproxy.NegotiateCell().fromBytes(cell_bytes).getMux()
+
+
+@pytest.fixture
+def sessions():
+    """A client and a server session over a socket pair; yields the client
+    session and a queue of the streams opened on the server side."""
+    client_end, server_end = socket.socketpair()
+    opened = queue.Queue()
+    client = fteproxy.mux.session(client_end)
+    server = fteproxy.mux.session(server_end, opened.put)
+    client.start()
+    server.start()
+
+    yield client, opened
+
+    client.close()
+    server.close()
+
+
+def _recv_exactly(sock, numbytes):
+    data = b''
+    while len(data) < numbytes:
+        chunk = sock.recv(numbytes - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+class TestSession:
+    """Tests for fteproxy.mux.session."""
+
+    def test_streams_carry_data_both_ways(self, sessions):
+        client, opened = sessions
+
+        streams = [client.open_stream() for _ in range(3)]
+        for i, stream in enumerate(streams):
+            stream.sendall(('request %d' % i).encode('utf-8'))
+        peers = [opened.get(timeout=5) for _ in streams]
+        for peer in peers:
+            peer.settimeout(5)
+            peer.sendall(b'reply to ' + peer.recv(1024))
+        for i, stream in enumerate(streams):
+            stream.settimeout(5)
+            assert stream.recv(1024) == ('reply to request %d' % i).encode('utf-8')
+
+    def test_close_reaches_the_peer(self, sessions):
+        client, opened = sessions
+
+        stream = client.open_stream()
+        stream.sendall(b'last words')
+        stream.close()
+        peer = opened.get(timeout=5)
+        peer.settimeout(5)
+        assert _recv_exactly(peer, 100) == b'last words'
+
+    def test_slow_stream_does_not_block_others(self, sessions):
+        """A stream whose reader stops uses up its window and stops; other
+        streams keep moving."""
+        client, opened = sessions
+
+        bulk = client.open_stream()
+        sender = threading.Thread(target=bulk.sendall,
+                                  args=(b'x' * (4 * fteproxy.mux._WINDOW),))
+        sender.daemon = True
+        sender.start()
+        bulk_peer = opened.get(timeout=5)
+
+        time.sleep(0.2)
+        interactive = client.open_stream()
+        interactive.sendall(b'ping')
+        peer = opened.get(timeout=5)
+        peer.settimeout(5)
+        assert peer.recv(1024) == b'ping'
+        assert sender.is_alive()
+
+        bulk_peer.settimeout(5)
+        assert _recv_exactly(bulk_peer, 4 * fteproxy.mux._WINDOW) == \
+            b'x' * (4 * fteproxy.mux._WINDOW)
+        sender.join(5)
+        assert not sender.is_alive()
+
+    def test_closing_the_session_ends_its_streams(self, sessions):
+        client, opened = sessions
+
+        stream = client.open_stream()
+        stream.sendall(b'hello')
+        peer = opened.get(timeout=5)
+        peer.settimeout(5)
+        assert peer.recv(1024) == b'hello'
+        client.close()
+
+        stream.settimeout(5)
+        assert stream.recv(1024) == b''
+        assert peer.recv(1024) == b''
+        assert client.closed
+        with pytest.raises(socket.error):
+            client.open_stream()
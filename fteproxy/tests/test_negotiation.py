@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for server-side negotiation: finding the language of a client's first
+cell among the request languages of the loaded definitions, and the prefix
+index that narrows down the languages to try.
+"""
+
+import pytest
+
+import fteproxy
+import fteproxy.conf
+import fteproxy.defs
+import fteproxy.classifier
+import fteproxy.format_cache
+
+
+@pytest.fixture(autouse=True)
+def _defs():
+    upstream_language = fteproxy.conf.getValue('runtime.state.upstream_language')
+    fteproxy.defs.load_definitions()
+    fteproxy._recent_languages.clear()
+
+    yield
+
+    fteproxy.conf.setValue('runtime.state.upstream_language', upstream_language)
+    fteproxy._recent_languages.clear()
+
+
+def _manager():
+    key = fteproxy.conf.getValue('runtime.fteproxy.encrypter.key')
+    return fteproxy.NegotiationManager(key[:16], key[16:])
+
+
+def _first_cell(language, data=b''):
+    """The client's first cell in ``language``, followed by ``data``
+    encoded as ordinary cells."""
+    manager = _manager()
+    fteproxy.conf.setValue('runtime.state.upstream_language', language)
+    [encoder, _] = manager._init_encoders(
+        fteproxy.defs.getRegex(language), fteproxy.defs.getFixedSlice(language),
+        None, -1)
+    cell = manager._makeNegotiationCell(encoder, language)
+    if data:
+        encoder.push(data)
+        cell += encoder.pop()
+    return cell
+
+
+def _request_languages():
+    return [language for language in fteproxy.defs.load_definitions()
+            if language.endswith('-request')]
+
+
+class TestAcceptNegotiation:
+
+    @pytest.mark.parametrize('language', _request_languages())
+    def test_every_request_language_is_found(self, language):
+        """Clients of any language are served by a server configured for
+        another one."""
+        cell = _first_cell(language)
+        fteproxy.conf.setValue('runtime.state.upstream_language', 'manual-http-request')
+
+        [negotiate_cell, remaining] = _manager()._acceptNegotiation(cell)
+        parsed = fteproxy.NegotiateCell().fromBytes(negotiate_cell)
+        assert parsed.getLanguage() + '-request' == language
+        assert remaining == b''
+
+    def test_data_after_the_first_cell_is_kept(self):
+        cell = _first_cell('ssh-request', b'first data')
+        fteproxy.conf.setValue('runtime.state.upstream_language', 'manual-http-request')
+
+        [encoder, decoder] = _manager().doServerSideNegotiation(cell)
+        assert decoder.pop() == b'first data'
+
+    def test_incomplete_cell_is_not_accepted(self):
+        cell = _first_cell('manual-http-request')
+
+        with pytest.raises(fteproxy.NegotiationFailedException):
+            _manager()._acceptNegotiation(cell[:-1])
+
+    def test_garbage_is_not_accepted(self):
+        with pytest.raises(fteproxy.NegotiationFailedException):
+            _manager()._acceptNegotiation(b'GET / HTTP/1.1\r\n\r\n' * 100)
+
+    def test_negotiated_language_is_tried_next(self):
+        cell = _first_cell('ssh-request')
+        fteproxy.conf.setValue('runtime.state.upstream_language', 'manual-http-request')
+
+        _manager()._acceptNegotiation(cell)
+        assert list(fteproxy._recent_languages) == ['ssh-request']
+
+
+class TestPrefixIndex:
+
+    @pytest.fixture
+    def index(self):
+        return fteproxy.classifier.prefix_index(_request_languages())
+
+    @pytest.mark.parametrize('language', _request_languages())
+    def test_language_of_a_cell_is_a_candidate(self, index, language):
+        cell = _first_cell(language)
+        assert language in index.candidates(cell)
+
+    def test_prefix_rules_out_other_formats(self, index):
+        candidates = index.candidates(b'GET /')
+        assert 'manual-http-request' in candidates
+        assert 'ssh-request' not in candidates
+        assert 'smtp-request' not in candidates
+
+    def test_no_data_leaves_every_language(self, index):
+        assert index.candidates(b'') == set(_request_languages())
+
+    def test_bytes_of_no_language_leave_none(self):
+        index = fteproxy.classifier.prefix_index(['manual-http-request', 'ssh-request'])
+        assert index.candidates(b'\xff\xfe') == set()
+
+    def test_languages_not_loaded_are_candidates(self, monkeypatch):
+        """Languages still to be compiled by a lazy warm-up are tried, rather
+        than compiled by the classifier."""
+        monkeypatch.setattr(fteproxy.format_cache, '_dfas', {})
+        monkeypatch.setattr(fteproxy.format_cache, '_encoders', {})
+        monkeypatch.setattr(fteproxy.classifier, '_index', None)
+        monkeypatch.setattr(fteproxy.classifier, '_unindexed', None)
+        assert fteproxy.classifier.candidates(b'GET /') == set(_request_languages())
+
+        regex = fteproxy.defs.getRegex('ssh-request')
+        fteproxy.format_cache.get_encoder(regex, fteproxy.defs.getFixedSlice('ssh-request'))
+        candidates = fteproxy.classifier.candidates(b'GET /')
+        assert 'ssh-request' not in candidates
+        assert 'manual-http-request' in candidates
@@ -4,11 +4,15 @@
 Tests for the FTE record layer encoding/decoding.
 """
 
+import os
+import time
+
 import pytest
 import fte
 
 import fteproxy.conf
 import fteproxy.defs
+import fteproxy.codec_pool
 import fteproxy.record_layer
 
 
@@ -90,6 +94,285 @@ class TestRecordLayer:
                 assert plaintext == decoded, f"Failed for {language}"
 
 
+class TestRingBuffer:
+    """Tests for the record layer's RingBuffer."""
+
+    def test_fifo_across_compaction_and_growth(self):
+        """Bytes come out in the order they went in while the buffer moves its
+        unread bytes to the front and grows."""
+        ring = fteproxy.record_layer.RingBuffer(capacity=8)
+        ring.write(b'abcdef')
+        assert bytes(ring.peek()[:2]) == b'ab'
+        ring.consume(4)
+
+        ring.write(b'ghij')     # moves 'ef' to the front
+        assert bytes(ring) == b'efghij'
+        ring.write(b'klmnop')   # grows
+        assert bytes(ring) == b'efghijklmnop'
+        ring.consume(len(ring))
+        assert len(ring) == 0
+
+    def test_reserve_and_commit(self):
+        """Data received in place through reserve() is added by commit()."""
+        ring = fteproxy.record_layer.RingBuffer(capacity=4)
+        ring.write(b'ab')
+        view = ring.reserve(8)
+        view[:3] = b'cde'
+        ring.commit(3)
+        assert bytes(ring) == b'abcde'
+
+    def test_emptied_buffer_shrinks(self):
+        """An array that grew for a large cell goes back to the buffer's
+        capacity once everything in it was read."""
+        ring = fteproxy.record_layer.RingBuffer(capacity=4)
+        ring.write(b'abcdefghij')
+        ring.consume(5)
+        assert len(ring._data) > 4
+        ring.consume(5)
+        assert len(ring._data) == 4
+        ring.write(b'kl')
+        assert bytes(ring) == b'kl'
+
+    def test_whole_chunk_is_encoded_without_a_copy(self):
+        """A pushed chunk that fits a cell reaches fte uncopied, and received
+        covertext is copied once, into fte."""
+        regex = fteproxy.defs.getRegex('manual-http-request')
+        fixed_slice = fteproxy.defs.getFixedSlice('manual-http-request')
+        regex_encoder = fte.Encoder(regex, fixed_slice)
+        encoder = fteproxy.record_layer.Encoder(encoder=regex_encoder)
+        decoder = fteproxy.record_layer.Decoder(decoder=regex_encoder)
+
+        fteproxy.record_layer.reset_counters()
+        encoder.push(b'X' * 1000)
+        covertext = encoder.pop()
+        assert fteproxy.record_layer.counters['copies'] == 0
+
+        decoder.reserve(len(covertext))[:] = covertext
+        decoder.commit(len(covertext))
+        assert decoder.pop() == b'X' * 1000
+        assert fteproxy.record_layer.counters['bytes_copied'] == len(covertext)
+
+
+@pytest.fixture(scope='module')
+def codec_pool():
+    """An fte.Encoder for manual-http-request and a codec for the same
+    format, on a two-process codec pool."""
+    regex = fteproxy.defs.getRegex('manual-http-request')
+    fixed_slice = fteproxy.defs.getFixedSlice('manual-http-request')
+    fteproxy.conf.setValue('runtime.fteproxy.record_layer.codec_pool.workers', 2)
+    yield (fte.Encoder(regex, fixed_slice),
+           fteproxy.codec_pool.codec(regex, fixed_slice))
+    fteproxy.codec_pool.shutdown()
+    fteproxy.conf.setValue('runtime.fteproxy.record_layer.codec_pool.workers', 0)
+
+
+class TestCodecPool:
+    """Tests for encoding and decoding cells in parallel on a codec pool."""
+
+    def test_cell_length(self, codec_pool):
+        """cell_length reads the length of each cell from its header alone."""
+        regex_encoder, _ = codec_pool
+        cells = [regex_encoder.encode(b'X' * n) for n in (1, 100, 5000)]
+        buffer = b''.join(cells)
+
+        offset = 0
+        for cell in cells:
+            assert fteproxy.record_layer.cell_length(regex_encoder, buffer, offset) == len(cell)
+            offset += len(cell)
+        assert fteproxy.record_layer.cell_length(regex_encoder, cells[0][:100]) is None
+
+    def test_roundtrip_in_order(self, codec_pool):
+        """Cells encoded and decoded on the pool come back in their original
+        order, and a trailing partial cell stays buffered."""
+        regex_encoder, codec = codec_pool
+        encoder = fteproxy.record_layer.Encoder(encoder=regex_encoder, codec=codec)
+        decoder = fteproxy.record_layer.Decoder(decoder=regex_encoder, codec=codec)
+
+        plaintext = os.urandom(fteproxy.record_layer.MAX_CELL_SIZE * 3 + 1000)
+        encoder.push(plaintext)
+        covertext = encoder.pop()
+
+        decoder.push(covertext[:-10])
+        decoded = decoder.pop()
+        assert plaintext.startswith(decoded)
+        assert len(decoded) == fteproxy.record_layer.MAX_CELL_SIZE * 3
+
+        decoder.push(covertext[-10:])
+        assert decoded + decoder.pop() == plaintext
+        assert bytes(decoder._buffer) == b''
+
+
+class TestPartialCells:
+    """Tests for cells that arrive over several pushes."""
+
+    def test_partial_cell_is_not_decoded_until_complete(self, codec_pool):
+        """A cell pushed in small pieces is decoded once, when its last piece
+        arrives, without any failed decode attempts in between."""
+        regex_encoder, _ = codec_pool
+        decoder = fteproxy.record_layer.Decoder(decoder=regex_encoder)
+        plaintext = os.urandom(fteproxy.record_layer.MAX_CELL_SIZE)
+        covertext = regex_encoder.encode(plaintext)
+
+        fteproxy.record_layer.reset_counters()
+        for offset in range(0, len(covertext) - 1, 16384):
+            decoder.push(covertext[offset:min(offset + 16384, len(covertext) - 1)])
+            assert decoder.pop() == b''
+            assert decoder._cell_length == len(covertext)
+        decoder.push(covertext[-1:])
+
+        assert decoder.pop() == plaintext
+        assert bytes(decoder._buffer) == b''
+        assert fteproxy.record_layer.counters['failed_decodes'] == 0
+
+    def test_cells_split_at_arbitrary_offsets(self, codec_pool):
+        """Cells that straddle pushes come out whole and in order."""
+        regex_encoder, _ = codec_pool
+        decoder = fteproxy.record_layer.Decoder(decoder=regex_encoder)
+        plaintexts = [os.urandom(n) for n in (1, 1000, 70000, 5, 3000)]
+        covertext = b''.join(regex_encoder.encode(p) for p in plaintexts)
+
+        decoded = []
+        for offset in range(0, len(covertext), 1500):
+            decoder.push(covertext[offset:offset + 1500])
+            decoded.append(decoder.pop())
+
+        assert b''.join(decoded) == b''.join(plaintexts)
+        assert bytes(decoder._buffer) == b''
+
+
+class _CountingEncoder:
+    """Encoder stub that frames each plaintext with its length, and counts
+    the cells it encoded."""
+
+    def __init__(self):
+        self.encoded = 0
+
+    def encode(self, plaintext):
+        self.encoded += 1
+        return len(plaintext).to_bytes(4, 'big') + plaintext
+
+
+class TestIterCells:
+    """Tests for yielding the encoded cells one at a time."""
+
+    def test_cells_are_encoded_as_they_are_taken(self):
+        """Each cell is encoded only once the previous one was taken, and the
+        cells add up to what ``pop`` returns."""
+        counting = _CountingEncoder()
+        encoder = fteproxy.record_layer.Encoder(encoder=counting)
+        plaintext = os.urandom(fteproxy.record_layer.MAX_CELL_SIZE * 3 + 1000)
+
+        encoder.push(plaintext)
+        cells = encoder.iter_cells()
+        assert counting.encoded == 0
+        first = next(cells)
+        assert counting.encoded == 1
+        assert first == counting.encode(plaintext[:fteproxy.record_layer.MAX_CELL_SIZE])
+        rest = list(cells)
+        assert len(rest) == 3
+        assert encoder.pop() == b''
+
+        encoder.push(plaintext)
+        assert encoder.pop() == b''.join([first] + rest)
+
+    def test_sizer_is_told_once_the_cells_are_taken(self):
+        """The time spent writing cells in between does not count as encoding
+        time."""
+        sizer = fteproxy.record_layer.CellSizer(4096, 2 ** 18, 0.05)
+        encoder = fteproxy.record_layer.Encoder(encoder=_CountingEncoder(), sizer=sizer)
+
+        encoder.push(os.urandom(20000))
+        for cell in encoder.iter_cells():
+            assert sizer.rate() is None
+            time.sleep(0.01)
+        assert sizer.rate() > 20000 / 0.01
+
+    def test_codec_pool_cells_in_order(self, codec_pool):
+        """Cells encoded on a codec pool are yielded in their original order."""
+        regex_encoder, codec = codec_pool
+        encoder = fteproxy.record_layer.Encoder(encoder=regex_encoder, codec=codec)
+        decoder = fteproxy.record_layer.Decoder(decoder=regex_encoder)
+
+        plaintext = os.urandom(fteproxy.record_layer.MAX_CELL_SIZE * 3 + 1000)
+        encoder.push(plaintext)
+        decoded = b''
+        for cell in encoder.iter_cells():
+            decoder.push(cell)
+            decoded += decoder.pop()
+        assert decoded == plaintext
+
+
+class TestCellSizer:
+    """Tests for adaptive cell sizing."""
+
+    def test_interactive_shrinks_to_rate(self):
+        """Writes with pauses in between shrink the cell size, by at most a
+        halving at a time, to what the connection encodes and writes within the
+        target latency, but no lower than the minimum."""
+        sizer = fteproxy.record_layer.CellSizer(4096, 2 ** 18, 0.05)
+        sizer.cell_size = 2 ** 18
+        sizes = []
+        for _ in range(10):
+            # 1 MB/s, so 50 KB within the target latency.
+            sizer.encoded(20000, 0.01)
+            sizer.written(20000, 0.01)
+            sizes.append(sizer.cell_size)
+            time.sleep(0.05)
+        assert 32768 <= sizer.cell_size <= 65536
+        assert all(b >= a // 2 for a, b in zip(sizes, sizes[1:]))
+
+        sizer = fteproxy.record_layer.CellSizer(4096, 2 ** 18, 0.05)
+        sizer.cell_size = 2 ** 18
+        for _ in range(10):
+            # 20 KB/s, so 1 KB within the target latency.
+            sizer.encoded(20000, 0.01)
+            sizer.written(20000, 1.0)
+            time.sleep(0.05)
+        assert sizer.cell_size == 4096
+
+    def test_small_writes_are_not_measured(self):
+        """Writes below the minimum cell size leave the cell size alone."""
+        sizer = fteproxy.record_layer.CellSizer(4096, 2 ** 18, 0.05)
+        for _ in range(5):
+            sizer.encoded(64, 0.001)
+            sizer.written(64, 0.001)
+            time.sleep(0.05)
+        assert sizer.rate() is None
+        assert sizer.cell_size == 4096
+
+    def test_bulk_switches_to_max(self):
+        """Back-to-back writes that fill their cells switch to the largest
+        cells, however slow the connection."""
+        sizer = fteproxy.record_layer.CellSizer(4096, 2 ** 18, 0.05)
+        sizer.written(20000, 1.0)
+        time.sleep(0.05)
+        sizer.encoded(20000, 0.01)
+        assert sizer.cell_size == 4096
+
+        sizer.written(20000, 1.0)
+        sizer.encoded(20000, 0.01)
+        assert sizer.cell_size == 2 ** 18
+
+    def test_encoder_cuts_cells_at_cell_size(self):
+        """The encoder cuts cells at the sizer's current cell size, and they
+        decode back to the data pushed."""
+        regex = fteproxy.defs.getRegex('manual-http-request')
+        fixed_slice = fteproxy.defs.getFixedSlice('manual-http-request')
+        regex_encoder = fte.Encoder(regex, fixed_slice)
+        sizer = fteproxy.record_layer.CellSizer(4096, 2 ** 18, 0.05)
+        encoder = fteproxy.record_layer.Encoder(encoder=regex_encoder, sizer=sizer)
+        decoder = fteproxy.record_layer.Decoder(decoder=regex_encoder)
+
+        plaintext = os.urandom(10000)
+        encoder.push(plaintext)
+        covertext = encoder.pop()
+
+        assert fteproxy.record_layer.cell_length(regex_encoder, covertext) == \
+            len(regex_encoder.encode(plaintext[:4096]))
+        decoder.push(covertext)
+        assert decoder.pop() == plaintext
+
+
 class _RaisingDecoder:
     """Decoder stub whose decode() always raises a given exception."""
 
@@ -137,7 +420,7 @@ class TestDecoderExceptionHandling:
         decoder.push(b'AAAABBBBCCCC')
 
         assert decoder.pop(oneCell=True) == b'AAAA'
-        assert decoder._buffer == b'BBBBCCCC'
+        assert bytes(decoder._buffer) == b'BBBBCCCC'
 
     def test_multicell_drains_entire_buffer(self):
         """oneCell=False drains every cell from the buffer."""
@@ -145,4 +428,4 @@ class TestDecoderExceptionHandling:
         decoder.push(b'AAAABBBBCCCC')
 
         assert decoder.pop() == b'AAAABBBBCCCC'
-        assert decoder._buffer == b''
+        assert bytes(decoder._buffer) == b''
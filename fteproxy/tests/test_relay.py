@@ -7,6 +7,8 @@ Integration tests for the FTE relay (client/server communication).
 import time
 import socket
 import random
+import threading
+import collections
 
 import pytest
 
@@ -16,15 +18,17 @@ import fteproxy.network_io
 import fteproxy.relay
 import fteproxy.client
 import fteproxy.server
+import fteproxy.settings
 
 
 LOCAL_INTERFACE = '127.0.0.1'
 
 
-@pytest.fixture
-def relay_setup():
-    """Set up client and server for relay testing."""
+@pytest.fixture(params=['threads', 'selectors'])
+def relay_setup(request):
+    """Set up client and server for relay testing, once per relay backend."""
     time.sleep(1)
+    fteproxy.conf.setValue('runtime.fteproxy.relay.backend', request.param)
     
     server = fteproxy.server.listener(
         LOCAL_INTERFACE,
@@ -48,6 +52,7 @@ def relay_setup():
     # Cleanup
     server.stop()
     client.stop()
+    fteproxy.conf.setValue('runtime.fteproxy.relay.backend', 'threads')
 
 
 class TestRelay:
@@ -58,6 +63,55 @@ class TestRelay:
         for i in range(10):
             self._test_single_stream()
 
+    def test_concurrent_streams(self, relay_setup):
+        """Test many simultaneously open tunnels through the relay."""
+        num_streams = 20
+        proxy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        proxy_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        proxy_socket.bind((LOCAL_INTERFACE, fteproxy.conf.getValue('runtime.proxy.port')))
+        proxy_socket.listen(fteproxy.conf.getValue('runtime.fteproxy.relay.backlog'))
+        proxy_socket.settimeout(10)
+
+        def workers():
+            return [t for t in threading.enumerate()
+                    if isinstance(t, fteproxy.relay.worker)]
+        workers_before = len(workers())
+
+        client_sockets = []
+        server_conns = []
+        try:
+            for i in range(num_streams):
+                client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                client_socket.connect((LOCAL_INTERFACE, fteproxy.conf.getValue('runtime.client.port')))
+                client_socket.settimeout(10)
+                client_sockets.append(client_socket)
+                client_socket.sendall(('stream %d;' % i).encode('utf-8'))
+                server_conn, addr = proxy_socket.accept()
+                server_conn.settimeout(10)
+                server_conns.append(server_conn)
+
+            # Every tunnel is open at once; echo back over each of them.
+            for server_conn in server_conns:
+                data = server_conn.recv(1024)
+                assert data.startswith(b'stream ')
+                server_conn.sendall(data)
+            for i, client_socket in enumerate(client_sockets):
+                expected = ('stream %d;' % i).encode('utf-8')
+                actual = b''
+                while len(actual) < len(expected):
+                    data = client_socket.recv(1024)
+                    if not data:
+                        break
+                    actual += data
+                assert actual == expected
+
+            if fteproxy.conf.getValue('runtime.fteproxy.relay.backend') == 'selectors':
+                # One event loop per listener, no per-tunnel threads.
+                assert len(workers()) <= workers_before
+        finally:
+            for sock in client_sockets + server_conns + [proxy_socket]:
+                fteproxy.network_io.close_socket(sock)
+
     def _test_single_stream(self):
         """Test a single data stream through the relay."""
         uniq_id = str(random.choice(range(2 ** 10)))
@@ -113,3 +167,642 @@ class TestRelay:
                 fteproxy.network_io.close_socket(client_socket)
 
         assert expected_msg == actual_msg
+
+
+def _echo_server():
+    """A threaded echo server on a free port; returns its listening socket."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((LOCAL_INTERFACE, 0))
+    sock.listen(16)
+
+    def echo(conn):
+        while True:
+            data = conn.recv(1024)
+            if not data:
+                break
+            conn.sendall(data)
+        conn.close()
+
+    def serve():
+        while True:
+            try:
+                conn, addr = sock.accept()
+            except socket.error:
+                return
+            threading.Thread(target=echo, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return sock
+
+
+@pytest.fixture
+def pooled_relay():
+    """A plain relay.listener with a worker pool of two slots, in front of an
+    echo server."""
+    fteproxy.conf.setValue('runtime.fteproxy.relay.pool_size', 2)
+    fteproxy.conf.setValue('runtime.fteproxy.relay.queue_timeout', 1)
+    echo = _echo_server()
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind((LOCAL_INTERFACE, 0))
+    port = probe.getsockname()[1]
+    probe.close()
+
+    relay = fteproxy.relay.listener(LOCAL_INTERFACE, port,
+                                    LOCAL_INTERFACE, echo.getsockname()[1])
+    relay.start()
+    time.sleep(0.5)
+
+    yield relay, port
+
+    relay.stop()
+    echo.close()
+    fteproxy.conf.setValue('runtime.fteproxy.relay.pool_size', 0)
+    fteproxy.conf.setValue('runtime.fteproxy.relay.queue_timeout', 10)
+
+
+def _echoes(sock, msg):
+    sock.sendall(msg)
+    try:
+        return sock.recv(1024) == msg
+    except socket.timeout:
+        return False
+
+
+def _wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.05)
+    return predicate()
+
+
+class TestWorkerPool:
+    """Tests for relaying tunnels on a bounded relay.worker_pool."""
+
+    def test_tunnels_beyond_pool_size_wait_for_a_slot(self, pooled_relay):
+        """A tunnel beyond the pool size is queued until a slot frees up, and
+        no threads are created for it."""
+        relay, port = pooled_relay
+
+        sockets = [socket.create_connection((LOCAL_INTERFACE, port), timeout=0.5)
+                   for _ in range(3)]
+        try:
+            # Tunnels connect concurrently, so any one of them may be the one
+            # queued.
+            assert _wait_for(lambda: relay.stats.get('queued') == 1)
+            echoed = [_echoes(sock, msg) for sock, msg
+                      in zip(sockets, [b'one', b'two', b'three'])]
+            assert sorted(echoed) == [False, True, True]
+            queued = echoed.index(False)
+            # Pool slots run their workers inline, on the threads they own.
+            assert not [t for t in threading.enumerate()
+                        if isinstance(t, fteproxy.relay.worker)]
+
+            sockets[echoed.index(True)].close()
+            sockets[queued].settimeout(5)
+            assert sockets[queued].recv(1024) == [b'one', b'two', b'three'][queued]
+            assert relay.stats.get('queued') == 0
+            assert _wait_for(lambda: relay.stats.get('active') == 2)
+        finally:
+            for sock in sockets:
+                fteproxy.network_io.close_socket(sock)
+
+    def test_queue_timeout(self, pooled_relay):
+        """A tunnel that waits longer than the queue timeout is closed."""
+        relay, port = pooled_relay
+
+        sockets = [socket.create_connection((LOCAL_INTERFACE, port), timeout=5)
+                   for _ in range(3)]
+        try:
+            assert _echoes(sockets[0], b'one')
+            assert _echoes(sockets[1], b'two')
+            assert sockets[2].recv(1024) == b''
+            assert relay.stats.get('failed') == 1
+            assert relay.stats.get('queued') == 0
+        finally:
+            for sock in sockets:
+                fteproxy.network_io.close_socket(sock)
+
+
+def _free_port():
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind((LOCAL_INTERFACE, 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+_tunnel = collections.namedtuple('_tunnel', ['client', 'server', 'client_port', 'server_port'])
+
+
+@pytest.fixture
+def tunnel():
+    """Start an fteproxy client and server in front of an echo server with
+    ``tunnel(backend, settings, **listener_kwargs)``: on the relay ``backend``,
+    with the ``fteproxy.conf`` values in ``settings``, and with
+    ``listener_kwargs`` passed to both listeners. They are stopped, and the
+    settings put back, after the test."""
+    started = []
+    saved = {}
+
+    def start(backend='threads', settings=None, **listener_kwargs):
+        settings = dict(settings or {})
+        settings['runtime.fteproxy.relay.backend'] = backend
+        for key, value in settings.items():
+            saved.setdefault(key, fteproxy.conf.getValue(key))
+            fteproxy.conf.setValue(key, value)
+
+        echo = _echo_server()
+        server_port = _free_port()
+        client_port = _free_port()
+        server = fteproxy.server.listener(LOCAL_INTERFACE, server_port,
+                                          LOCAL_INTERFACE, echo.getsockname()[1],
+                                          **listener_kwargs)
+        client = fteproxy.client.listener(LOCAL_INTERFACE, client_port,
+                                          LOCAL_INTERFACE, server_port,
+                                          **listener_kwargs)
+        server.start()
+        client.start()
+        time.sleep(0.5)
+        started.append((client, server, echo))
+        return _tunnel(client, server, client_port, server_port)
+
+    yield start
+
+    for client, server, echo in started:
+        client.stop()
+        server.stop()
+        echo.close()
+    for key, value in saved.items():
+        fteproxy.conf.setValue(key, value)
+
+
+@pytest.fixture(params=['threads', 'selectors'])
+def coalescing_tunnel(request, tunnel):
+    """An fteproxy client and server whose listeners coalesce writes, in front
+    of an echo server, once per relay backend."""
+    return tunnel(request.param, coalesce_window=0.01, coalesce_bytes=4096).client_port
+
+
+class TestCoalescing:
+    """Tests for listeners that coalesce the writes of their tunnels."""
+
+    def test_small_writes_are_relayed(self, coalescing_tunnel):
+        """Small writes in quick succession all come back, in order."""
+        sock = socket.create_connection((LOCAL_INTERFACE, coalescing_tunnel), timeout=5)
+        try:
+            expected = b''
+            for i in range(20):
+                msg = ('message %d;' % i).encode('utf-8')
+                sock.sendall(msg)
+                expected += msg
+
+            received = b''
+            while len(received) < len(expected):
+                data = sock.recv(1024)
+                if not data:
+                    break
+                received += data
+            assert received == expected
+        finally:
+            sock.close()
+
+    @pytest.mark.parametrize('backend', ['threads', 'selectors'])
+    def test_small_write_waits_for_the_window(self, tunnel, backend):
+        """A small write is held back for the window by the fteproxy writer on
+        each side of the tunnel."""
+        client_port = tunnel(backend, coalesce_window=0.5).client_port
+        sock = socket.create_connection((LOCAL_INTERFACE, client_port), timeout=5)
+        try:
+            assert _echoes(sock, b'warm up')
+            start = time.time()
+            assert _echoes(sock, b'ping')
+            assert time.time() - start >= 1.0
+        finally:
+            sock.close()
+
+
+class TestSettingsSnapshot:
+    """Tests for setting up each tunnel with one snapshot of the settings."""
+
+    def test_reload_during_setup(self):
+        """Settings that change while a tunnel is set up apply to the next
+        tunnel, not to part of this one."""
+        settings = fteproxy.settings.current()
+        seen = []
+
+        class reloading_listener(fteproxy.relay.listener):
+            def onNewIncomingConnection(self, socket):
+                fteproxy.conf.setValue('runtime.fteproxy.relay.socket_timeout',
+                                       settings.socket_timeout + 1)
+                return socket
+
+            def onNewOutgoingConnection(self, socket):
+                seen.append(self._settings())
+                return socket
+
+        relay = reloading_listener(LOCAL_INTERFACE, 0, LOCAL_INTERFACE, 0)
+        [a, b] = socket.socketpair()
+        try:
+            relay._setupConnection(a, b, settings)
+            assert seen == [settings]
+            assert a.gettimeout() == b.gettimeout() == settings.socket_timeout
+            assert relay._settings().socket_timeout == settings.socket_timeout + 1
+        finally:
+            a.close()
+            b.close()
+            fteproxy.conf.setValue('runtime.fteproxy.relay.socket_timeout',
+                                   settings.socket_timeout)
+
+
+class TestEngine:
+    """Tests for listeners that encode their tunnels with a codec engine other
+    than the one in fteproxy.conf."""
+
+    @pytest.mark.parametrize('backend', ['threads', 'selectors'])
+    def test_identity_tunnel(self, tunnel, backend):
+        """A client and server that both use the identity engine relay data."""
+        identity = tunnel(backend, engine='identity')
+        sock = socket.create_connection((LOCAL_INTERFACE, identity.client_port), timeout=5)
+        try:
+            assert _echoes(sock, b'framed, not encoded')
+        finally:
+            sock.close()
+        assert identity.server.stats.get('failed') == 0
+
+
+def _blackhole():
+    """A listening socket that never accepts, with its accept queue already
+    full, so that connects to it hang until they time out."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((LOCAL_INTERFACE, 0))
+    sock.listen(0)
+    filler = socket.create_connection(sock.getsockname(), timeout=1)
+    return sock, filler
+
+
+@pytest.fixture(params=['threads', 'selectors'])
+def blackholed_relay(request):
+    """A plain relay.listener in front of an upstream that never completes a
+    connect, with a short connect timeout, once per relay backend."""
+    fteproxy.conf.setValue('runtime.fteproxy.relay.backend', request.param)
+    fteproxy.conf.setValue('runtime.fteproxy.relay.connect_timeout', 0.5)
+    upstream, filler = _blackhole()
+    port = _free_port()
+
+    def start(connect_concurrency):
+        fteproxy.conf.setValue('runtime.fteproxy.relay.connect_concurrency',
+                               connect_concurrency)
+        relay = fteproxy.relay.listener(LOCAL_INTERFACE, port,
+                                        LOCAL_INTERFACE, upstream.getsockname()[1])
+        relay.start()
+        time.sleep(0.5)
+        relays.append(relay)
+        return relay
+
+    relays = []
+    yield start, port
+
+    for relay in relays:
+        relay.stop()
+    filler.close()
+    upstream.close()
+    fteproxy.conf.setValue('runtime.fteproxy.relay.backend', 'threads')
+    fteproxy.conf.setValue('runtime.fteproxy.relay.connect_timeout', 10)
+    fteproxy.conf.setValue('runtime.fteproxy.relay.connect_concurrency', 64)
+
+
+class TestUpstreamConnect:
+    """Tests for connecting to the upstream off the accept loop."""
+
+    def test_slow_connect_does_not_block_accept(self, blackholed_relay):
+        """Connections keep being accepted while upstream connects hang, and
+        those connects time out."""
+        start, port = blackholed_relay
+        relay = start(64)
+
+        sockets = [socket.create_connection((LOCAL_INTERFACE, port), timeout=5)
+                   for _ in range(3)]
+        try:
+            assert _wait_for(lambda: relay.stats.get('accepted') == 3, timeout=0.4)
+            assert relay.stats.get('connecting') == 3
+
+            assert _wait_for(lambda: relay.stats.get('failed') == 3)
+            assert relay.stats.get('connecting') == 0
+            for sock in sockets:
+                assert sock.recv(1024) == b''
+        finally:
+            for sock in sockets:
+                fteproxy.network_io.close_socket(sock)
+
+    def test_connect_concurrency(self, blackholed_relay):
+        """No more than connect_concurrency connects are in flight at once."""
+        start, port = blackholed_relay
+        relay = start(1)
+
+        sockets = [socket.create_connection((LOCAL_INTERFACE, port), timeout=5)
+                   for _ in range(3)]
+        try:
+            assert _wait_for(lambda: relay.stats.get('accepted') == 3, timeout=0.4)
+            assert _wait_for(lambda: relay.stats.get('failed') >= 1)
+            assert relay.stats.get('failed') < 3
+            assert _wait_for(lambda: relay.stats.get('failed') == 3)
+        finally:
+            for sock in sockets:
+                fteproxy.network_io.close_socket(sock)
+
+    def test_stop_with_connects_in_flight(self, blackholed_relay):
+        """Connections whose upstream connects are in flight when the relay
+        stops are closed, and no longer counted as connecting."""
+        start, port = blackholed_relay
+        relay = start(64)
+
+        sock = socket.create_connection((LOCAL_INTERFACE, port), timeout=5)
+        try:
+            assert _wait_for(lambda: relay.stats.get('connecting') == 1, timeout=0.4)
+            relay.stop()
+            assert _wait_for(lambda: relay.stats.get('connecting') == 0, timeout=2)
+            assert sock.recv(1024) == b''
+        finally:
+            fteproxy.network_io.close_socket(sock)
+
+
+    def test_slow_setup_does_not_block_other_tunnels(self):
+        """With the selectors backend, a tunnel whose sockets take long to
+        wrap does not hold up relaying the others."""
+        fteproxy.conf.setValue('runtime.fteproxy.relay.backend', 'selectors')
+        echo = _echo_server()
+        release = threading.Event()
+        setups = []
+
+        class slow_listener(fteproxy.relay.listener):
+            def onNewIncomingConnection(self, socket):
+                setups.append(socket)
+                if len(setups) == 1:
+                    release.wait(5)
+                return socket
+
+        port = _free_port()
+        relay = slow_listener(LOCAL_INTERFACE, port, LOCAL_INTERFACE, echo.getsockname()[1])
+        relay.start()
+        time.sleep(0.5)
+        slow = socket.create_connection((LOCAL_INTERFACE, port), timeout=5)
+        fast = socket.create_connection((LOCAL_INTERFACE, port), timeout=1)
+        try:
+            assert _wait_for(lambda: len(setups) == 2, timeout=1)
+            assert _echoes(fast, b'not held up')
+            release.set()
+            assert _echoes(slow, b'set up at last')
+        finally:
+            release.set()
+            slow.close()
+            fast.close()
+            relay.stop()
+            echo.close()
+            fteproxy.conf.setValue('runtime.fteproxy.relay.backend', 'threads')
+
+
+def _collecting_server():
+    """A listening socket on a free port whose accepted connections are
+    appended to a list; returns both."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((LOCAL_INTERFACE, 0))
+    sock.listen(16)
+    accepted = []
+
+    def serve():
+        while True:
+            try:
+                conn, addr = sock.accept()
+            except socket.error:
+                return
+            accepted.append(conn)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return sock, accepted
+
+
+class TestUpstreamPool:
+    """Tests for relay.upstream_pool and the server listener that uses it."""
+
+    def test_keeps_min_idle_connections(self):
+        """The pool connects ahead of time, and replaces a connection once
+        it is taken."""
+        upstream, accepted = _collecting_server()
+        pool = fteproxy.relay.upstream_pool(
+            LOCAL_INTERFACE, upstream.getsockname()[1], 2, 60, 1, 5)
+        try:
+            assert _wait_for(lambda: len(accepted) == 2)
+            sock = pool.get()
+            assert sock is not None
+            assert _wait_for(lambda: len(accepted) == 3)
+            time.sleep(0.2)
+            assert len(accepted) == 3
+            sock.close()
+        finally:
+            pool.stop()
+            upstream.close()
+
+    def test_skips_connections_closed_by_the_upstream(self):
+        """``get`` does not hand out a connection the upstream has closed."""
+        upstream, accepted = _collecting_server()
+        pool = fteproxy.relay.upstream_pool(
+            LOCAL_INTERFACE, upstream.getsockname()[1], 1, 60, 1, 5)
+        try:
+            assert _wait_for(lambda: len(accepted) == 1)
+            accepted[0].close()
+            time.sleep(0.1)
+            sock = pool.get()
+            assert sock is None or fteproxy.relay._is_open(sock)
+        finally:
+            pool.stop()
+            upstream.close()
+
+    def test_expires_old_connections(self):
+        """Idle connections older than ``max_age`` are replaced."""
+        upstream, accepted = _collecting_server()
+        pool = fteproxy.relay.upstream_pool(
+            LOCAL_INTERFACE, upstream.getsockname()[1], 1, 0.2, 1, 0.1)
+        try:
+            assert _wait_for(lambda: len(accepted) >= 3)
+        finally:
+            pool.stop()
+            upstream.close()
+
+    @pytest.mark.parametrize('backend', ['threads', 'selectors'])
+    def test_tunnel_through_pooled_server(self, tunnel, backend):
+        """Tunnels through a server with an upstream pool take their upstream
+        connections from it."""
+        pooled = tunnel(backend, {'runtime.fteproxy.relay.upstream_pool.min_idle': 2})
+        server = pooled.server
+        assert _wait_for(lambda: server._upstream_pool is not None
+                         and len(server._upstream_pool._idle) == 2)
+        sockets = [socket.create_connection((LOCAL_INTERFACE, pooled.client_port),
+                                            timeout=5)
+                   for _ in range(3)]
+        try:
+            for i, sock in enumerate(sockets):
+                assert _echoes(sock, ('pooled %d' % i).encode('utf-8'))
+        finally:
+            for sock in sockets:
+                sock.close()
+        assert server.stats.get('failed') == 0
+        assert _wait_for(lambda: len(server._upstream_pool._idle) == 2)
+
+
+@pytest.fixture(params=['threads', 'selectors'])
+def mux_tunnel(request):
+    """An fteproxy client that multiplexes its tunnels, once per relay backend
+    of the client, and a server that accepts that, in front of an echo
+    server."""
+    fteproxy.conf.setValue('runtime.fteproxy.mux', True)
+    echo = _echo_server()
+    server_port = _free_port()
+    client_port = _free_port()
+    server = fteproxy.server.listener(LOCAL_INTERFACE, server_port,
+                                      LOCAL_INTERFACE, echo.getsockname()[1])
+    server.start()
+    # The server reads its backend once it runs; it must stay on threads.
+    time.sleep(0.5)
+    fteproxy.conf.setValue('runtime.fteproxy.relay.backend', request.param)
+    client = fteproxy.client.listener(LOCAL_INTERFACE, client_port,
+                                      LOCAL_INTERFACE, server_port)
+    client.start()
+    time.sleep(0.5)
+
+    yield server, client_port, server_port
+
+    client.stop()
+    server.stop()
+    echo.close()
+    fteproxy.conf.setValue('runtime.fteproxy.relay.backend', 'threads')
+    fteproxy.conf.setValue('runtime.fteproxy.mux', False)
+
+
+class TestMux:
+    """Tests for tunnels multiplexed over one connection to the server."""
+
+    def test_session_connect_does_not_block_the_event_loop(self):
+        """With the selectors backend, a client whose session to the server
+        hangs connecting keeps accepting tunnels."""
+        fteproxy.conf.setValue('runtime.fteproxy.mux', True)
+        fteproxy.conf.setValue('runtime.fteproxy.relay.backend', 'selectors')
+        fteproxy.conf.setValue('runtime.fteproxy.relay.connect_timeout', 2)
+        upstream, filler = _blackhole()
+        client_port = _free_port()
+        client = fteproxy.client.listener(LOCAL_INTERFACE, client_port,
+                                          LOCAL_INTERFACE, upstream.getsockname()[1])
+        client.start()
+        time.sleep(0.5)
+        sockets = []
+        try:
+            for _ in range(2):
+                sockets.append(socket.create_connection((LOCAL_INTERFACE, client_port),
+                                                        timeout=5))
+            assert _wait_for(lambda: client.stats.get('accepted') == 2, timeout=0.5)
+            assert _wait_for(lambda: client.stats.get('failed') == 2)
+        finally:
+            for sock in sockets:
+                sock.close()
+            client.stop()
+            filler.close()
+            upstream.close()
+            fteproxy.conf.setValue('runtime.fteproxy.relay.backend', 'threads')
+            fteproxy.conf.setValue('runtime.fteproxy.relay.connect_timeout', 10)
+            fteproxy.conf.setValue('runtime.fteproxy.mux', False)
+
+    def test_tunnels_share_one_connection(self, mux_tunnel):
+        """Serial and concurrent tunnels all work, over one connection."""
+        server, client_port, server_port = mux_tunnel
+
+        for i in range(5):
+            sock = socket.create_connection((LOCAL_INTERFACE, client_port), timeout=5)
+            try:
+                assert _echoes(sock, ('serial %d' % i).encode('utf-8'))
+            finally:
+                sock.close()
+
+        sockets = [socket.create_connection((LOCAL_INTERFACE, client_port), timeout=5)
+                   for _ in range(5)]
+        try:
+            for i, sock in enumerate(sockets):
+                assert _echoes(sock, ('concurrent %d' % i).encode('utf-8'))
+        finally:
+            for sock in sockets:
+                sock.close()
+
+        # The one connection of the session, and the ten streams carried by it.
+        assert server.stats.get('accepted') == 11
+        assert server.stats.get('failed') == 0
+
+    def test_client_without_mux_is_still_served(self, mux_tunnel):
+        """A server that accepts multiplexed connections relays ordinary ones
+        as before."""
+        server, client_port, server_port = mux_tunnel
+        fteproxy.conf.setValue('runtime.fteproxy.mux', False)
+        plain_port = _free_port()
+        client = fteproxy.client.listener(LOCAL_INTERFACE, plain_port,
+                                          LOCAL_INTERFACE, server_port)
+        client.start()
+        time.sleep(0.5)
+        try:
+            sock = socket.create_connection((LOCAL_INTERFACE, plain_port), timeout=5)
+            try:
+                assert _echoes(sock, b'not multiplexed')
+            finally:
+                sock.close()
+        finally:
+            client.stop()
+
+    def test_silent_client_does_not_hold_up_streams(self, tunnel):
+        """A client that never sends its negotiation cell does not keep the
+        streams of a session from connecting upstream."""
+        mux = tunnel(settings={'runtime.fteproxy.mux': True,
+                               'runtime.fteproxy.relay.connect_concurrency': 1})
+        sock = socket.create_connection((LOCAL_INTERFACE, mux.client_port), timeout=5)
+        try:
+            assert _echoes(sock, b'first')
+        finally:
+            sock.close()
+
+        silent = socket.create_connection((LOCAL_INTERFACE, mux.server_port), timeout=5)
+        try:
+            time.sleep(0.2)
+            sock = socket.create_connection((LOCAL_INTERFACE, mux.client_port), timeout=2)
+            try:
+                assert _echoes(sock, b'second')
+            finally:
+                sock.close()
+        finally:
+            silent.close()
+
+    def test_refused_by_server_without_mux(self):
+        """A server that does not accept multiplexed connections closes them,
+        rather than relaying their frames upstream."""
+        echo = _echo_server()
+        server_port = _free_port()
+        client_port = _free_port()
+        server = fteproxy.server.listener(LOCAL_INTERFACE, server_port,
+                                          LOCAL_INTERFACE, echo.getsockname()[1])
+        server.start()
+        time.sleep(0.5)
+        fteproxy.conf.setValue('runtime.fteproxy.mux', True)
+        client = fteproxy.client.listener(LOCAL_INTERFACE, client_port,
+                                          LOCAL_INTERFACE, server_port)
+        client.start()
+        time.sleep(0.5)
+        try:
+            sock = socket.create_connection((LOCAL_INTERFACE, client_port), timeout=5)
+            try:
+                sock.sendall(b'multiplexed')
+                try:
+                    data = sock.recv(1024)
+                except ConnectionResetError:
+                    data = b''
+                assert data == b''
+            finally:
+                sock.close()
+        finally:
+            client.stop()
+            server.stop()
+            echo.close()
+            fteproxy.conf.setValue('runtime.fteproxy.mux', False)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for fteproxy.settings: snapshots of fteproxy.conf, and config files
+loaded into them.
+"""
+
+import json
+
+import pytest
+
+import fteproxy.conf
+import fteproxy.defs
+import fteproxy.settings
+
+
+KEY = '0123456789abcdef' * 4
+
+
+@pytest.fixture(autouse=True)
+def _conf():
+    saved = {key: fteproxy.conf.getValue(key)
+             for key in list(fteproxy.settings.RELOADABLE) + ['runtime.fteproxy.config_file']}
+
+    yield
+
+    for key, value in saved.items():
+        fteproxy.conf.setValue(key, value)
+
+
+def _config(tmp_path, settings):
+    path = tmp_path / 'fteproxy.json'
+    path.write_text(json.dumps(settings))
+    return str(path)
+
+
+class TestSnapshot:
+
+    def test_shared_until_conf_changes(self):
+        snapshot = fteproxy.settings.current()
+        assert fteproxy.settings.current() is snapshot
+
+        fteproxy.conf.setValue('runtime.fteproxy.relay.throttle', 0.5)
+        assert fteproxy.settings.current() is not snapshot
+        assert fteproxy.settings.current().throttle == 0.5
+        assert snapshot.throttle == 0.01
+
+    def test_read_only(self):
+        snapshot = fteproxy.settings.current()
+        with pytest.raises(AttributeError):
+            snapshot.throttle = 1
+        with pytest.raises(TypeError):
+            snapshot.values['runtime.fteproxy.relay.throttle'] = 1
+
+    def test_profiles(self):
+        fteproxy.conf.setValue('runtime.state.upstream_language', 'ssh-request')
+        fteproxy.conf.setValue('runtime.state.downstream_language', 'ssh-response')
+        fteproxy.conf.setValue('runtime.fteproxy.encrypter.key', bytes.fromhex(KEY))
+
+        snapshot = fteproxy.settings.current()
+        assert snapshot.client == (
+            fteproxy.defs.getRegex('ssh-request'), fteproxy.defs.getFixedSlice('ssh-request'),
+            fteproxy.defs.getRegex('ssh-response'), fteproxy.defs.getFixedSlice('ssh-response'),
+            bytes.fromhex(KEY)[:16], bytes.fromhex(KEY)[16:], 'ssh-request')
+        assert snapshot.server == (None, -1, None, -1,
+                                   bytes.fromhex(KEY)[:16], bytes.fromhex(KEY)[16:], None)
+
+
+class TestLoad:
+
+    def test_load(self, tmp_path):
+        snapshot = fteproxy.settings.load(_config(tmp_path, {
+            'runtime.fteproxy.encrypter.key': KEY,
+            'runtime.fteproxy.relay.connect_timeout': 2.5,
+        }))
+
+        assert fteproxy.settings.current() is snapshot
+        assert snapshot.connect_timeout == 2.5
+        assert snapshot.client.K1 + snapshot.client.K2 == bytes.fromhex(KEY)
+        assert fteproxy.conf.getValue('runtime.fteproxy.encrypter.key') == bytes.fromhex(KEY)
+
+    @pytest.mark.parametrize('settings', [
+        {'runtime.server.port': 9000},
+        {'runtime.fteproxy.encrypter.key': 'abcd'},
+        {'runtime.fteproxy.relay.connect_timeout': 0},
+        {'runtime.state.upstream_language': 'no-such-request'},
+        {'runtime.loglevel': 2, 'runtime.fteproxy.relay.throttle': 'fast'},
+        ['runtime.loglevel'],
+    ])
+    def test_invalid_settings_change_nothing(self, tmp_path, settings):
+        snapshot = fteproxy.settings.current()
+        with pytest.raises(fteproxy.settings.InvalidConfig):
+            fteproxy.settings.load(_config(tmp_path, settings))
+        assert fteproxy.settings.current() is snapshot
+
+    def test_reload_keeps_settings_on_failure(self, tmp_path):
+        path = _config(tmp_path, {'runtime.fteproxy.relay.socket_timeout': 7})
+        fteproxy.conf.setValue('runtime.fteproxy.config_file', path)
+        fteproxy.settings.reload()
+        assert fteproxy.settings.current().socket_timeout == 7
+
+        with open(path, 'w') as fh:
+            fh.write('{"runtime.fteproxy.relay.socket_timeout": ')
+        fteproxy.settings.reload()
+        assert fteproxy.settings.current().socket_timeout == 7
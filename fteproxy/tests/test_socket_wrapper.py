@@ -6,8 +6,15 @@ Tests for _FTESocketWrapper.recv() connection-close (EOF) semantics.
 These exercise a gap in the existing suite: what recv() does when the peer
 closes the TCP connection while undecodable bytes remain buffered in the
 decoder (e.g. the peer was cut off part-way through a covertext cell).
+
+Also tests send() with a send pipeline (runtime.fteproxy.relay.pipeline_depth),
+and with writes held back by cork() or a coalescing window.
 """
 
+import time
+import socket
+import threading
+
 import pytest
 
 import fte
@@ -64,6 +71,11 @@ class FakeSocket:
                 "EOF" % self.eof_reads)
         return b''
 
+    def recv_into(self, buffer, nbytes=0):
+        data = self.recv(nbytes or len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
     # send()/sendall() are only reached during negotiation; unused here since
     # these tests wrap with negotiate=False.
     def send(self, data):
@@ -116,3 +128,158 @@ class TestRecvEOF:
         wrapper = _wrap(fake)
         assert wrapper.recv(65536) == b'hello'
         assert wrapper.recv(65536) == b''
+
+
+class TestIdleBuffer:
+    """An idle connection holds a small decoder buffer."""
+
+    def test_small_message_keeps_the_buffer_small(self):
+        regex, fixed_slice = _regex_slice()
+        [near, far] = socket.socketpair()
+        try:
+            sender = fteproxy.wrap_socket(far, regex, fixed_slice, regex, fixed_slice,
+                                          negotiate=False)
+            receiver = fteproxy.wrap_socket(near, regex, fixed_slice, regex, fixed_slice,
+                                            negotiate=False)
+            sender.send(b'hi')
+            assert receiver.recv(2 ** 18) == b'hi'
+            buffer = receiver._decoder._buffer
+            assert len(buffer._data) == buffer.capacity
+        finally:
+            near.close()
+            far.close()
+
+
+@pytest.fixture
+def pipelined_pair():
+    """Two wrapped ends of a socketpair, the sending one with a send pipeline."""
+    fteproxy.conf.setValue('runtime.fteproxy.relay.pipeline_depth', 2)
+    a, b = socket.socketpair()
+    a.settimeout(5)
+    b.settimeout(5)
+    sender = _wrap(a)
+    fteproxy.conf.setValue('runtime.fteproxy.relay.pipeline_depth', 0)
+    receiver = _wrap(b)
+    yield sender, receiver
+    sender.close()
+    receiver.close()
+
+
+class TestSendPipeline:
+    """send() with a pipeline encodes and writes on separate threads."""
+
+    def test_data_arrives_in_order_and_close_flushes(self, pipelined_pair):
+        """Every chunk sent arrives in order, including those still queued
+        when the sender closes."""
+        sender, receiver = pipelined_pair
+        chunks = [('chunk %d;' % i).encode('utf-8') * 100 for i in range(50)]
+        received = []
+
+        def receive():
+            while True:
+                data = receiver.recv(65536)
+                if not data:
+                    break
+                received.append(data)
+        reader = threading.Thread(target=receive)
+        reader.start()
+
+        for chunk in chunks:
+            assert sender.send(chunk) == len(chunk)
+        sender.close()
+        reader.join(10)
+
+        assert b''.join(received) == b''.join(chunks)
+
+    def test_send_after_close_raises(self, pipelined_pair):
+        """A send after close() raises, rather than starting a new pipeline
+        or queueing data that is never written."""
+        sender, receiver = pipelined_pair
+        sender.send(b'hello')
+        sender.close()
+        with pytest.raises(OSError):
+            sender.send(b'lost')
+        assert sender._pipeline is None
+
+    def test_write_error_is_raised_by_next_send(self, pipelined_pair):
+        """Once the writer fails, a later send() raises its error."""
+        sender, receiver = pipelined_pair
+        receiver.close()
+        with pytest.raises(OSError):
+            for _ in range(100):
+                sender.send(b'X' * 65536)
+
+
+class RecordingSocket(FakeSocket):
+    """A FakeSocket that records the covertext written with sendall()."""
+
+    def __init__(self):
+        FakeSocket.__init__(self, [])
+        self.written = []
+
+    def sendall(self, data):
+        self.written.append(data)
+
+    def decoded(self):
+        """The data sent, decoded from the covertext written so far."""
+        wrapper = _wrap(FakeSocket(list(self.written)))
+        received = []
+        while True:
+            data = wrapper.recv(65536)
+            if not data:
+                return b''.join(received)
+            received.append(data)
+
+
+class TestCoalescing:
+    """send() holding writes back, to send them as one cell."""
+
+    def test_small_writes_share_one_cell(self):
+        """Writes within the window are sent together once it has passed."""
+        fake = RecordingSocket()
+        wrapper = _wrap(fake)
+        wrapper.set_coalescing(0.05, 4096)
+        for i in range(10):
+            wrapper.send(b'write %d;' % i)
+        assert fake.written == []
+
+        time.sleep(0.2)
+        assert len(fake.written) == 1
+        assert fake.decoded() == b''.join(b'write %d;' % i for i in range(10))
+
+    def test_threshold_sends_without_waiting(self):
+        """Writes are sent as soon as the byte threshold is reached."""
+        fake = RecordingSocket()
+        wrapper = _wrap(fake)
+        wrapper.set_coalescing(10, 100)
+        wrapper.send(b'A' * 60)
+        assert fake.written == []
+        wrapper.send(b'B' * 60)
+        assert len(fake.written) == 1
+        assert fake.decoded() == b'A' * 60 + b'B' * 60
+
+    def test_cork_holds_until_uncork(self):
+        """Corked writes are held past the window, and however large, until
+        uncork() sends them at once."""
+        fake = RecordingSocket()
+        wrapper = _wrap(fake)
+        wrapper.set_coalescing(0.01, 100)
+        wrapper.cork()
+        wrapper.send(b'A' * 1000)
+        wrapper.send(b'B' * 10)
+        time.sleep(0.05)
+        assert fake.written == []
+
+        wrapper.uncork()
+        assert len(fake.written) == 1
+        assert fake.decoded() == b'A' * 1000 + b'B' * 10
+
+    def test_close_flushes(self):
+        """Held writes are sent when the socket is closed."""
+        fake = RecordingSocket()
+        fake.close = lambda: None
+        wrapper = _wrap(fake)
+        wrapper.cork()
+        wrapper.send(b'held')
+        wrapper.close()
+        assert fake.decoded() == b'held'
@@ -12,6 +12,7 @@ These tests verify end-to-end functionality by:
 
 import os
 import sys
+import json
 import time
 import socket
 import signal
@@ -248,6 +249,12 @@ class TestCLI:
         result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
         assert result.returncode != 0
 
+    def test_lazy_warmup_with_workers_is_rejected(self):
+        cmd = get_fteproxy_cmd() + ['--mode', 'server', '--lazy-warmup', '--workers', '2']
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+        assert result.returncode != 0
+        assert '--lazy-warmup requires --workers 1' in result.stderr
+
     def test_key_file_in_help(self):
         """Test that --key-file appears in the help output."""
         cmd = get_fteproxy_cmd() + ['--help']
@@ -372,3 +379,336 @@ class TestKeyFileEndToEnd:
         )
         assert received_data == test_data, \
             f"Data mismatch: {received_data!r} != {test_data!r}"
+
+
+WORKERS_CLIENT_PORT = 18279
+WORKERS_SERVER_PORT = 18280
+WORKERS_PROXY_PORT = 18281
+
+
+@pytest.mark.skipif(not hasattr(socket, 'SO_REUSEPORT'),
+                    reason='--workers requires SO_REUSEPORT')
+class TestWorkersEndToEnd:
+    """End-to-end test of a server sharded across worker processes."""
+
+    @pytest.fixture
+    def fteproxy_server(self, tmp_path):
+        """Start an fteproxy server with two worker processes, logging to a file."""
+        log_path = tmp_path / 'server.log'
+        cmd = get_fteproxy_cmd() + [
+            '--mode', 'server',
+            '--workers', '2',
+            '--server_ip', BIND_IP,
+            '--server_port', str(WORKERS_SERVER_PORT),
+            '--proxy_ip', BIND_IP,
+            '--proxy_port', str(WORKERS_PROXY_PORT),
+        ]
+        env = dict(os.environ, PYTHONUNBUFFERED='1')
+        with open(log_path, 'w') as log:
+            proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+        if not wait_for_port(BIND_IP, WORKERS_SERVER_PORT):
+            proc.terminate()
+            pytest.fail(f"Server failed to start: {log_path.read_text()}")
+        time.sleep(1)
+        yield proc, log_path
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+    @pytest.fixture
+    def fteproxy_client(self, fteproxy_server):
+        """Start a single-process fteproxy client in front of the server."""
+        cmd = get_fteproxy_cmd() + [
+            '--mode', 'client',
+            '--quiet',
+            '--client_ip', BIND_IP,
+            '--client_port', str(WORKERS_CLIENT_PORT),
+            '--server_ip', BIND_IP,
+            '--server_port', str(WORKERS_SERVER_PORT),
+        ]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if not wait_for_port(BIND_IP, WORKERS_CLIENT_PORT):
+            proc.terminate()
+            stdout, stderr = proc.communicate(timeout=5)
+            pytest.fail(f"Client failed to start. stdout: {stdout}, stderr: {stderr}")
+        time.sleep(1)
+        yield fteproxy_server
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+    @staticmethod
+    def _worker_pids(log_path):
+        prefix = 'INFO: started fteproxy worker '
+        return [int(line[len(prefix):]) for line in log_path.read_text().splitlines()
+                if line.startswith(prefix)]
+
+    def test_workers_transfer_restart_and_stats(self, fteproxy_client):
+        """Data flows through the workers, a killed worker is replaced and
+        SIGUSR1 reports the counters of all workers added together."""
+        server, log_path = fteproxy_client
+
+        for i in range(4):
+            test_data = f'Worker connection {i}'.encode('utf-8')
+            assert transfer_through_proxy(
+                test_data,
+                client_port=WORKERS_CLIENT_PORT,
+                proxy_port=WORKERS_PROXY_PORT) == test_data
+
+        pids = self._worker_pids(log_path)
+        assert len(pids) == 2
+        os.kill(pids[0], signal.SIGKILL)
+
+        deadline = time.time() + 10
+        while len(self._worker_pids(log_path)) < 3 and time.time() < deadline:
+            time.sleep(0.2)
+        assert len(self._worker_pids(log_path)) == 3
+
+        test_data = b'After restart'
+        assert transfer_through_proxy(
+            test_data,
+            client_port=WORKERS_CLIENT_PORT,
+            proxy_port=WORKERS_PROXY_PORT) == test_data
+
+        server.send_signal(signal.SIGUSR1)
+        deadline = time.time() + 5
+        while 'INFO: stats: ' not in log_path.read_text() and time.time() < deadline:
+            time.sleep(0.2)
+        stats_line = [line for line in log_path.read_text().splitlines()
+                      if line.startswith('INFO: stats: ')][-1]
+        counters = dict(field.split('=') for field in stats_line.split()[2:])
+        # Readiness probes are accepted connections too, so only a lower bound.
+        assert int(counters['accepted']) >= 1
+        assert set(counters) == {'accepted', 'active', 'failed', 'queued',
+                                 'connecting', 'connect_ms', 'setup_ms'}
+
+
+LAZY_CLIENT_PORT = 18379
+LAZY_SERVER_PORT = 18380
+LAZY_PROXY_PORT = 18381
+
+
+class TestLazyWarmupEndToEnd:
+    """End-to-end test of a server that loads most formats after it starts
+    listening."""
+
+    @pytest.fixture
+    def fteproxy_client(self, tmp_path):
+        status_path = tmp_path / 'warmup'
+        server = subprocess.Popen(get_fteproxy_cmd() + [
+            '--mode', 'server',
+            '--quiet',
+            '--lazy-warmup',
+            '--warmup-status-file', str(status_path),
+            '--server_ip', BIND_IP,
+            '--server_port', str(LAZY_SERVER_PORT),
+            '--proxy_ip', BIND_IP,
+            '--proxy_port', str(LAZY_PROXY_PORT),
+        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        client = subprocess.Popen(get_fteproxy_cmd() + [
+            '--mode', 'client',
+            '--quiet',
+            '--client_ip', BIND_IP,
+            '--client_port', str(LAZY_CLIENT_PORT),
+            '--server_ip', BIND_IP,
+            '--server_port', str(LAZY_SERVER_PORT),
+        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        for port in (LAZY_SERVER_PORT, LAZY_CLIENT_PORT):
+            if not wait_for_port(BIND_IP, port):
+                server.terminate()
+                client.terminate()
+                pytest.fail('fteproxy failed to start on port ' + str(port))
+        time.sleep(1)
+
+        yield server, status_path
+
+        for proc in (client, server):
+            proc.terminate()
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    def test_warmup_reports_ready(self, fteproxy_client):
+        server, status_path = fteproxy_client
+
+        test_data = b'Lazy warm-up'
+        assert transfer_through_proxy(
+            test_data,
+            client_port=LAZY_CLIENT_PORT,
+            proxy_port=LAZY_PROXY_PORT) == test_data
+
+        deadline = time.time() + STARTUP_TIMEOUT
+        while time.time() < deadline:
+            status = status_path.read_text() if status_path.exists() else ''
+            if status.startswith('ready'):
+                break
+            time.sleep(0.2)
+        [state, progress] = status.split()
+        [done, total] = progress.split('/')
+        assert state == 'ready'
+        assert done == total
+
+        server.terminate()
+        server.wait(timeout=5)
+        assert not status_path.exists()
+
+
+RELOAD_CLIENT_PORT = 18479
+RELOAD_SERVER_PORT = 18480
+RELOAD_PROXY_PORT = 18481
+
+
+class TestReloadEndToEnd:
+    """End-to-end test of SIGHUP reloading the settings of --config files."""
+
+    @staticmethod
+    def _write_config(path, key, **languages):
+        settings = {'runtime.fteproxy.encrypter.key': key}
+        for name, language in languages.items():
+            settings['runtime.state.' + name + '_language'] = language
+        path.write_text(json.dumps(settings))
+
+    @pytest.fixture
+    def proxies(self, request, tmp_path):
+        # The relay backend of the client; threads unless the test asks.
+        backend = getattr(request, 'param', 'threads')
+        client_config = tmp_path / 'client.json'
+        server_config = tmp_path / 'server.json'
+        for path in (client_config, server_config):
+            self._write_config(path, KEYFILE_TEST_KEY)
+
+        server = subprocess.Popen(get_fteproxy_cmd() + [
+            '--mode', 'server',
+            '--quiet',
+            '--config', str(server_config),
+            '--server_ip', BIND_IP,
+            '--server_port', str(RELOAD_SERVER_PORT),
+            '--proxy_ip', BIND_IP,
+            '--proxy_port', str(RELOAD_PROXY_PORT),
+        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        client = subprocess.Popen(get_fteproxy_cmd() + [
+            '--mode', 'client',
+            '--quiet',
+            '--config', str(client_config),
+            '--relay-backend', backend,
+            '--client_ip', BIND_IP,
+            '--client_port', str(RELOAD_CLIENT_PORT),
+            '--server_ip', BIND_IP,
+            '--server_port', str(RELOAD_SERVER_PORT),
+        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        dest = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        dest.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        dest.bind((BIND_IP, RELOAD_PROXY_PORT))
+        dest.listen(5)
+        for port in (RELOAD_SERVER_PORT, RELOAD_CLIENT_PORT):
+            if not wait_for_port(BIND_IP, port):
+                server.terminate()
+                client.terminate()
+                pytest.fail('fteproxy failed to start on port ' + str(port))
+        time.sleep(1)
+        # The readiness probe of the client is relayed too.
+        dest.settimeout(0.5)
+        try:
+            while True:
+                dest.accept()[0].close()
+        except socket.timeout:
+            pass
+        dest.settimeout(DATA_TIMEOUT)
+
+        yield client, server, client_config, server_config, dest
+
+        dest.close()
+        for proc in (client, server):
+            proc.terminate()
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    @staticmethod
+    def _open(dest):
+        conn = socket.create_connection((BIND_IP, RELOAD_CLIENT_PORT), timeout=5)
+        upstream, _ = dest.accept()
+        upstream.settimeout(5)
+        return conn, upstream
+
+    @staticmethod
+    def _relays(tunnel, msg):
+        conn, upstream = tunnel
+        try:
+            for sender, receiver in ((conn, upstream), (upstream, conn)):
+                sender.sendall(msg)
+                received = b''
+                while len(received) < len(msg):
+                    chunk = receiver.recv(4096)
+                    if not chunk:
+                        break
+                    received += chunk
+                if received != msg:
+                    return False
+        except (socket.timeout, OSError):
+            return False
+        return True
+
+    def test_sighup_applies_to_new_tunnels_only(self, proxies):
+        client, server, client_config, server_config, dest = proxies
+        new_key = 'fedcba9876543210' * 4
+
+        old = self._open(dest)
+        assert self._relays(old, b'before')
+
+        # With only the client on the new key, new tunnels fail to negotiate.
+        self._write_config(client_config, new_key)
+        client.send_signal(signal.SIGHUP)
+        time.sleep(1)
+        assert not self._relays(self._open(dest), b'mismatched')
+
+        self._write_config(server_config, new_key)
+        server.send_signal(signal.SIGHUP)
+        time.sleep(1)
+        assert self._relays(self._open(dest), b'after')
+
+        # The tunnel opened before the reloads still has the old key.
+        assert self._relays(old, b'still open')
+        assert client.poll() is None and server.poll() is None
+
+    @pytest.mark.parametrize('proxies', ['selectors'], indirect=True)
+    def test_sighup_changing_format_keeps_open_tunnels(self, proxies):
+        """A tunnel set up before a reload that changes the format negotiates
+        the format it was set up with, though it sends its negotiation cell
+        after the reload: with the selectors backend, only once there is data.
+        """
+        client, server, client_config, server_config, dest = proxies
+
+        old = self._open(dest)
+        self._write_config(client_config, KEYFILE_TEST_KEY,
+                           upstream='ssh-request', downstream='ssh-response')
+        client.send_signal(signal.SIGHUP)
+        time.sleep(2)
+
+        assert self._relays(old, b'old format')
+        assert self._relays(self._open(dest), b'new format')
+        assert client.poll() is None and server.poll() is None
+
+    def test_sighup_without_config_stops(self):
+        """Without --config, a hangup stops fteproxy as it always did."""
+        client = subprocess.Popen(get_fteproxy_cmd() + [
+            '--mode', 'client',
+            '--quiet',
+            '--client_ip', BIND_IP,
+            '--client_port', str(RELOAD_CLIENT_PORT),
+            '--server_ip', BIND_IP,
+            '--server_port', str(RELOAD_SERVER_PORT),
+        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            assert wait_for_port(BIND_IP, RELOAD_CLIENT_PORT)
+            client.send_signal(signal.SIGHUP)
+            assert client.wait(timeout=5) == -signal.SIGHUP
+        finally:
+            if client.poll() is None:
+                client.kill()
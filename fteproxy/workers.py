@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+import os
+import time
+import signal
+import threading
+import multiprocessing
+import multiprocessing.connection
+
+import fteproxy
+import fteproxy.conf
+import fteproxy.relay
+import fteproxy.settings
+
+
+# A worker that dies sooner than this after being started is not restarted
+# until this many seconds have passed, so that a worker failing at startup
+# (e.g. it cannot bind its port) does not turn into a fork loop.
+_RESTART_DELAY = 1.0
+
+
+def _exit_with_supervisor():
+    # The parent sentinel becomes ready once the supervisor process is gone,
+    # however it exited.
+    multiprocessing.connection.wait([multiprocessing.parent_process().sentinel])
+    os._exit(0)
+
+
+def _reload(signum, frame):
+    # The handler runs on the thread of the listener, between two of its
+    # steps, so the settings are loaded on a thread of their own, rather than
+    # waiting on locks that the listener may hold.
+    thread = threading.Thread(target=fteproxy.settings.reload)
+    thread.daemon = True
+    thread.start()
+
+
+def _run_worker(make_listener, counters, cpu):
+    # The supervisor owns the lifecycle of its workers: it stops them with
+    # SIGTERM, so a Ctrl-C delivered to the whole process group is left to it,
+    # and passes on SIGHUP if there is a config file to reload. Without one, a
+    # hangup stops workers as usual.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if hasattr(signal, 'SIGHUP'):
+        if fteproxy.conf.getValue('runtime.fteproxy.config_file'):
+            signal.signal(signal.SIGHUP, _reload)
+        else:
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+
+    watchdog = threading.Thread(target=_exit_with_supervisor)
+    watchdog.daemon = True
+    watchdog.start()
+
+    if cpu is not None:
+        os.sched_setaffinity(0, [cpu])
+
+    fteproxy.conf.setValue('runtime.fteproxy.relay.reuse_port', True)
+    listener = make_listener()
+    listener.stats = fteproxy.relay.stats(counters)
+    listener.run()
+
+
+class supervisor(threading.Thread):
+
+    """``fteproxy.workers.supervisor`` forks ``num_workers`` processes that each
+    run their own listener, as returned by ``make_listener``, bound to the same
+    port with SO_REUSEPORT, so that the kernel spreads connections, and with
+    them the FTE encode/decode work, across cores. A worker that dies is
+    restarted. If ``cpu_affinity`` is set, each worker is pinned to its own CPU.
+
+    The counters of all workers are kept in shared memory; ``stats`` adds them
+    up, so that the workers report as one server.
+    """
+
+    def __init__(self, num_workers, make_listener, cpu_affinity=False):
+        threading.Thread.__init__(self)
+        self._num_workers = num_workers
+        self._make_listener = make_listener
+        self._cpu_affinity = cpu_affinity
+        self._running = False
+
+        # fork (rather than spawn) so that workers inherit the configuration
+        # and the FTE tables that were already built by this process.
+        self._context = multiprocessing.get_context('fork')
+        self._processes = [None] * num_workers
+        self._startTimes = [0] * num_workers
+        self._counters = [self._context.Array('q', len(fteproxy.relay.stats.FIELDS), lock=False)
+                          for _ in range(num_workers)]
+
+    def _cpu(self, index):
+        if not self._cpu_affinity:
+            return None
+        cpus = sorted(os.sched_getaffinity(0))
+        return cpus[index % len(cpus)]
+
+    def _startWorker(self, index):
+        # Tunnels of a dead worker died with it; its totals carry over.
+        self._counters[index][fteproxy.relay.stats.FIELDS.index('active')] = 0
+        process = self._context.Process(
+            target=_run_worker,
+            args=(self._make_listener, self._counters[index], self._cpu(index)))
+        process.daemon = True
+        process.start()
+        self._processes[index] = process
+        self._startTimes[index] = time.time()
+        fteproxy.info('started fteproxy worker %d', process.pid)
+
+    def run(self):
+        """Start all workers, then restart any worker that exits until
+        ``stop()`` is called.
+        """
+        self._running = True
+        for index in range(self._num_workers):
+            self._startWorker(index)
+
+        while self._running:
+            multiprocessing.connection.wait(
+                [p.sentinel for p in self._processes if p.is_alive()], timeout=0.5)
+
+            for index, process in enumerate(self._processes):
+                if not self._running or process.is_alive():
+                    continue
+                if time.time() - self._startTimes[index] < _RESTART_DELAY:
+                    continue
+                fteproxy.warn('fteproxy worker %d exited with %s, restarting',
+                              process.pid, process.exitcode)
+                self._startWorker(index)
+
+    def stop(self):
+        """Stop all workers and stop restarting them.
+        """
+        self._running = False
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            if process is not None:
+                process.join(timeout=5)
+
+    def reload(self):
+        """Have every worker reload ``runtime.fteproxy.config_file``. Workers
+        restarted later inherit the settings of the supervisor's process.
+        """
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signal.SIGHUP)
+
+    @property
+    def stats(self):
+        """An ``fteproxy.relay.stats`` with the counters of all workers added
+        together.
+        """
+        totals = [sum(column) for column in zip(*[c[:] for c in self._counters])]
+        return fteproxy.relay.stats(totals)
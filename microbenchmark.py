@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+microbenchmark.py - In-process microbenchmarks of the fteproxy record layer and
+negotiation.
+
+benchmark.py measures fteproxy end to end, through subprocesses and link
+shapers, where a few percent more time spent per cell is lost in the noise.
+This script times the code that runs per cell and per connection directly, in
+this process:
+
+  * encode              - record_layer.Encoder.push + pop of one payload
+  * decode              - record_layer.Decoder.push + pop of the cells of one
+                          payload
+  * negotiate_cell      - NegotiateCell.toBytes + fromBytes
+  * accept_negotiation  - NegotiationManager._acceptNegotiation of a client's
+                          first cell, as the first client of its language: no
+                          languages are remembered from earlier clients
+
+encode and decode run for every language of the definitions release and every
+payload size; the negotiation benchmarks for every request language. Each case
+is called --warmup times untimed, then timed in --repeat samples, each of as
+many calls as take at least --min-time seconds, with the garbage collector
+off. The samples of all cases are taken round-robin, so that a spell of the
+machine running slower (another process, a VM's neighbours, frequency scaling)
+slows down one sample of every case, not every sample of a few. The median,
+minimum and standard deviation of the time per call are reported.
+
+    python3 microbenchmark.py --json baseline.json      # record a baseline
+    python3 microbenchmark.py --compare baseline.json   # run, compare to it
+    python3 microbenchmark.py --compare baseline.json --against new.json
+
+A case whose fastest sample (--statistic min, the default) is more than
+--threshold slower than in the baseline is a regression, and --compare then
+exits with status 1. The minimum is what a case takes when nothing else gets
+in its way, which makes it the steadiest of the statistics from run to run. Baselines are only
+comparable when taken on the same machine, Python and fte.
+
+Stdlib only. Requires `fteproxy` (and its `fte` dependency) to be importable by
+the same interpreter that runs this script:  python3 microbenchmark.py
+"""
+
+import argparse
+import functools
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+from benchmark import fmt_size, _parse_size
+
+# progress should stream even when stdout is a pipe (e.g. redirected to a file)
+print = functools.partial(print, flush=True)  # noqa: A001
+
+
+BENCHMARKS = ['encode', 'decode', 'negotiate_cell', 'accept_negotiation']
+DEFAULT_SIZES = [64, 1024, 16 * 1024, 256 * 1024]
+
+
+# --------------------------------------------------------------------------- #
+# Timing
+# --------------------------------------------------------------------------- #
+
+def calibrate(fn, warmup=3, min_time=0.02):
+    """Call fn() warmup times untimed, then return the number of calls that
+    one sample of it is made of: doubled until a sample takes at least
+    min_time seconds."""
+    for _ in range(warmup):
+        fn()
+
+    number = 1
+    while _sample(fn, number) < min_time:
+        number *= 2
+    return number
+
+
+def summarize(number, samples):
+    """The summary of the seconds per call of each sample."""
+    return {'number': number,
+            'median_s': statistics.median(samples),
+            'min_s': min(samples),
+            'stdev_s': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+            'samples': samples}
+
+
+def _sample(fn, number):
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        return time.perf_counter() - t0
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+# --------------------------------------------------------------------------- #
+# Cases
+# --------------------------------------------------------------------------- #
+
+def _encoder(language):
+    import fteproxy.conf
+    import fteproxy.defs
+    import fteproxy.format_cache
+
+    return fteproxy.format_cache.get_encoder(
+        fteproxy.defs.getRegex(language),
+        fteproxy.defs.getFixedSlice(language),
+        fteproxy.conf.getValue('runtime.fteproxy.encrypter.key'))
+
+
+def case_encode(language, size):
+    import fteproxy.record_layer
+
+    encoder = fteproxy.record_layer.Encoder(_encoder(language))
+    payload = os.urandom(size)
+
+    def run():
+        encoder.push(payload)
+        encoder.pop()
+    return run
+
+
+def case_decode(language, size):
+    import fteproxy.record_layer
+
+    encoder = fteproxy.record_layer.Encoder(_encoder(language))
+    encoder.push(os.urandom(size))
+    covertext = encoder.pop()
+    decoder = fteproxy.record_layer.Decoder(_encoder(language))
+
+    def run():
+        decoder.push(covertext)
+        decoder.pop()
+    return run
+
+
+def case_negotiate_cell(language):
+    import fteproxy
+    import fteproxy.conf
+
+    cell = fteproxy.NegotiateCell()
+    cell.setDefFile(fteproxy.conf.getValue('fteproxy.defs.release'))
+    cell.setLanguage(language[:-len('-request')])
+
+    def run():
+        fteproxy.NegotiateCell().fromBytes(cell.toBytes())
+    return run
+
+
+def case_accept_negotiation(language):
+    import fteproxy
+    import fteproxy.conf
+    import fteproxy.defs
+
+    key = fteproxy.conf.getValue('runtime.fteproxy.encrypter.key')
+    manager = fteproxy.NegotiationManager(key[:16], key[16:])
+
+    # The client's first cell, as a client configured for language sends it.
+    preferred = fteproxy.conf.getValue('runtime.state.upstream_language')
+    fteproxy.conf.setValue('runtime.state.upstream_language', language)
+    try:
+        [encoder, _] = manager._init_encoders(
+            fteproxy.defs.getRegex(language), fteproxy.defs.getFixedSlice(language),
+            None, -1)
+        data = manager._makeNegotiationCell(encoder)
+    finally:
+        fteproxy.conf.setValue('runtime.state.upstream_language', preferred)
+
+    def run():
+        fteproxy._recent_languages.clear()
+        manager._acceptNegotiation(data)
+    return run
+
+
+def cases(benchmarks, languages, sizes):
+    """Yield (case id, record fields, function to time) for every case of the
+    given benchmarks."""
+    requests = [language for language in languages if language.endswith('-request')]
+    for benchmark in benchmarks:
+        if benchmark in ('encode', 'decode'):
+            make = case_encode if benchmark == 'encode' else case_decode
+            for language in languages:
+                for size in sizes:
+                    yield (f"{benchmark}/{language}/{size}",
+                           dict(benchmark=benchmark, language=language, size=size),
+                           make(language, size))
+        else:
+            make = globals()['case_' + benchmark]
+            for language in requests:
+                yield (f"{benchmark}/{language}",
+                       dict(benchmark=benchmark, language=language),
+                       make(language))
+
+
+# --------------------------------------------------------------------------- #
+# Runner
+# --------------------------------------------------------------------------- #
+
+def fmt_time(seconds):
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:8.2f} us"
+    return f"{seconds * 1e3:8.2f} ms"
+
+
+def _label(record):
+    label = f"{record['benchmark']:<18} {record['language']:<32}"
+    label += f" {fmt_size(record['size']) if 'size' in record else '':>6}"
+    return label
+
+
+def run_suite(args):
+    import fte
+    import fteproxy
+    import fteproxy.conf
+    import fteproxy.defs
+
+    # Failed trial decodes during negotiation are logged; keep them out of
+    # both the output and the timings.
+    fteproxy.conf.setValue('runtime.loglevel', 0)
+
+    definitions = fteproxy.defs.load_definitions()
+    languages = args.languages or list(definitions)
+    for language in languages:
+        if language not in definitions:
+            sys.exit(f"unknown language {language!r} in release "
+                     f"{fteproxy.conf.getValue('fteproxy.defs.release')}")
+
+    meta = {'python': sys.version.split()[0],
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+            'fteproxy': fteproxy.__version__,
+            'fte': fte.__version__,
+            'release': fteproxy.conf.getValue('fteproxy.defs.release'),
+            'warmup': args.warmup,
+            'repeat': args.repeat,
+            'min_time': args.min_time}
+
+    print("=" * 78)
+    print("fteproxy microbenchmarks")
+    print(f"  python      : {meta['python']}  ({sys.executable})")
+    print(f"  fteproxy    : {meta['fteproxy']}  fte {meta['fte']}  release {meta['release']}")
+    print(f"  benchmarks  : {', '.join(args.benchmarks)}")
+    print(f"  languages   : {len(languages)}")
+    print(f"  sizes       : {', '.join(fmt_size(s) for s in args.sizes)}")
+    print(f"  samples     : {args.repeat} x >= {args.min_time}s, after {args.warmup} warm-up calls")
+    print("=" * 78)
+
+    # Load every format first, so that compiling them is not timed, and so
+    # that negotiation narrows the candidates down with all of them.
+    t0 = time.perf_counter()
+    for language in definitions:
+        _encoder(language)
+    print(f"  loaded {len(definitions)} formats in {(time.perf_counter() - t0) * 1000:.0f} ms")
+
+    # Calibrate every case, then take their samples round-robin: a spell of
+    # the machine running slower then spreads over the samples of all cases,
+    # rather than slowing down every sample of the few cases it falls on.
+    runs = []
+    for case, record, fn in cases(args.benchmarks, languages, args.sizes):
+        runs.append((dict(record, case=case), fn,
+                     calibrate(fn, warmup=args.warmup, min_time=args.min_time)))
+    print(f"  calibrated {len(runs)} cases, sampling them {args.repeat} times round-robin")
+
+    samples = [[] for _ in runs]
+    for _ in range(args.repeat):
+        for (record, fn, number), times in zip(runs, samples):
+            times.append(_sample(fn, number) / number)
+
+    results = []
+    for (record, fn, number), times in zip(runs, samples):
+        r = summarize(number, times)
+        record = dict(record, **r)
+        spread = 100 * r['stdev_s'] / r['median_s'] if r['median_s'] else 0.0
+        line = f"  {_label(record)}: median {fmt_time(r['median_s'])}  min {fmt_time(r['min_s'])}  ±{spread:4.1f}%"
+        if 'size' in record:
+            line += f"  {record['size'] * 8 / 1e6 / r['min_s']:9.2f} Mbit/s"
+        print(line)
+        results.append(record)
+
+    return {'meta': meta, 'results': results}
+
+
+def compare(baseline, current, threshold, statistic='min_s'):
+    """Print the change of every case of current from baseline in statistic,
+    and return the cases slower by more than threshold (a fraction)."""
+    before = {r['case']: r for r in baseline['results']}
+    after = {r['case']: r for r in current['results']}
+
+    print("=" * 78)
+    print(f"comparison with the baseline, by the {statistic[:-2]} of the samples; "
+          f"regressions beyond +{threshold * 100:.0f}%")
+    for field in ('python', 'machine', 'fte', 'release'):
+        if baseline['meta'].get(field) != current['meta'].get(field):
+            print(f"  WARNING: {field} differs: baseline {baseline['meta'].get(field)}, "
+                  f"now {current['meta'].get(field)}")
+    print("=" * 78)
+
+    regressions = []
+    improvements = 0
+    for case, record in after.items():
+        if case not in before:
+            continue
+        ratio = record[statistic] / before[case][statistic] - 1
+        tag = ''
+        if ratio > threshold:
+            tag = 'REGRESSION'
+            regressions.append(case)
+        elif ratio < -threshold:
+            tag = 'faster'
+            improvements += 1
+        print(f"  {_label(record)}: {fmt_time(before[case][statistic])} -> "
+              f"{fmt_time(record[statistic])}  {ratio * 100:+6.1f}%  {tag}")
+
+    compared = len(set(before) & set(after))
+    print(f"\n{compared} cases compared: {len(regressions)} regressions, "
+          f"{improvements} faster, {compared - len(regressions) - improvements} within "
+          f"±{threshold * 100:.0f}%")
+    missing = sorted(set(before) - set(after))
+    if missing:
+        print(f"{len(missing)} cases of the baseline were not run, e.g. {missing[0]}")
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="In-process microbenchmarks of the fteproxy record layer "
+                    "and negotiation.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    ap.add_argument('--benchmarks', nargs='+', default=BENCHMARKS, choices=BENCHMARKS,
+                    metavar='NAME', help=f"any of: {', '.join(BENCHMARKS)}")
+    ap.add_argument('--languages', nargs='+', default=None, metavar='LANGUAGE',
+                    help="languages to run (default: every language of the release)")
+    ap.add_argument('--sizes', nargs='+', type=_parse_size, default=DEFAULT_SIZES,
+                    metavar='SIZE', help="payload sizes for encode and decode, e.g. 64 1K 256K")
+    ap.add_argument('--warmup', type=int, default=3,
+                    help="untimed calls of each case before its samples")
+    ap.add_argument('--repeat', type=int, default=10,
+                    help="timed samples per case")
+    ap.add_argument('--min-time', type=float, default=0.02, metavar='SECONDS',
+                    help="shortest duration of one sample")
+    ap.add_argument('--json', default=None, metavar='PATH',
+                    help="write the results as JSON, for use as a baseline")
+    ap.add_argument('--compare', default=None, metavar='BASELINE',
+                    help="compare the results with those in the JSON file BASELINE, "
+                         "and exit with status 1 if any case regressed")
+    ap.add_argument('--against', default=None, metavar='PATH',
+                    help="with --compare, compare the results in the JSON file PATH "
+                         "instead of running the benchmarks")
+    ap.add_argument('--threshold', type=float, default=0.10,
+                    help="slowdown, as a fraction, beyond which --compare reports "
+                         "a regression")
+    ap.add_argument('--statistic', default='min', choices=['min', 'median'],
+                    help="what --compare compares of the samples of each case")
+    args = ap.parse_args()
+
+    if args.repeat < 1:
+        ap.error("--repeat must be at least 1")
+    if args.min_time <= 0:
+        ap.error("--min-time must be positive")
+    if args.against and not args.compare:
+        ap.error("--against requires --compare")
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+
+    if args.against:
+        with open(args.against) as fh:
+            current = json.load(fh)
+    else:
+        try:
+            import fteproxy  # noqa: F401
+        except Exception as e:
+            print(f"ERROR: cannot import fteproxy ({e}).")
+            print("Install it into this interpreter, e.g.:  pip install -e .  (needs `fte`)")
+            sys.exit(2)
+        current = run_suite(args)
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(current, fh, indent=2)
+        print(f"\nWrote {len(current['results'])} records to {args.json}")
+
+    if baseline is not None and compare(baseline, current, args.threshold, args.statistic + '_s'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()